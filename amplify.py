@@ -0,0 +1,256 @@
+#!/bin/env python
+
+import ipaddress
+import logging
+import struct
+
+import numpy as np
+
+import anon
+from packetbatch import PacketBatch, fold_checksums
+from randomness import random_integers
+
+'''
+Replay-based amplification: realistic packets at the generator's volume.
+
+A small seed capture (e.g. sample_data/http.pcap) is parsed once into a
+PacketPool, which keeps its IPv4 packets back to back as pcap records along
+with everything needed to rewrite them: where the addresses and checksums
+sit, which seed host each address belongs to, and the checksums with the
+seed addresses already taken out of them.
+
+An Amplifier then re-emits the pool over and over, one copy of the seed after
+another, as a packet source for the generator (like flows.FlowTable). Each
+copy has its seed hosts replaced by hosts drawn from the generator's host
+tables, and the packets get the generator's timestamps. The batches are one
+gather copy out of the pool buffer, followed by vectorized writes of the new
+addresses and incrementally patched checksums (RFC 1624), so payloads are
+never parsed or summed again. Truncated packets are patched just as well.
+'''
+
+ETHER_TYPE_IPV4 = 0x0800
+ETHER_TYPE_VLAN = 0x8100
+PROTOCOL_TCP = 6
+PROTOCOL_UDP = 17
+
+
+def word_sums(ips):
+    """Sums of the two 16-bit words of uint32 addresses"""
+    ips = np.asarray(ips, dtype=np.uint64)
+    return (ips >> 16) + (ips & 0xffff)
+
+
+def complement_sums(ips):
+    """Sums of the ones' complements of the two 16-bit words of addresses"""
+    ips = np.asarray(ips, dtype=np.uint64)
+    return (0xffff - (ips >> 16)) + (0xffff - (ips & 0xffff))
+
+
+class PacketPool(object):
+    """
+    records:     PacketBatch of the pool packets as pcap records
+    ip_start:    offset of the ipv4 header in each record
+    checksum:    offset of the TCP/UDP checksum in each record, or -1 when it
+                 is not patched (other protocols, later fragments, UDP
+                 without a checksum)
+    udp:         whether each packet is UDP, whose checksum is never zero
+    source, destination: seed host number of each packet's addresses
+    internal:    whether each seed host is on the internal side
+    ip_base, l4_base: the IP header and TCP/UDP checksums with the seed
+                 addresses taken out, ready to have new ones added
+    """
+
+    def __init__(self, records, ip_start, checksum, udp, source, destination,
+                 internal, ip_base, l4_base):
+        self.records = records
+        self.ip_start = ip_start
+        self.checksum = checksum
+        self.udp = udp
+        self.source = source
+        self.destination = destination
+        self.internal = internal
+        self.ip_base = ip_base
+        self.l4_base = l4_base
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Reads the IPv4 over Ethernet packets of a capture (anything
+        anon.PcapReader reads). Other packets are left out of the pool.
+        """
+        rows = []
+        hosts = {}
+        first_source = None
+        skipped = 0
+        with anon.PcapReader(file_name) as reader:
+            for offset, packet_header, packet_data in reader:
+                packet = bytes(packet_data)
+                ip = 14
+                ether_type = struct.unpack_from('!H', packet, 12)[0] if len(packet) >= 14 else 0
+                if ether_type == ETHER_TYPE_VLAN and len(packet) >= 18:
+                    ip = 18
+                    ether_type = struct.unpack_from('!H', packet, 16)[0]
+                if ether_type != ETHER_TYPE_IPV4 or len(packet) < ip + 20:
+                    skipped += 1
+                    continue
+
+                ihl = (packet[ip] & 0x0f) * 4
+                flags, protocol, header_checksum, source_ip, destination_ip = \
+                    struct.unpack_from('!HxBHII', packet, ip + 6)
+                segment = ip + ihl
+                checksum = -1
+                if not flags & 0x1fff:
+                    if protocol == PROTOCOL_TCP and len(packet) >= segment + 18:
+                        checksum = segment + 16
+                    elif protocol == PROTOCOL_UDP and len(packet) >= segment + 8:
+                        checksum = segment + 6
+                        if packet[checksum:checksum + 2] == b'\x00\x00':
+                            checksum = -1
+                l4_checksum = (struct.unpack_from('!H', packet, checksum)[0]
+                               if checksum >= 0 else 0)
+
+                if first_source is None:
+                    first_source = source_ip
+                source = hosts.setdefault(source_ip, len(hosts))
+                destination = hosts.setdefault(destination_ip, len(hosts))
+                record = struct.pack('=IIII', packet_header.start_time, packet_header.offset_ms,
+                                     len(packet), packet_header.original_length) + packet
+                rows.append((record, 16 + ip, checksum + 16 if checksum >= 0 else -1,
+                             source, destination, header_checksum, l4_checksum,
+                             source_ip, destination_ip, protocol))
+
+        if not rows:
+            raise ValueError("{0} holds no IPv4 packets to amplify".format(file_name))
+        if skipped:
+            logging.info("Left {0} non-IPv4 packets of {1} out of the pool".format(
+                skipped, file_name))
+
+        # private addresses are internal hosts; a seed without any has the
+        # host which sent the first packet play the internal side
+        addresses = sorted(hosts, key=hosts.get)
+        internal = np.array([ipaddress.IPv4Address(address).is_private
+                             for address in addresses], dtype=bool)
+        if not internal.any():
+            internal[hosts[first_source]] = True
+
+        records, ip_start, checksum, source, destination, header_checksum, l4_checksum, \
+            source_ip, destination_ip, protocol = zip(*rows)
+        lengths = np.array([len(record) for record in records], dtype=np.int64)
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.frombuffer(b"".join(records), dtype=np.uint8)
+        header = data[offsets[:-1, np.newaxis] + np.arange(8)].copy().view('=u4')
+        batch = PacketBatch(data, offsets, header[:, 0], header[:, 1])
+
+        seed_ips = complement_sums(source_ip) + complement_sums(destination_ip)
+        header_checksum = np.array(header_checksum, dtype=np.uint64)
+        l4_checksum = np.array(l4_checksum, dtype=np.uint64)
+        pool = cls(batch,
+                   np.array(ip_start, dtype=np.int64),
+                   np.array(checksum, dtype=np.int64),
+                   np.array(protocol) == PROTOCOL_UDP,
+                   np.array(source, dtype=np.int64),
+                   np.array(destination, dtype=np.int64),
+                   internal,
+                   (0xffff - header_checksum) + seed_ips,
+                   (0xffff - l4_checksum) + seed_ips)
+        logging.info("Loaded {0} packets between {1} hosts from {2}".format(
+            len(pool), len(addresses), file_name))
+        return pool
+
+    def mean_record_size(self):
+        return self.records.nbytes / float(len(self))
+
+
+class Amplifier(object):
+    """
+    Packet source re-emitting a PacketPool with the seed hosts of each copy
+    replaced by hosts drawn from internal_hosts and external_hosts (see
+    test.HostTable), with the popularity of host_pairs (see
+    hostmodel.HostPairs) or uniformly when that is None
+    """
+
+    def __init__(self, pool, internal_hosts, external_hosts, rng=np.random,
+                 host_pairs=None):
+        self.pool = pool
+        self.internal_hosts = internal_hosts
+        self.external_hosts = external_hosts
+        self.host_pairs = host_pairs
+        self.rng = rng
+        # packets emitted so far, and the hosts of the copy in progress
+        self.position = 0
+        self._copy = None
+
+    def mean_record_size(self):
+        return self.pool.mean_record_size()
+
+    def draw_hosts(self, count):
+        """(ips, macs) of the hosts standing in for the seed hosts in count copies"""
+        internal = self.pool.internal
+        shape = (count, len(internal))
+        if self.host_pairs is None:
+            internal_ndx = random_integers(self.rng, 0, len(self.internal_hosts), shape)
+            external_ndx = random_integers(self.rng, 0, len(self.external_hosts), shape)
+        else:
+            internal_ndx = self.host_pairs.internal.sample(shape, self.rng)
+            external_ndx = self.host_pairs.external.sample(shape, self.rng)
+        ips = np.where(internal, self.internal_hosts.ips[internal_ndx],
+                       self.external_hosts.ips[external_ndx])
+        macs = np.where(internal[:, np.newaxis], self.internal_hosts.macs[internal_ndx],
+                        self.external_hosts.macs[external_ndx])
+        return ips, macs
+
+    def create_batch(self, ts_sec, ts_usec):
+        pool = self.pool
+        count = len(ts_sec)
+        packets = self.position + np.arange(count)
+        ndx = packets % len(pool)
+        copies = packets // len(pool)
+        first = int(copies[0])
+
+        # a copy split across batches keeps its hosts
+        ips, macs = self.draw_hosts(int(copies[-1]) - first + 1)
+        if self._copy is not None and self._copy[0] == first:
+            ips[0], macs[0] = self._copy[1], self._copy[2]
+        self._copy = (int(copies[-1]), ips[-1], macs[-1])
+        self.position += count
+
+        batch = pool.records.take(ndx)
+        data = batch.data
+        starts = batch.offsets[:-1]
+        copy = copies - first
+        source_ip = ips[copy, pool.source[ndx]].astype(np.uint32)
+        destination_ip = ips[copy, pool.destination[ndx]].astype(np.uint32)
+
+        header = np.empty((count, 2), dtype='=u4')
+        header[:, 0] = ts_sec
+        header[:, 1] = ts_usec
+        data[starts[:, np.newaxis] + np.arange(8)] = header.view(np.uint8)
+        data[starts[:, np.newaxis] + 16 + np.arange(6)] = macs[copy, pool.destination[ndx]]
+        data[starts[:, np.newaxis] + 22 + np.arange(6)] = macs[copy, pool.source[ndx]]
+
+        ip_start = starts + pool.ip_start[ndx]
+        addresses = np.empty((count, 2), dtype='>u4')
+        addresses[:, 0] = source_ip
+        addresses[:, 1] = destination_ip
+        data[ip_start[:, np.newaxis] + 12 + np.arange(8)] = addresses.view(np.uint8)
+
+        new_ips = word_sums(source_ip) + word_sums(destination_ip)
+        self.put_checksums(data, ip_start + 10, fold_checksums(pool.ip_base[ndx] + new_ips))
+
+        patched = pool.checksum[ndx] >= 0
+        checksums = fold_checksums(pool.l4_base[ndx][patched] + new_ips[patched])
+        # a UDP checksum that works out to zero is sent as all ones
+        checksums[(checksums == 0) & pool.udp[ndx][patched]] = 0xffff
+        self.put_checksums(data, starts[patched] + pool.checksum[ndx][patched], checksums)
+
+        return PacketBatch(data, batch.offsets, np.asarray(ts_sec, dtype=np.uint32),
+                           np.asarray(ts_usec, dtype=np.uint32))
+
+    @staticmethod
+    def put_checksums(data, offsets, checksums):
+        data[offsets] = checksums >> 8
+        data[offsets + 1] = checksums & 0xff
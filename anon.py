@@ -1,7 +1,17 @@
 import logging
 from logging.handlers import TimedRotatingFileHandler
+import argparse
+import hashlib
+import mmap
+import multiprocessing
+import os
+import shutil
 import struct
-from collections import namedtuple
+import time
+from collections import namedtuple, OrderedDict
+
+import compression
+import metrics
 
 TEST_FILE = 'sample_data/http.pcap'
 TEST_OUT = 'sample_data/http_anon.pcap'
@@ -19,15 +29,281 @@ Ipv4Datagram = namedtuple('Ipv4Datagram', 'version ihl dscp ecn total_length ide
 # 16	128	Destination IP Address
 # 20	160	Options (if IHL > 5)
 pkt_count = 0
+# frames left out of the output because their protocol is not handled
+dropped_count = 0
+
+PCAP_MAGIC = 0xa1b2c3d4
+# pcap with nanosecond rather than microsecond timestamps
+PCAP_NS_MAGIC = 0xa1b23c4d
+# pcapng block types and the section header's byte-order magic
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IF_TSRESOL = 9
+# size of the output buffer, writes are flushed to disk in chunks this big
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# maximum number of real -> fake address mappings kept in memory
+ADDRESS_CACHE_SIZE = 1000000
+BROADCAST_MAC = b'\xff' * 6
+ETHER_TYPE_IPV4 = 0x0800
+ETHER_TYPE_ARP = 0x0806
+ETHER_TYPE_IPV6 = 0x86dd
+# 802.1Q and 802.1ad tags, stepped over to get to the frame's own ether type
+VLAN_ETHER_TYPES = (0x8100, 0x88a8)
+# pcap timestamps hold whole seconds in an unsigned 32-bit field
+MAX_TIMESTAMP = 1 << 32
+RESERVED_IPS = (b'\x00' * 4, b'\xff' * 4)
+# hop-by-hop, routing and destination options headers, all laid out as
+# (next header, length in 8 byte units past the first 8, options...)
+IPV6_OPTION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+
+
+def swap_magic(magic):
+    return struct.unpack('>I', struct.pack('<I', magic))[0]
+
+
+def get_byte_order(byte_data):
+    """
+    Works out the byte order a pcap file was written in from the magic number
+    in the first four bytes of its file header. For pcapng, whose block type
+    reads the same either way, the byte-order magic in the next eight bytes
+    of the section header decides.
+    """
+    magic = struct.unpack('<I', byte_data[0:4])[0]
+    if magic == PCAPNG_SECTION_HEADER and len(byte_data) >= 12:
+        magic = struct.unpack('<I', byte_data[8:12])[0]
+        if magic == PCAPNG_BYTE_ORDER_MAGIC:
+            return '<'
+        if magic == swap_magic(PCAPNG_BYTE_ORDER_MAGIC):
+            return '>'
+        raise ValueError("bad pcapng byte-order magic 0x{0:08x}".format(magic))
+    if magic in (PCAP_MAGIC, PCAP_NS_MAGIC):
+        return '<'
+    if magic in (swap_magic(PCAP_MAGIC), swap_magic(PCAP_NS_MAGIC)):
+        return '>'
+    raise ValueError("not a pcap file, magic number was 0x{0:08x}".format(magic))
+
 
+def get_ticks(byte_data):
+    """Resolution of the timestamps of a pcap file, in ticks per second"""
+    magic = struct.unpack('<I', byte_data[0:4])[0]
+    if magic in (PCAP_NS_MAGIC, swap_magic(PCAP_NS_MAGIC)):
+        return 1000000000
+    return 1000000
 
 
 def read_file_header(byte_data):
-    return PcapHeader._make(struct.unpack('IHHiIII', byte_data))
+    byte_order = get_byte_order(byte_data)
+    return PcapHeader._make(struct.unpack(byte_order + 'IHHiIII', byte_data))
+
+
+def read_packet_header(byte_data, byte_order='='):
+    return PacketHeader._make(struct.unpack(byte_order + 'IIII', byte_data))
+
+
+class PcapReader(object):
+    """
+    Memory-maps a pcap file and walks its records in place. Packet data is
+    handed out as memoryview slices of the mapping, so nothing is copied or
+    read with a separate syscall per packet. Views must not be used after the
+    reader is closed. Compressed files (see compression.py) are decompressed
+    into a temporary file first.
+
+    Both microsecond and nanosecond pcap are read, as is pcapng, whose
+    Enhanced Packet Blocks are handed out as ordinary records. Timestamps come
+    out with offset_ms counting ticks (1e6 or 1e9) per second, and
+    pcap_header() describes the records in legacy pcap terms so they can be
+    written back out as pcap. header_bytes is everything in front of the
+    first record, to write before a raw copy of a range of records.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._file = compression.open_decompressed(file_name)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self.size = len(self._view)
+
+        self.byte_order = get_byte_order(self._view[0:12])
+        self._packet_header = struct.Struct(self.byte_order + 'IIII')
+        self._block_header = struct.Struct(self.byte_order + 'II')
+        self.pcapng = struct.unpack_from('<I', self._view)[0] == PCAPNG_SECTION_HEADER
+        if self.pcapng:
+            # (link type, snaplen, timestamp units per second) per interface
+            self._interfaces = []
+            self._scanned = 0
+            self.data_start = self._scan_interfaces(self.size, preamble=True)
+            link_type, snaplen, units = (self._interfaces[0] if self._interfaces
+                                         else (1, 65535, 1000000))
+            self.ticks = 1000000000 if units > 1000000 else 1000000
+            self.header = PcapHeader(PCAP_NS_MAGIC if self.ticks > 1000000 else PCAP_MAGIC,
+                                     2, 4, 0, 0, snaplen, link_type)
+        else:
+            self.data_start = 24
+            self.ticks = get_ticks(self._view[0:4])
+            self.header = read_file_header(self._view[0:24])
+        self.header_bytes = bytes(self._view[0:self.data_start])
+
+    def __iter__(self):
+        return self.records()
+
+    def pcap_header(self):
+        """Legacy pcap file header for the records as records() yields them"""
+        if not self.pcapng:
+            return self.header_bytes
+        return struct.pack(self.byte_order + 'IHHiIII', *self.header)
+
+    def read(self, start, end):
+        """Returns a view of the raw bytes between two offsets of the file"""
+        return self._view[start:end]
+
+    def offsets(self, start=None, end=None):
+        """
+        Yields the offset of every record (every block, for pcapng) between
+        two offsets, reading only the lengths needed to hop between them
+        """
+        view = self._view
+        if start is None:
+            start = self.data_start
+        if end is None:
+            end = self.size
+
+        offset = start
+        if self.pcapng:
+            unpack_from = self._block_header.unpack_from
+            while offset + 12 <= end:
+                yield offset
+                length = unpack_from(view, offset)[1]
+                if length < 12:
+                    raise ValueError("{0}: bad pcapng block length {1} at offset {2}".format(
+                        self.file_name, length, offset))
+                offset += length
+        else:
+            unpack_from = self._packet_header.unpack_from
+            while offset + 16 <= end:
+                yield offset
+                offset += 16 + unpack_from(view, offset)[2]
+
+    def records(self, start=None, end=None):
+        """
+        Yields (offset, PacketHeader, packet data) for every record that
+        starts at or after the start offset and before the end offset
+        """
+        if start is None:
+            start = self.data_start
+        if end is None:
+            end = self.size
+        if self.pcapng:
+            for record in self._blocks(start, end):
+                yield record
+            return
+
+        view = self._view
+        unpack_from = self._packet_header.unpack_from
+        offset = start
+        while offset + 16 <= end:
+            packet_header = PacketHeader._make(unpack_from(view, offset))
+            data_start = offset + 16
+            data_end = data_start + packet_header.included_length
+            yield offset, packet_header, view[data_start:data_end]
+            offset = data_end
+
+    def _blocks(self, start, end):
+        """records() for pcapng: packets from EPBs, other blocks are skipped"""
+        view = self._view
+        block_header = self._block_header.unpack_from
+        packet_block = struct.Struct(self.byte_order + 'IIIII').unpack_from
+        ticks = self.ticks
+
+        offset = start
+        while offset + 12 <= end:
+            block_type, length = block_header(view, offset)
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                interface, high, low, captured, original = packet_block(view, offset + 8)
+                units = self.interface(interface)[2]
+                seconds, fraction = divmod((high << 32) | low, units)
+                if units != ticks:
+                    fraction = fraction * ticks // units
+                yield (offset, PacketHeader(seconds, fraction, captured, original),
+                       view[offset + 28:offset + 28 + captured])
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION and offset >= self._scanned:
+                self._scan_interfaces(offset + length)
+            elif block_type == PCAPNG_SECTION_HEADER and offset > 0:
+                raise ValueError("{0}: pcapng files with more than one section are "
+                                 "not supported".format(self.file_name))
+            if length < 12:
+                raise ValueError("{0}: bad pcapng block length {1} at offset {2}".format(
+                    self.file_name, length, offset))
+            offset += length
+
+    def _scan_interfaces(self, end, preamble=False):
+        """
+        Reads the interface descriptions up to the end offset, carrying on
+        from the last scan so interfaces are numbered in file order. With
+        preamble, stops at the first packet block. Returns where it stopped.
+        """
+        view = self._view
+        offset = self._scanned
+        while offset + 12 <= end:
+            block_type, length = self._block_header.unpack_from(view, offset)
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                self._interfaces.append(self._read_interface(offset))
+            elif preamble and block_type != PCAPNG_SECTION_HEADER:
+                break
+            if length < 12:
+                raise ValueError("{0}: bad pcapng block length {1} at offset {2}".format(
+                    self.file_name, length, offset))
+            offset += length
+        self._scanned = offset
+        return offset
+
+    def _read_interface(self, offset):
+        """(link type, snaplen, timestamp units per second) of an IDB"""
+        view = self._view
+        length = self._block_header.unpack_from(view, offset)[1]
+        link_type, snaplen = struct.unpack_from(self.byte_order + 'H2xI', view, offset + 8)
+        units = 1000000
+        option = offset + 16
+        while option + 4 <= offset + length - 4:
+            code, size = struct.unpack_from(self.byte_order + 'HH', view, option)
+            if code == 0:
+                break
+            if code == PCAPNG_IF_TSRESOL:
+                resolution = view[option + 4]
+                # the top bit selects a power of two rather than of ten
+                if resolution & 0x80:
+                    units = 2 ** (resolution & 0x7f)
+                else:
+                    units = 10 ** resolution
+            option += 4 + size + (-size % 4)
+        return link_type, snaplen, units
 
+    def interface(self, interface):
+        """(link type, snaplen, timestamp units per second) of a pcapng interface"""
+        if interface >= len(self._interfaces):
+            # described further into the file than we have read so far
+            self._scan_interfaces(self.size)
+        return self._interfaces[interface]
 
-def read_packet_header(byte_data):
-    return PacketHeader._make(struct.unpack('IIII', byte_data))
+    def close(self):
+        if self._map is not None:
+            self._view.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # packet views are still alive somewhere, the mapping is
+                # released once the last of them is garbage collected
+                pass
+            self._file.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def read_ethernet_frame(byte_data):
@@ -37,58 +313,607 @@ def read_ethernet_frame(byte_data):
     return EthernetFrame(destination_mac=destination, source_mac=source, ether_type=ether_type)
 
 def read_ipv4_datagram(byte_data):
-    pass
+    (v1, v2, total_length, identification, v3, time_to_live, protocol,
+     header_checksum, source_ip, destination_ip) = struct.unpack('!BBHHHBBHII', byte_data[0:20])
+    ihl = v1 & 0x0f
+    return Ipv4Datagram(version=v1 >> 4,
+                        ihl=ihl,
+                        dscp=v2 >> 2,
+                        ecn=v2 & 0x03,
+                        total_length=total_length,
+                        identification=identification,
+                        flags=v3 >> 13,
+                        frament_offset=v3 & 0x1fff,
+                        time_to_live=time_to_live,
+                        protocol=protocol,
+                        header_checksum=header_checksum,
+                        source_ip=source_ip,
+                        destination_ip=destination_ip,
+                        options=bytes(byte_data[20:ihl*4]))
+
+
+def internet_checksum(byte_data, initial=0):
+    """
+    RFC 1071 ones' complement checksum. Rather than summing 16-bit words one
+    at a time this relies on 2**16 being 1 modulo 0xffff, so the sum of the
+    words folds down to the whole buffer read as one big integer mod 0xffff.
+    """
+    if len(byte_data) % 2:
+        byte_data = bytes(byte_data) + b'\x00'
+    total = initial + int.from_bytes(byte_data, 'big')
+    folded = total % 0xffff
+    if folded == 0 and total:
+        folded = 0xffff
+    return ~folded & 0xffff
+
+
+class AddressMapper(object):
+    """
+    Maps real MAC and IP addresses to fake ones with a keyed hash, so the same
+    real address always maps to the same fake one for a given key no matter
+    where in a capture (or in which process) it is seen. A bounded LRU cache
+    in front of the hash keeps memory constant on very large captures.
+    """
+
+    def __init__(self, key=None, cache_size=ADDRESS_CACHE_SIZE):
+        if key is None:
+            key = os.urandom(16)
+        # blake2b takes keys of up to 64 bytes, longer ones are hashed down to
+        # that size (shorter ones are used as they are, so their mappings stay)
+        if len(key) > hashlib.blake2b.MAX_KEY_SIZE:
+            key = hashlib.blake2b(key).digest()
+        self.key = key
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _lookup(self, kind, address, digest_size):
+        cache_key = (kind, address)
+        cache = self._cache
+        fake = cache.get(cache_key)
+        if fake is not None:
+            cache.move_to_end(cache_key)
+            return fake
+
+        fake = hashlib.blake2b(address, digest_size=digest_size,
+                               key=self.key, person=kind).digest()
+        if len(cache) >= self.cache_size:
+            cache.popitem(last=False)
+        cache[cache_key] = fake
+        return fake
+
+    def map_mac(self, mac):
+        mac = bytes(mac)
+        if mac == BROADCAST_MAC:
+            return mac
+        fake = self._lookup(b'mac', mac, 6)
+        # keep the individual/group bit so multicast stays multicast
+        return bytes([(fake[0] & 0xfe) | (mac[0] & 0x01)]) + fake[1:]
+
+    def map_ip(self, ip):
+        ip = bytes(ip)
+        if ip in RESERVED_IPS:
+            return ip
+        return self._lookup(b'ip', ip, 4)
+
+    def map_ipv6(self, ip):
+        ip = bytes(ip)
+        if ip == b'\x00' * 16:
+            return ip
+        fake = self._lookup(b'ip6', ip, 16)
+        # keep multicast (ff00::/8) multicast, and unicast out of it
+        if ip[0] == 0xff:
+            return ip[0:2] + fake[2:]
+        if fake[0] == 0xff:
+            return b'\xfe' + fake[1:]
+        return fake
+
+    def scrub(self, packet, start, end, position):
+        """
+        Replaces the L5+ bytes in packet[start:end] with noise. The noise is
+        drawn from a keystream of the key and the record's position in the
+        input, so a capture anonymized twice with the same key comes out the
+        same byte for byte.
+        """
+        if end > start:
+            seed = hashlib.blake2b(struct.pack('!Q', position), key=self.key,
+                                   person=b'scrub').digest()
+            packet[start:end] = hashlib.shake_256(seed).digest(end)[start:end]
+
+
+def anonymize_arp(packet, mapper, offset, position):
+    if len(packet) < offset + 28:
+        mapper.scrub(packet, offset, len(packet), position)
+        return
+    packet[offset+8:offset+14] = mapper.map_mac(packet[offset+8:offset+14])
+    packet[offset+14:offset+18] = mapper.map_ip(packet[offset+14:offset+18])
+    packet[offset+18:offset+24] = mapper.map_mac(packet[offset+18:offset+24])
+    packet[offset+24:offset+28] = mapper.map_ip(packet[offset+24:offset+28])
+
+
+def anonymize_ipv4(packet, mapper, offset, truncated, position):
+    if len(packet) < offset + 20 or packet[offset] & 0x0f < 5:
+        mapper.scrub(packet, offset, len(packet), position)
+        return
+    ihl = (packet[offset] & 0x0f) * 4
+
+    total_length = struct.unpack_from('!H', packet, offset + 2)[0]
+    end = min(offset + total_length, len(packet))
+    truncated = truncated or offset + total_length > len(packet)
+
+    # swap the addresses and fix up the header checksum
+    source_ip = mapper.map_ip(packet[offset+12:offset+16])
+    destination_ip = mapper.map_ip(packet[offset+16:offset+20])
+    packet[offset+12:offset+16] = source_ip
+    packet[offset+16:offset+20] = destination_ip
+    packet[offset+10:offset+12] = b'\x00\x00'
+    struct.pack_into('!H', packet, offset + 10,
+                     internet_checksum(packet[offset:offset+ihl]))
+
+    flags = struct.unpack_from('!H', packet, offset + 6)[0]
+    protocol = packet[offset + 9]
+    segment = offset + ihl
+
+    # later fragments carry no L4 header and fragmented segments can't be
+    # checksummed here, so everything past the IP header is just scrubbed
+    if flags & 0x1fff:
+        mapper.scrub(packet, segment, end, position)
+        return
+    truncated = truncated or bool(flags & 0x2000)
+
+    if protocol == 6 and end - segment >= 20:
+        data_offset = (packet[segment + 12] >> 4) * 4
+        mapper.scrub(packet, segment + data_offset, end, position)
+        checksum_offset = segment + 16
+    elif protocol == 17 and end - segment >= 8:
+        mapper.scrub(packet, segment + 8, end, position)
+        checksum_offset = segment + 6
+        # a zero UDP checksum means the sender didn't compute one
+        if packet[checksum_offset:checksum_offset+2] == b'\x00\x00':
+            truncated = True
+    elif protocol == 1 and end - segment >= 8:
+        mapper.scrub(packet, segment + 8, end, position)
+        checksum_offset = segment + 2
+    else:
+        mapper.scrub(packet, segment, end, position)
+        return
+
+    if truncated:
+        return
+
+    packet[checksum_offset:checksum_offset+2] = b'\x00\x00'
+    if protocol == 1:
+        checksum = internet_checksum(packet[segment:end])
+    else:
+        pseudo_header = b"".join([source_ip, destination_ip,
+                                  struct.pack('!BBH', 0, protocol, end - segment)])
+        checksum = internet_checksum(packet[segment:end],
+                                     initial=int.from_bytes(pseudo_header, 'big'))
+        if protocol == 17 and checksum == 0:
+            checksum = 0xffff
+    struct.pack_into('!H', packet, checksum_offset, checksum)
+
 
+def anonymize_ipv6(packet, mapper, offset, truncated, position):
+    if len(packet) < offset + 40:
+        mapper.scrub(packet, offset, len(packet), position)
+        return
 
-def clone_pcap_file(input_file, output_file):
+    payload_length = struct.unpack_from('!H', packet, offset + 4)[0]
+    end = min(offset + 40 + payload_length, len(packet))
+    truncated = truncated or offset + 40 + payload_length > len(packet)
+
+    source_ip = mapper.map_ipv6(packet[offset+8:offset+24])
+    destination_ip = mapper.map_ipv6(packet[offset+24:offset+40])
+    packet[offset+8:offset+24] = source_ip
+    packet[offset+24:offset+40] = destination_ip
+
+    # step over the extension headers, blanking their options (all zeros
+    # reads back as padding, and as a routing header with no segments left)
+    protocol = packet[offset + 6]
+    segment = offset + 40
+    while protocol in IPV6_OPTION_HEADERS or protocol == IPV6_FRAGMENT_HEADER:
+        if end - segment < 8:
+            mapper.scrub(packet, segment, end, position)
+            return
+        if protocol == IPV6_FRAGMENT_HEADER:
+            # as with IPv4, only a first fragment has an L4 header and no
+            # fragment can be checksummed on its own
+            fragment = struct.unpack_from('!H', packet, segment + 2)[0]
+            if fragment & 0xfff8:
+                mapper.scrub(packet, segment + 8, end, position)
+                return
+            truncated = truncated or bool(fragment & 0x0001)
+            length = 8
+        else:
+            length = (packet[segment + 1] + 1) * 8
+            if end - segment < length:
+                mapper.scrub(packet, segment, end, position)
+                return
+            packet[segment+2:segment+length] = bytes(length - 2)
+        protocol = packet[segment]
+        segment += length
+
+    if protocol == 6 and end - segment >= 20:
+        data_offset = (packet[segment + 12] >> 4) * 4
+        mapper.scrub(packet, segment + data_offset, end, position)
+        checksum_offset = segment + 16
+    elif protocol == 17 and end - segment >= 8:
+        mapper.scrub(packet, segment + 8, end, position)
+        checksum_offset = segment + 6
+    elif protocol == 58 and end - segment >= 8:
+        mapper.scrub(packet, segment + 8, end, position)
+        checksum_offset = segment + 2
+    else:
+        mapper.scrub(packet, segment, end, position)
+        return
+
+    if truncated:
+        return
+
+    # unlike IPv4, every one of these carries a checksum over the pseudo header
+    packet[checksum_offset:checksum_offset+2] = b'\x00\x00'
+    pseudo_header = b"".join([source_ip, destination_ip,
+                              struct.pack('!IxxxB', end - segment, protocol)])
+    checksum = internet_checksum(packet[segment:end],
+                                 initial=int.from_bytes(pseudo_header, 'big'))
+    if protocol == 17 and checksum == 0:
+        checksum = 0xffff
+    struct.pack_into('!H', packet, checksum_offset, checksum)
+
+
+def anonymize_packet(packet_data, mapper, truncated=False, position=0):
+    """
+    Returns an anonymized copy of one ethernet frame: MAC and IP addresses are
+    remapped, L5+ data is replaced with noise (see AddressMapper.scrub, which
+    position is passed on to) and checksums are recomputed (unless the packet
+    was truncated by the snaplen, in which case they can't be). VLAN tags are
+    kept. Frames of protocols we can't parse can't be anonymized without
+    mangling them, so None is returned for those and the frame is to be
+    dropped.
+    """
+    packet = bytearray(packet_data)
+    if len(packet) < 14:
+        mapper.scrub(packet, 0, len(packet), position)
+        return packet
+
+    packet[0:6] = mapper.map_mac(packet[0:6])
+    packet[6:12] = mapper.map_mac(packet[6:12])
+
+    offset = 14
+    ether_type = struct.unpack_from('!H', packet, 12)[0]
+    while ether_type in VLAN_ETHER_TYPES and len(packet) >= offset + 4:
+        ether_type = struct.unpack_from('!H', packet, offset + 2)[0]
+        offset += 4
+
+    if ether_type == ETHER_TYPE_IPV4:
+        anonymize_ipv4(packet, mapper, offset, truncated, position)
+    elif ether_type == ETHER_TYPE_IPV6:
+        anonymize_ipv6(packet, mapper, offset, truncated, position)
+    elif ether_type == ETHER_TYPE_ARP:
+        anonymize_arp(packet, mapper, offset, position)
+    elif ether_type in VLAN_ETHER_TYPES:
+        # the snaplen cut a tag short, there is nothing past it to parse
+        mapper.scrub(packet, offset, len(packet), position)
+    else:
+        return None
+    return packet
+
+
+def anonymize_records(reader, mapper, time_shift=0, start=None, end=None,
+                      stats=None):
+    """
+    Generator at the heart of the anonymization pipeline. Walks the records
+    of an open PcapReader (optionally only those between the start and end
+    byte offsets) and yields the rewritten bytes of each one, header
+    included, with its timestamp shifted by time_shift seconds. Records come
+    out as pcap at the reader's resolution (see PcapReader.pcap_header), even
+    when the input is pcapng. Frames anonymize_packet can't handle are
+    dropped, and a record cut short by the end of the file is written with
+    the length it really has. Time spent reading, anonymizing and (in the
+    caller) writing is charged to stats.
+    """
+    global pkt_count
+    global dropped_count
+    packet_header_struct = struct.Struct(reader.byte_order + 'IIII')
+    ticks = reader.ticks
+    shift = int(round(time_shift * ticks))
+    if stats is not None:
+        stats.start_lap()
+
+    for offset, packet_header, packet_data in reader.records(start, end):
+        pkt_count += 1
+        if stats is not None:
+            stats.lap('read')
+
+        timestamp = packet_header.start_time * ticks + packet_header.offset_ms + shift
+        if not 0 <= timestamp < MAX_TIMESTAMP * ticks:
+            raise ValueError("shifting by {0} seconds moves the packet at offset {1} "
+                             "out of the range of pcap timestamps".format(time_shift, offset))
+
+        included_length = packet_header.included_length
+        if len(packet_data) < included_length:
+            logging.warning("The record at offset {0} is cut short by the end of the "
+                            "file, keeping its {1} bytes".format(offset, len(packet_data)))
+            included_length = len(packet_data)
+        truncated = included_length < packet_header.original_length
+        packet = anonymize_packet(packet_data, mapper, truncated, offset)
+        if stats is not None:
+            stats.lap('anonymize')
+        if packet is None:
+            dropped_count += 1
+            continue
+
+        yield packet_header_struct.pack(timestamp // ticks,
+                                        timestamp % ticks,
+                                        included_length,
+                                        packet_header.original_length)
+        yield packet
+        if stats is not None:
+            stats.lap('write')
+            stats.count(1, 16 + len(packet))
+
+
+def get_time_shift(reader, start_time):
+    """
+    Works out how many seconds the capture in reader has to be shifted by so
+    that its first packet lands on start_time (a time.strptime style string)
+    """
+    for offset, packet_header, packet_data in reader:
+        first = packet_header.start_time + packet_header.offset_ms / float(reader.ticks)
+        return time.mktime(time.strptime(start_time)) - first
+    return 0
+
+
+def check_time_shift(reader, time_shift):
+    """
+    Raises a ValueError when shifting the capture in reader by time_shift
+    seconds would move its first packet out of the range of pcap timestamps
+    """
+    for offset, packet_header, packet_data in reader:
+        first = packet_header.start_time + packet_header.offset_ms / float(reader.ticks)
+        if not 0 <= first + time_shift < MAX_TIMESTAMP:
+            raise ValueError("shifting by {0} seconds moves the first packet to {1:.0f}, "
+                             "out of the range of pcap timestamps".format(
+                                 time_shift, first + time_shift))
+        return
+
+
+def get_shard_boundaries(reader, shard_count):
+    """
+    Splits the records of a capture into shard_count byte ranges of roughly
+    equal size. Every range starts and ends on a record (or pcapng block)
+    boundary.
+    """
+    start = reader.data_start
+    target = (reader.size - start) / float(shard_count)
+    boundaries = [start]
+
+    # only the record headers are read while hopping through the file
+    for offset in reader.offsets():
+        if offset - start >= target * len(boundaries):
+            boundaries.append(offset)
+    boundaries.append(reader.size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def anonymize_shard(task):
+    """
+    Pool worker which anonymizes the records in one byte range of the input
+    into its own shard file. Every shard uses the same key, so the address
+    mapping is consistent across shards without any coordination.
+    """
+    input_file, shard_file, start, end, time_shift, key, metrics_options, compress = task
+    global pkt_count
+    global dropped_count
+    pkt_count = 0
+    dropped_count = 0
+
+    stats = None
+    if metrics_options is not None:
+        stats = metrics.create_stats('anon', per_process=True, **metrics_options)
+
+    mapper = AddressMapper(key=key)
+    with PcapReader(input_file) as reader:
+        with compression.open_compressed(shard_file, compress, threads=1,
+                                          buffering=WRITE_BUFFER_SIZE) as out:
+            for record in anonymize_records(reader, mapper, time_shift, start, end,
+                                            stats=stats):
+                out.write(record)
+    if stats is not None:
+        stats.close()
+    return pkt_count, dropped_count
+
+
+def clone_pcap_file_sharded(input_file, output_file, time_shift=0, key=None,
+                            workers=2, metrics_options=None, compress=None):
+    """
+    Anonymizes input_file by splitting it into one shard per worker, running
+    the shards in a process pool and concatenating the results in order.
+    metrics_options are the keyword arguments of metrics.create_stats.
+    Compressed shards are complete streams, so they concatenate just as well.
+    Compressed input would be decompressed by every worker, clone_pcap_file
+    decompresses it once before getting here.
+    """
     global pkt_count
+    global dropped_count
+    if key is None:
+        key = os.urandom(16)
 
-    # open the file for reading (r) in binary (b) mode
-    with open(input_file, "rb") as f:
-        pcap_header = read_file_header(f.read(24))
+    with PcapReader(input_file) as reader:
+        header_bytes = reader.pcap_header()
+        shards = get_shard_boundaries(reader, workers)
 
-        # attempt to read a packet
-        packet_header_bytes = f.read(16)
+    tasks = [(input_file, '{0}.shard{1:04d}'.format(output_file, i),
+              start, end, time_shift, key, metrics_options, compress)
+             for i, (start, end) in enumerate(shards)]
+    logging.info("Anonymizing {0} shards with {1} workers".format(len(tasks), workers))
 
-        while (packet_header_bytes != "") and (len(packet_header_bytes) > 0):
-            pkt_count += 1
-            packet_header = read_packet_header(packet_header_bytes)            
-            print(packet_header)
+    stats = None
+    if metrics_options is not None:
+        stats = metrics.create_stats('anon_scheduler', **metrics_options)
 
-            packet_data_bytes = f.read(packet_header.included_length)            
-            ethernet_frame = read_ethernet_frame(packet_data_bytes)
-            print(ethernet_frame)
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        done = 0
+        for count, dropped in pool.imap_unordered(anonymize_shard, tasks):
+            pkt_count += count
+            dropped_count += dropped
+            done += 1
+            if stats is not None:
+                stats.gauge('shards_pending', len(tasks) - done)
+                stats.gauge('shards_done', done)
+                stats.report()
+    finally:
+        pool.terminate()
+        pool.join()
 
+    with compression.open_compressed(output_file, compress) as out:
+        out.write(header_bytes)
+    with open(output_file, 'ab') as out:
+        for task in tasks:
+            shard_file = task[1]
+            with open(shard_file, 'rb') as shard:
+                shutil.copyfileobj(shard, out, WRITE_BUFFER_SIZE)
+            os.remove(shard_file)
 
 
-            # get the header for the next packet
-            packet_header_bytes = f.read(16)
-            
+def clone_pcap_file(input_file, output_file, time_shift=0, start_time=None,
+                    key=None, workers=1, metrics_options=None, compress=None):
+    """
+    Anonymizes input_file into output_file. With compress the output is
+    compressed with that codec and, like the generator's, named with its
+    extension. Returns the name of the file written.
+    """
+    if compress is not None and not output_file.endswith(compression.EXTENSIONS[compress]):
+        output_file += compression.EXTENSIONS[compress]
+
+    # the parent and every worker would each decompress their own copy, so
+    # decompress once up front and hand them all the same file
+    if workers > 1 and compression.detect_codec(input_file) is not None:
+        decompressed_file = output_file + '.input'
+        compression.decompress_file(input_file, decompressed_file)
+        try:
+            return clone_pcap_file(decompressed_file, output_file, time_shift=time_shift,
+                                   start_time=start_time, key=key, workers=workers,
+                                   metrics_options=metrics_options, compress=compress)
+        finally:
+            os.remove(decompressed_file)
+
+    # map the file for reading and stream the rewritten records back out
+    with PcapReader(input_file) as reader:
+        if start_time is not None:
+            time_shift = get_time_shift(reader, start_time)
+        logging.info("Shifting timestamps by {0} seconds".format(time_shift))
+        check_time_shift(reader, time_shift)
+
+        if workers <= 1:
+            stats = None
+            if metrics_options is not None:
+                stats = metrics.create_stats('anon', **metrics_options)
+            mapper = AddressMapper(key=key)
+            with compression.open_compressed(output_file, compress,
+                                              buffering=WRITE_BUFFER_SIZE) as out:
+                out.write(reader.pcap_header())
+                for record in anonymize_records(reader, mapper, time_shift,
+                                                stats=stats):
+                    out.write(record)
+            if stats is not None:
+                stats.close()
+
+    if workers > 1:
+        clone_pcap_file_sharded(input_file, output_file, time_shift=time_shift,
+                                key=key, workers=workers,
+                                metrics_options=metrics_options,
+                                compress=compress)
 
     logging.info("Finsished reading {0} packets".format(pkt_count))
+    if dropped_count:
+        logging.info("Dropped {0} frames of protocols that can't be anonymized".format(
+            dropped_count))
+    return output_file
+
 
 def main():
+    # setup the argument parser
+    parser = argparse.ArgumentParser(prog = 'python anon.py',
+                                     description = __doc__)
 
-    # setup logging
-    logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
-    logging.info("Starting the ORCA Synthetic PCAP Anonymizer Utility")
+    parser.add_argument("--input-file",
+        help="The pcap file to anonymize. Microsecond and nanosecond pcap and "
+             "pcapng are read, the output is pcap of the same resolution. "
+             "(default: %(default)s)",
+        default=TEST_FILE)
+
+    parser.add_argument("--output-file",
+        help="Where to write the anonymized pcap. (default: %(default)s)",
+        default=TEST_OUT)
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--time-shift",
+        help="Number of seconds (positive or negative) to shift every "
+             "timestamp by. (default: %(default)s)",
+        type=float,
+        default=0)
+    group.add_argument("--start-time",
+        help="Shift the capture so its first packet starts at this time, "
+             "e.g. 'Sun Oct 2 00:00:00 2016'")
+
+    parser.add_argument("--key",
+        help="Secret used to derive the fake addresses. The same key always "
+             "gives the same mapping (default: random per run)")
+
+    parser.add_argument("--workers",
+        help="Number of processes used to anonymize shards of the input in "
+             "parallel. (default: %(default)s)",
+        type=int,
+        default=1)
 
-    clone_pcap_file(TEST_FILE, TEST_OUT)
+    parser.add_argument("--compress",
+        help="Compress the output with this codec. Compressed input is "
+             "recognised automatically",
+        choices=sorted(compression.EXTENSIONS))
 
-    # with open(TEST_FILE, "rb") as f:
-        
-    #     while packet_header_bytes != "":
+    parser.add_argument("--stats",
+        help="Log a line of packet rates and per-stage timings every "
+             "--stats-interval seconds",
+        action="store_true")
 
-    #         # read and drop the packet data bytes
-    #         packet_data_bytes = f.read(packet_header.incl_len)
+    parser.add_argument("--stats-interval",
+        help="Seconds between stats lines and metrics file updates. "
+             "(default: %(default)s)",
+        type=float,
+        default=metrics.DEFAULT_INTERVAL)
+
+    parser.add_argument("--metrics-file",
+        help="Keep the same stats in this Prometheus text format file (with "
+             "--workers, each worker writes its own <name>.<pid>.prom next to it)")
+
+    args = parser.parse_args()
+
+    # setup logging
+    logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+    logging.info("Starting the ORCA Synthetic PCAP Anonymizer Utility")
 
-    #         layer_two = parse_layer_two(packet_data_bytes, header.little_endian)
-    #         layer_three = parse_layer_three(layer_two.data)
-    #         layer_four = parse_layer_four(layer_three.data)
+    if args.compress is not None and args.compress not in compression.get_codecs():
+        parser.error("{0} compression needs a package that is not installed".format(args.compress))
 
-    #         # get the header for the next packet
-    #         packet_header_bytes = f.read(16)
-    #         break
+    key = args.key.encode('utf-8') if args.key is not None else None
+    metrics_options = None
+    if args.stats or args.metrics_file is not None:
+        metrics_options = {'interval': args.stats_interval,
+                           'log': args.stats,
+                           'prometheus_file': args.metrics_file}
+    try:
+        clone_pcap_file(args.input_file, args.output_file,
+                        time_shift=args.time_shift,
+                        start_time=args.start_time,
+                        key=key,
+                        workers=args.workers,
+                        metrics_options=metrics_options,
+                        compress=args.compress)
+    except ValueError as e:
+        parser.error(str(e))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,308 @@
+#!/bin/env python
+
+import logging
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import amplify
+import anon
+import test
+import trafficmodel
+
+'''
+Throughput benchmarks for the generator and anonymizer hot paths.
+
+Every case of the matrix (host counts x file sizes x engines) runs in a fresh
+process so that its peak RSS is its own (inputs a case only reads, like the
+capture clone_pcap_file anonymizes, are generated beforehand by the parent),
+and the results are written as JSON:
+one entry per case with the packets and bytes processed, the best wall-clock
+time over the repeats and the derived packets and bytes per second. Passing a
+previous results file with --compare logs the change of every case that was
+run both times.
+'''
+
+DEFAULT_HOSTS = '50:500,500:5000'
+DEFAULT_SIZES = '10000000,100000000'
+DEFAULT_ENGINES = 'packet,batch,flows,mixed'
+# number of calls timed by the micro benchmarks
+PACKET_CALLS = 200000
+DURATION_CALLS = 200000
+# timestamps used for the generated files
+START_TIME = 1475366400
+# the amplify engine's seed capture, found wherever the benchmark is run from
+SEED_CAPTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), test.SEED_CAPTURE)
+
+
+def parse_hosts(value):
+    """Parses 'internal:external,...' into a list of (internal, external) pairs"""
+    pairs = []
+    for part in value.split(','):
+        internal, _, external = part.partition(':')
+        pairs.append((int(internal), int(external)))
+    return pairs
+
+
+def parse_engines(value):
+    """Parses a comma separated list of the generator's engines"""
+    engines = value.split(',')
+    for engine in engines:
+        if engine not in test.ENGINES:
+            raise argparse.ArgumentTypeError("unknown engine {0}, expected one of {1}".format(
+                engine, ', '.join(test.ENGINES)))
+    return engines
+
+
+def get_peak_rss():
+    """Peak resident set size of this process, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def count_records(file_name):
+    reader = anon.PcapReader(file_name)
+    try:
+        return sum(1 for record in reader.records())
+    finally:
+        reader.close()
+
+
+def best_of(repeat, func):
+    """Runs func repeat times and returns the shortest time and its last result"""
+    best = None
+    result = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_create_packet(params, work_dir, repeat):
+    test.initialize_hosts(*params['hosts'])
+
+    def run():
+        for i in range(PACKET_CALLS):
+            test.create_packet(START_TIME, i % 1000000)
+    seconds, _ = best_of(repeat, run)
+    return PACKET_CALLS, PACKET_CALLS * 78, seconds
+
+
+def get_packet_pool(engine):
+    """The seed capture the amplify engine re-emits, None for other engines"""
+    if engine == 'amplify':
+        return amplify.PacketPool.load(SEED_CAPTURE)
+    return None
+
+
+def bench_create_pcap_file(params, work_dir, repeat):
+    test.initialize_hosts(*params['hosts'])
+    file_name = os.path.join(work_dir, 'generated.pcap')
+    packet_pool = get_packet_pool(params['engine'])
+
+    def run():
+        test.create_pcap_file(START_TIME, duration=90, max_size=params['size'],
+                              file_name=file_name, engine=params['engine'],
+                              packet_pool=packet_pool)
+    seconds, _ = best_of(repeat, run)
+    return count_records(file_name), os.path.getsize(file_name), seconds
+
+
+def prepare_clone_pcap_file(params, work_dir):
+    """Generates the capture bench_clone_pcap_file anonymizes"""
+    test.initialize_hosts(*params['hosts'])
+    test.create_pcap_file(START_TIME, duration=90, max_size=params['size'],
+                          file_name=os.path.join(work_dir, 'input.pcap'),
+                          engine=params['engine'],
+                          packet_pool=get_packet_pool(params['engine']))
+
+
+def bench_clone_pcap_file(params, work_dir, repeat):
+    input_file = os.path.join(work_dir, 'input.pcap')
+    output_file = os.path.join(work_dir, 'anonymized.pcap')
+
+    def run():
+        anon.clone_pcap_file(input_file, output_file, key=b'benchmark')
+    seconds, _ = best_of(repeat, run)
+    return count_records(input_file), os.path.getsize(input_file), seconds
+
+
+def bench_get_duration_scalar(params, work_dir, repeat):
+    hours = (np.arange(DURATION_CALLS) % 2400 / 100.0).tolist()
+
+    def run():
+        for hour in hours:
+            trafficmodel.get_duration_scalar(hour, weekend=False)
+    seconds, _ = best_of(repeat, run)
+    return DURATION_CALLS, None, seconds
+
+
+BENCHMARKS = {
+    'create_packet': bench_create_packet,
+    'create_pcap_file': bench_create_pcap_file,
+    'clone_pcap_file': bench_clone_pcap_file,
+    'get_duration_scalar': bench_get_duration_scalar,
+}
+
+# run in the parent before the case's own process is started, so the memory
+# and time they take aren't charged to the case
+PREPARE = {
+    'clone_pcap_file': prepare_clone_pcap_file,
+}
+
+
+def plan_cases(benchmarks, hosts, sizes, engines):
+    """Expands the matrix into a list of (benchmark, params) cases"""
+    cases = []
+    for name in benchmarks:
+        if name == 'get_duration_scalar':
+            cases.append((name, {}))
+        elif name == 'create_packet':
+            cases.extend((name, {'hosts': pair}) for pair in hosts)
+        else:
+            cases.extend((name, {'hosts': pair, 'size': size, 'engine': engine})
+                         for pair in hosts for size in sizes for engine in engines)
+    return cases
+
+
+def run_case(task):
+    """Runs one case, in its own process, and returns its result entry"""
+    name, params, work_dir, repeat = task
+    logging.disable(logging.INFO)
+    packets, size, seconds = BENCHMARKS[name](params, work_dir, repeat)
+
+    return {
+        'benchmark': name,
+        'params': params,
+        'packets': packets,
+        'bytes': size,
+        'seconds': seconds,
+        'packets_per_second': packets / seconds if seconds > 0 else None,
+        'bytes_per_second': size / seconds if size is not None and seconds > 0 else None,
+        'peak_rss_bytes': get_peak_rss(),
+    }
+
+
+def case_key(result):
+    return result['benchmark'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare_results(results, baseline):
+    """Logs how the packet rate of every case changed relative to baseline"""
+    previous = dict((case_key(result), result) for result in baseline['results'])
+    for result in results:
+        before = previous.get(case_key(result))
+        if before is None or not before['packets_per_second']:
+            continue
+        change = result['packets_per_second'] / before['packets_per_second'] - 1
+        logging.info("{0} {1}: {2:+.1%} packets/s".format(
+            result['benchmark'], json.dumps(result['params'], sort_keys=True), change))
+
+
+def run_benchmarks(cases, repeat=1):
+    """Runs every case in a fresh process and returns the list of results"""
+    results = []
+    # spawn rather than fork so a case doesn't inherit the parent's memory
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(processes=1, maxtasksperchild=1)
+    try:
+        for name, params in cases:
+            work_dir = tempfile.mkdtemp(prefix='pcapbench')
+            try:
+                if name in PREPARE:
+                    PREPARE[name](params, work_dir)
+                result = pool.apply(run_case, ((name, params, work_dir, repeat),))
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            logging.info("{0} {1}: {2:.0f} packets/s, {3} bytes/s, peak RSS {4:.1f} MB".format(
+                result['benchmark'], json.dumps(result['params'], sort_keys=True),
+                result['packets_per_second'],
+                '{0:.0f}'.format(result['bytes_per_second'])
+                if result['bytes_per_second'] is not None else '-',
+                result['peak_rss_bytes'] / 1e6))
+            results.append(result)
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python benchmark.py',
+                                     description = 'Benchmark the generator and anonymizer')
+
+    parser.add_argument("--benchmarks",
+        help="Comma separated benchmarks to run, out of {0}. "
+             "(default: all)".format(', '.join(sorted(BENCHMARKS))),
+        default=','.join(sorted(BENCHMARKS)))
+
+    parser.add_argument("--hosts",
+        help="Comma separated internal:external host counts. (default: %(default)s)",
+        default=DEFAULT_HOSTS)
+
+    parser.add_argument("--sizes",
+        help="Comma separated file sizes in bytes. (default: %(default)s)",
+        default=DEFAULT_SIZES)
+
+    parser.add_argument("--engines",
+        help="Comma separated generator engines, out of {0}. "
+             "(default: %(default)s)".format(', '.join(test.ENGINES)),
+        type=parse_engines,
+        default=DEFAULT_ENGINES)
+
+    parser.add_argument("--repeat",
+        help="Number of times each case is timed, the best time is kept. "
+             "(default: %(default)s)",
+        type=int,
+        default=1)
+
+    parser.add_argument("--output",
+        help="Where to write the JSON results. (default: %(default)s)",
+        default='benchmark.json')
+
+    parser.add_argument("--compare",
+        help="Previous JSON results to compare this run against")
+
+    args = parser.parse_args()
+    logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+
+    benchmarks = args.benchmarks.split(',')
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {0}".format(name))
+    cases = plan_cases(benchmarks, parse_hosts(args.hosts),
+                       [int(size) for size in args.sizes.split(',')],
+                       args.engines)
+
+    results = run_benchmarks(cases, repeat=args.repeat)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info("Wrote {0} results to {1}".format(len(results), args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/bin/env python
+
+import gzip
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+'''
+Compressed capture files.
+
+Output is cut into frames of FRAME_SIZE bytes which are compressed
+independently on a thread pool (the codecs release the GIL while they work)
+and written out in order. Each frame is a complete gzip member, zstd frame or
+lz4 frame, and all three formats allow concatenated frames, so the result is
+an ordinary .gz, .zst or .lz4 file that the usual tools can read.
+
+gzip is always available. zstd and lz4 need the zstandard and lz4 packages.
+'''
+
+# uncompressed bytes per independently compressed frame
+FRAME_SIZE = 4 * 1024 * 1024
+# compressed frames in flight per thread before writes wait for them
+FRAMES_PER_THREAD = 2
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+MAGIC = {
+    'gzip': b'\x1f\x8b',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'lz4': b'\x04\x22\x4d\x18',
+}
+
+
+def compress_gzip(data):
+    return gzip.compress(data, compresslevel=6)
+
+
+def compress_zstd(data):
+    # compressor objects are not thread safe, so each frame gets its own
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def compress_lz4(data):
+    return lz4.frame.compress(data)
+
+
+def open_gzip(f):
+    return gzip.GzipFile(fileobj=f, mode='rb')
+
+
+def open_zstd(f):
+    return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+
+
+def open_lz4(f):
+    return lz4.frame.LZ4FrameFile(f, mode='rb')
+
+
+def get_codecs():
+    """Names of the codecs that can be used here"""
+    codecs = ['gzip']
+    if zstandard is not None:
+        codecs.append('zstd')
+    if lz4 is not None:
+        codecs.append('lz4')
+    return codecs
+
+
+def get_compressor(codec):
+    if codec not in get_codecs():
+        raise ValueError("{0} compression is not available, expected one of {1}".format(
+            codec, ', '.join(get_codecs())))
+    return {'gzip': compress_gzip, 'zstd': compress_zstd, 'lz4': compress_lz4}[codec]
+
+
+def detect_codec(file_name):
+    """Codec a file was compressed with, going by its magic number, or None"""
+    with open(file_name, 'rb') as f:
+        magic = f.read(4)
+    for codec, codec_magic in MAGIC.items():
+        if magic.startswith(codec_magic):
+            return codec
+    return None
+
+
+class CompressedWriter(object):
+    """
+    File-like object compressing everything written to it into raw, a file
+    opened for binary writing, using a pool of threads
+    """
+
+    def __init__(self, raw, codec='gzip', threads=None, frame_size=FRAME_SIZE):
+        self._raw = raw
+        self._compress = get_compressor(codec)
+        self.threads = threads or os.cpu_count() or 1
+        self.frame_size = frame_size
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.frame_size:
+            view = memoryview(self._buffer)
+            frames = len(self._buffer) // self.frame_size
+            for i in range(frames):
+                self._submit(bytes(view[i * self.frame_size:(i + 1) * self.frame_size]))
+            view.release()
+            del self._buffer[:frames * self.frame_size]
+        return len(data)
+
+    def _submit(self, frame):
+        self._pending.append(self._executor.submit(self._compress, frame))
+        while len(self._pending) > self.threads * FRAMES_PER_THREAD:
+            self._raw.write(self._pending.popleft().result())
+
+    def flush(self):
+        """Compresses whatever is buffered (as a short frame) and writes it all out"""
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._raw.write(self._pending.popleft().result())
+        self._raw.flush()
+
+    def close(self):
+        if self._raw is not None:
+            try:
+                self.flush()
+            finally:
+                self._executor.shutdown()
+                self._raw.close()
+                self._raw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_compressed(file_name, codec=None, threads=None, buffering=-1):
+    """
+    Opens file_name for writing, compressed with codec (a CompressedWriter),
+    or as a plain file with the given buffering when codec is None
+    """
+    if codec is None:
+        return open(file_name, 'wb', buffering)
+    return CompressedWriter(open(file_name, 'wb'), codec=codec, threads=threads)
+
+
+def copy_decompressed(file_name, out, codec):
+    """Writes the decompressed contents of file_name to out, a binary file"""
+    if codec not in get_codecs():
+        raise ValueError("{0} is {1} compressed, which needs a package that is "
+                         "not installed".format(file_name, codec))
+    opener = {'gzip': open_gzip, 'zstd': open_zstd, 'lz4': open_lz4}[codec]
+    with open(file_name, 'rb') as f:
+        reader = opener(f)
+        shutil.copyfileobj(reader, out, FRAME_SIZE)
+        reader.close()
+
+
+def open_decompressed(file_name):
+    """
+    Returns a file opened for binary reading holding the decompressed contents
+    of file_name. Uncompressed files are simply opened, compressed ones are
+    decompressed into an anonymous temporary file, so the result can always
+    be memory mapped.
+    """
+    codec = detect_codec(file_name)
+    if codec is None:
+        return open(file_name, 'rb')
+
+    temp = tempfile.TemporaryFile()
+    copy_decompressed(file_name, temp, codec)
+    temp.seek(0)
+    return temp
+
+
+def decompress_file(file_name, output_file):
+    """Writes the decompressed contents of file_name to output_file"""
+    with open(output_file, 'wb') as out:
+        copy_decompressed(file_name, out, detect_codec(file_name))
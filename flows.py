@@ -0,0 +1,304 @@
+#!/bin/env python
+
+import numpy as np
+
+from packetbatch import PacketBatch, fold_checksums, sum_words, ipv4_checksums, pseudo_header_sums
+from randomness import random_integers
+
+'''
+Stateful TCP flow engine. Rather than a stream of identical SYNs, it keeps a
+table of concurrent connections between the generator's hosts and steps each
+of them through a handshake, a number of data segments (each one ACKed by the
+other side) and a FIN or RST teardown, with consistent sequence and
+acknowledgement numbers and valid IPv4 and TCP checksums.
+
+All per-connection state lives in flat numpy arrays, and every step advances
+many connections at once, so packets are built and checksummed in bulk.
+'''
+
+# number of connections kept open at any one time
+CONCURRENT_FLOWS = 1024
+# mean number of data segments sent over a connection
+MEAN_SEGMENTS = 8
+# share of data segments sent by the client (the rest are responses)
+CLIENT_DATA_SHARE = 0.3
+# share of connections opened by an external host towards an internal one
+INBOUND_SHARE = 0.2
+# share of connections torn down with a RST rather than a FIN exchange
+RESET_SHARE = 0.1
+MSS = 1460
+SERVER_PORTS = np.array([80, 443, 8080, 22, 25], dtype=np.uint16)
+SERVER_PORT_WEIGHTS = np.array([0.35, 0.5, 0.05, 0.05, 0.05])
+# size of the random data payloads are cut from
+PAYLOAD_POOL_SIZE = 1 << 20
+
+# flow states, named after the packet the flow sends next
+SYN, SYN_ACK, HANDSHAKE_ACK, DATA, DATA_ACK, FIN, FIN_ACK, LAST_ACK, RST, CLOSED = range(10)
+
+# tcp flags
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+# pcap packet header, ethernet frame, ipv4 header and option-less tcp header
+# of one packet, 70 bytes in all. Payloads follow in their own array.
+FLOW_HEADER_DTYPE = np.dtype([
+    ('ts_sec', '=u4'),
+    ('ts_usec', '=u4'),
+    ('included_length', '=u4'),
+    ('original_length', '=u4'),
+    ('destination_mac', 'u1', (6,)),
+    ('source_mac', 'u1', (6,)),
+    ('ether_type', '>u2'),
+    ('version_ihl', 'u1'),
+    ('dscp_ecn', 'u1'),
+    ('total_length', '>u2'),
+    ('identification', '>u2'),
+    ('flags_fragment', '>u2'),
+    ('time_to_live', 'u1'),
+    ('protocol', 'u1'),
+    ('header_checksum', '>u2'),
+    ('source_ip', '>u4'),
+    ('destination_ip', '>u4'),
+    ('source_port', '>u2'),
+    ('destination_port', '>u2'),
+    ('sequence', '>u4'),
+    ('acknowledgement', '>u4'),
+    ('data_offset', 'u1'),
+    ('tcp_flags', 'u1'),
+    ('window', '>u2'),
+    ('tcp_checksum', '>u2'),
+    ('urgent_pointer', '>u2'),
+])
+IP_OFFSET = 30
+TCP_OFFSET = 50
+HEADER_SIZE = FLOW_HEADER_DTYPE.itemsize
+
+
+def get_mean_record_size():
+    """
+    Expected size of a record (pcap header included), used to work out how
+    many packets fit in a file
+    """
+    client_payload = 325.0
+    server_payload = 0.7 * MSS + 0.3 * MSS / 2
+    mean_payload = (CLIENT_DATA_SHARE * client_payload +
+                    (1 - CLIENT_DATA_SHARE) * server_payload)
+    # handshake, one ack per data segment and the teardown
+    packets = 3 + 2 * MEAN_SEGMENTS + 3 * (1 - RESET_SHARE) + RESET_SHARE
+    return HEADER_SIZE + MEAN_SEGMENTS * mean_payload / packets
+
+
+class FlowTable(object):
+    """
+    Table of concurrent TCP connections. Each one is between an internal and
+    an external host (see test.HostTable) and advances one packet every time
+    it is stepped. Closed connections are immediately replaced by new ones.
+    Hosts are picked from host_pairs (see hostmodel.HostPairs), or uniformly
+    when that is None.
+    """
+    __slots__ = ('internal_hosts', 'external_hosts', 'host_pairs', 'rng', 'payload_pool',
+                 'inbound', 'client', 'server', 'client_port', 'server_port',
+                 'client_seq', 'server_seq', 'state', 'segments', 'sender')
+
+    def __init__(self, internal_hosts, external_hosts, count=CONCURRENT_FLOWS,
+                 rng=np.random, host_pairs=None):
+        self.internal_hosts = internal_hosts
+        self.external_hosts = external_hosts
+        self.host_pairs = host_pairs
+        self.rng = rng
+        self.payload_pool = np.frombuffer(rng.bytes(PAYLOAD_POOL_SIZE + MSS), dtype=np.uint8)
+
+        self.inbound = np.zeros(count, dtype=bool)
+        self.client = np.zeros(count, dtype=np.int64)
+        self.server = np.zeros(count, dtype=np.int64)
+        self.client_port = np.zeros(count, dtype=np.uint16)
+        self.server_port = np.zeros(count, dtype=np.uint16)
+        self.client_seq = np.zeros(count, dtype=np.uint32)
+        self.server_seq = np.zeros(count, dtype=np.uint32)
+        self.state = np.zeros(count, dtype=np.uint8)
+        self.segments = np.zeros(count, dtype=np.int64)
+        self.sender = np.zeros(count, dtype=bool)    # true when the client sent the last data
+        self.open(np.arange(count))
+
+    def __len__(self):
+        return len(self.state)
+
+    def mean_record_size(self):
+        return get_mean_record_size()
+
+    def open(self, ndx):
+        """Replaces the connections at ndx with new ones about to send a SYN"""
+        count = len(ndx)
+        rng = self.rng
+        inbound = rng.random(count) < INBOUND_SHARE
+        self.inbound[ndx] = inbound
+        if self.host_pairs is None:
+            self.client[ndx] = np.where(inbound,
+                                        random_integers(rng, 0, len(self.external_hosts), count),
+                                        random_integers(rng, 0, len(self.internal_hosts), count))
+            self.server[ndx] = np.where(inbound,
+                                        random_integers(rng, 0, len(self.internal_hosts), count),
+                                        random_integers(rng, 0, len(self.external_hosts), count))
+        else:
+            internal_ndx, external_ndx = self.host_pairs.sample(count, rng)
+            self.client[ndx] = np.where(inbound, external_ndx, internal_ndx)
+            self.server[ndx] = np.where(inbound, internal_ndx, external_ndx)
+        self.client_port[ndx] = random_integers(rng, 32768, 61000, count)
+        ports = np.searchsorted(np.cumsum(SERVER_PORT_WEIGHTS), rng.random(count) * SERVER_PORT_WEIGHTS.sum())
+        self.server_port[ndx] = SERVER_PORTS[np.minimum(ports, len(SERVER_PORTS) - 1)]
+        self.client_seq[ndx] = random_integers(rng, 0, 1 << 32, count)
+        self.server_seq[ndx] = random_integers(rng, 0, 1 << 32, count)
+        self.state[ndx] = SYN
+        self.segments[ndx] = rng.geometric(1.0 / MEAN_SEGMENTS, count)
+
+    def step(self, ndx):
+        """
+        Advances the connections at ndx by one packet each and returns the
+        (from_client, tcp_flags, sequence, acknowledgement, payload_length)
+        columns of the packets they send
+        """
+        count = len(ndx)
+        rng = self.rng
+        state = self.state[ndx]
+        client_seq = self.client_seq[ndx].astype(np.int64)
+        server_seq = self.server_seq[ndx].astype(np.int64)
+        sender = self.sender[ndx]
+
+        # pick who sends data and how much for the flows that are doing so
+        data = state == DATA
+        data_from_client = rng.random(count) < CLIENT_DATA_SHARE
+        full = rng.random(count) < 0.7
+        lengths = np.where(data_from_client,
+                           random_integers(rng, 50, 600, count),
+                           np.where(full, MSS, random_integers(rng, 1, MSS, count)))
+        lengths = np.where(data, lengths, 0)
+        sender = np.where(data, data_from_client, sender)
+        reset_from_client = rng.random(count) < 0.5
+
+        from_client = np.select(
+            [state == SYN_ACK, data, state == DATA_ACK, state == FIN_ACK, state == RST],
+            [False, sender, ~sender, False, reset_from_client],
+            default=True)
+        flags = np.select(
+            [state == SYN, state == SYN_ACK, data, (state == FIN) | (state == FIN_ACK), state == RST],
+            [TCP_SYN, TCP_SYN | TCP_ACK, TCP_PSH | TCP_ACK, TCP_FIN | TCP_ACK, TCP_RST | TCP_ACK],
+            default=TCP_ACK).astype(np.uint8)
+        sequence = np.where(from_client, client_seq, server_seq)
+        acknowledgement = np.where(state == SYN, 0, np.where(from_client, server_seq, client_seq))
+
+        # SYNs and FINs take up one sequence number, data its length
+        advance = lengths + ((state == SYN) | (state == SYN_ACK) |
+                             (state == FIN) | (state == FIN_ACK))
+        client_seq = client_seq + np.where(from_client, advance, 0)
+        server_seq = server_seq + np.where(from_client, 0, advance)
+        self.client_seq[ndx] = client_seq & 0xffffffff
+        self.server_seq[ndx] = server_seq & 0xffffffff
+        self.sender[ndx] = sender
+
+        # work out what each flow sends next
+        segments = self.segments[ndx] - (state == DATA_ACK)
+        self.segments[ndx] = segments
+        teardown = np.where(rng.random(count) < RESET_SHARE, RST, FIN)
+        self.state[ndx] = np.select(
+            [state == SYN, state == SYN_ACK, state == HANDSHAKE_ACK, data,
+             state == DATA_ACK, state == FIN, state == FIN_ACK],
+            [SYN_ACK, HANDSHAKE_ACK, DATA, DATA_ACK,
+             np.where(segments > 0, DATA, teardown), FIN_ACK, LAST_ACK],
+            default=CLOSED)
+
+        return from_client, flags, sequence, acknowledgement, lengths
+
+    def build(self, ndx, from_client, flags, sequence, acknowledgement,
+              lengths, ts_sec, ts_usec):
+        """Builds the packets sent by the connections at ndx as a PacketBatch"""
+        count = len(ndx)
+        inbound = self.inbound[ndx]
+        internal = self.internal_hosts
+        external = self.external_hosts
+        client = self.client[ndx]
+        server = self.server[ndx]
+
+        # the internal end of each flow is the server when it's inbound
+        internal_ndx = np.where(inbound, server, client)
+        external_ndx = np.where(inbound, client, server)
+        internal_sends = from_client != inbound
+
+        headers = np.zeros(count, dtype=FLOW_HEADER_DTYPE)
+        headers['ts_sec'] = ts_sec
+        headers['ts_usec'] = ts_usec
+        headers['included_length'] = HEADER_SIZE - 16 + lengths
+        headers['original_length'] = HEADER_SIZE - 16 + lengths
+
+        internal_mac = internal.macs[internal_ndx]
+        external_mac = external.macs[external_ndx]
+        outbound = internal_sends[:, np.newaxis]
+        headers['source_mac'] = np.where(outbound, internal_mac, external_mac)
+        headers['destination_mac'] = np.where(outbound, external_mac, internal_mac)
+        headers['ether_type'] = 0x0800
+
+        internal_ip = internal.ips[internal_ndx]
+        external_ip = external.ips[external_ndx]
+        source_ip = np.where(internal_sends, internal_ip, external_ip)
+        destination_ip = np.where(internal_sends, external_ip, internal_ip)
+        headers['version_ihl'] = 0x45
+        headers['total_length'] = 40 + lengths
+        headers['identification'] = random_integers(self.rng, 0, 1 << 16, count)
+        headers['flags_fragment'] = 0x4000      # don't fragment
+        headers['time_to_live'] = np.where(internal_sends, 128, 64)
+        headers['protocol'] = 6
+        headers['source_ip'] = source_ip
+        headers['destination_ip'] = destination_ip
+
+        client_port = self.client_port[ndx]
+        server_port = self.server_port[ndx]
+        headers['source_port'] = np.where(from_client, client_port, server_port)
+        headers['destination_port'] = np.where(from_client, server_port, client_port)
+        headers['sequence'] = sequence
+        headers['acknowledgement'] = acknowledgement
+        headers['data_offset'] = 5 << 4
+        headers['tcp_flags'] = flags
+        headers['window'] = np.where(from_client, 65535, 29200)
+
+        # cut each payload from a random spot in the pool, zero padded
+        width = int(lengths.max()) if count else 0
+        columns = np.arange(width)
+        starts = random_integers(self.rng, 0, PAYLOAD_POOL_SIZE, count)
+        payloads = self.payload_pool[starts[:, np.newaxis] + columns]
+        payloads[columns >= lengths[:, np.newaxis]] = 0
+
+        # checksums, computed with the checksum fields still zeroed
+        rows = headers.view(np.uint8).reshape(count, HEADER_SIZE)
+        headers['header_checksum'] = ipv4_checksums(rows[:, IP_OFFSET:TCP_OFFSET])
+        totals = (sum_words(rows[:, TCP_OFFSET:]) + sum_words(payloads) +
+                  pseudo_header_sums(source_ip, destination_ip, 6, 20 + lengths))
+        headers['tcp_checksum'] = fold_checksums(totals)
+
+        return PacketBatch.from_rows(np.concatenate([rows, payloads], axis=1),
+                                     HEADER_SIZE + lengths, ts_sec, ts_usec)
+
+    def create_batch(self, ts_sec, ts_usec):
+        """
+        Builds one packet per timestamp. Flows are stepped in rounds of
+        distinct connections, so the packets of any one connection stay in
+        order.
+        """
+        batches = []
+        first = 0
+        while first < len(ts_sec):
+            count = min(len(self), len(ts_sec) - first)
+            ndx = np.sort(self.rng.permutation(len(self))[:count])
+            columns = self.step(ndx)
+            batches.append(self.build(ndx, *columns,
+                                      ts_sec=ts_sec[first:first+count],
+                                      ts_usec=ts_usec[first:first+count]))
+            first += count
+
+            # connections replaced only once their last packet is built, so
+            # it still goes out between the right hosts and ports
+            closed = ndx[self.state[ndx] == CLOSED]
+            if len(closed):
+                self.open(closed)
+        return PacketBatch.concatenate(batches)
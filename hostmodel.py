@@ -0,0 +1,141 @@
+#!/bin/env python
+
+import random
+
+import numpy as np
+
+from randomness import random_integers
+
+'''
+Host popularity and conversation locality.
+
+Real traffic is nothing like every internal/external pair being equally
+likely: a few hosts account for most packets and the same pairs keep talking
+to each other. HostPairs models both. Hosts are picked with Zipf-like
+popularity (the host of rank k gets weight 1 / k**exponent) and a share of
+packets belongs to a fixed set of sticky conversations, themselves Zipf
+popular, so the same pairs come back over and over.
+
+Every draw goes through a Walker alias table, which takes one uniform number
+and one table lookup per draw whatever the number of hosts, so sampling
+stays O(1) per packet and vectorizes over whole batches.
+'''
+
+# sticky conversations kept by default
+CONVERSATIONS = 1024
+
+
+def zipf_weights(count, exponent=1.0):
+    """Weight of each of count ranks, 1 / rank**exponent"""
+    return 1.0 / np.arange(1, count + 1, dtype=np.float64) ** exponent
+
+
+class AliasTable(object):
+    """
+    Walker alias table for drawing indices in proportion to a set of weights
+    (built with Vose's method)
+    """
+    __slots__ = ('probability', 'alias', '_probability', '_alias')
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        count = len(weights)
+        scaled = weights * (count / weights.sum())
+        probability = np.ones(count, dtype=np.float64)
+        alias = np.arange(count, dtype=np.int64)
+
+        small = np.flatnonzero(scaled < 1.0).tolist()
+        large = np.flatnonzero(scaled >= 1.0).tolist()
+        scaled = scaled.tolist()
+        while small and large:
+            less = small.pop()
+            more = large[-1]
+            probability[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(large.pop())
+        # whatever is left over is 1 up to rounding errors
+
+        self.probability = probability
+        self.alias = alias
+        # plain lists are much faster to index one value at a time
+        self._probability = probability.tolist()
+        self._alias = alias.tolist()
+
+    def __len__(self):
+        return len(self.alias)
+
+    def sample(self, count, rng=np.random):
+        """count indices drawn from the table"""
+        # the whole part of one uniform picks the column, the fraction
+        # decides between the column and its alias
+        draws = rng.random(count) * len(self.alias)
+        ndx = np.minimum(draws.astype(np.int64), len(self.alias) - 1)
+        return np.where(draws - ndx < self.probability[ndx], ndx, self.alias[ndx])
+
+    def pick(self, uniform=random.random):
+        """One index drawn from the table, for the per-packet engine"""
+        draw = uniform() * len(self._alias)
+        ndx = int(draw)
+        if draw - ndx < self._probability[ndx]:
+            return ndx
+        return self._alias[ndx]
+
+
+class HostPairs(object):
+    """
+    Draws (internal, external) host index pairs. exponent sets how skewed
+    host (and conversation) popularity is, 0 being uniform, and sticky_share
+    is the share of draws taken from the sticky conversations.
+    """
+
+    def __init__(self, internal_count, external_count, exponent=1.0,
+                 sticky_share=0.0, conversations=CONVERSATIONS, rng=np.random):
+        if conversations < 1:
+            raise ValueError("there must be at least one conversation, got {0}".format(
+                conversations))
+        self.exponent = exponent
+        self.sticky_share = sticky_share
+        self.internal = AliasTable(zipf_weights(internal_count, exponent))
+        self.external = AliasTable(zipf_weights(external_count, exponent))
+
+        # the conversations are between popular hosts as often as any other
+        # traffic, and the first conversations are the busiest
+        self.conversations = AliasTable(zipf_weights(conversations, exponent))
+        self.conversation_internal = self.internal.sample(conversations, rng)
+        self.conversation_external = self.external.sample(conversations, rng)
+        self._conversation_internal = self.conversation_internal.tolist()
+        self._conversation_external = self.conversation_external.tolist()
+
+    def sample(self, count, rng=np.random):
+        """Arrays of internal and external host indices for count packets"""
+        internal_ndx = self.internal.sample(count, rng)
+        external_ndx = self.external.sample(count, rng)
+        if self.sticky_share > 0:
+            sticky = rng.random(count) < self.sticky_share
+            conversation = self.conversations.sample(count, rng)
+            internal_ndx = np.where(sticky, self.conversation_internal[conversation],
+                                    internal_ndx)
+            external_ndx = np.where(sticky, self.conversation_external[conversation],
+                                    external_ndx)
+        return internal_ndx, external_ndx
+
+    def pick(self, uniform=random.random):
+        """One (internal, external) pair, for the per-packet engine"""
+        if self.sticky_share > 0 and uniform() < self.sticky_share:
+            conversation = self.conversations.pick(uniform)
+            return (self._conversation_internal[conversation],
+                    self._conversation_external[conversation])
+        return self.internal.pick(uniform), self.external.pick(uniform)
+
+
+def sample_pairs(host_pairs, internal_count, external_count, count, rng=np.random):
+    """
+    Internal and external host indices for count packets, drawn from
+    host_pairs, or uniformly at random when that is None
+    """
+    if host_pairs is None:
+        return (random_integers(rng, 0, internal_count, count),
+                random_integers(rng, 0, external_count, count))
+    return host_pairs.sample(count, rng)
@@ -0,0 +1,132 @@
+#!/bin/env python
+
+import base64
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+'''
+Checkpoint manifest of a multi-file generator run.
+
+The manifest is a JSON file holding everything a run needs to pick up where
+it left off: the seed, the settings that shape the output, the host tables,
+the planned schedule, and for every finished file the size and SHA-256 of
+each file written for it (the capture and its index). It is rewritten
+atomically after every finished file, so it never describes a file that
+isn't completely on disk.
+
+Since file N only depends on the seed, the host tables and N, a rerun can
+skip every file whose outputs still match the manifest and regenerate just
+the missing, truncated or modified ones, getting the same bytes it would
+have the first time.
+'''
+
+VERSION = 1
+# bytes read at a time when checksumming files
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def file_digest(file_name):
+    """(size, hex SHA-256) of a file"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def encode_array(array):
+    return base64.b64encode(np.ascontiguousarray(array).tobytes()).decode('ascii')
+
+
+def decode_array(text, dtype, shape=None):
+    array = np.frombuffer(base64.b64decode(text), dtype=dtype).copy()
+    if shape is not None:
+        array = array.reshape(shape)
+    return array
+
+
+class Manifest(object):
+    """
+    seed:     seed of the run
+    settings: dict of the options that shape the output
+    schedule: list of (start_time, duration, file_name), one per file
+    hosts:    dict of the host table arrays ('internal_macs', 'internal_ips',
+              'external_macs', 'external_ips')
+    files:    dict of file number -> list of [name, size, sha256] outputs
+    """
+
+    def __init__(self, file_name, seed=None, settings=None, schedule=None,
+                 hosts=None, files=None):
+        self.file_name = file_name
+        self.seed = seed
+        self.settings = settings or {}
+        self.schedule = schedule or []
+        self.hosts = hosts
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as f:
+            document = json.load(f)
+        if document.get('version') != VERSION:
+            raise ValueError("{0} is a version {1} manifest, expected version {2}".format(
+                file_name, document.get('version'), VERSION))
+
+        hosts = {}
+        for side in ('internal', 'external'):
+            table = document['hosts'][side]
+            hosts[side + '_ips'] = decode_array(table['ips'], '>u4').astype(np.uint32)
+            hosts[side + '_macs'] = decode_array(table['macs'], np.uint8, (-1, 6))
+        return cls(file_name,
+                   seed=document['seed'],
+                   settings=document['settings'],
+                   schedule=[tuple(entry) for entry in document['schedule']],
+                   hosts=hosts,
+                   files={int(number): outputs
+                          for number, outputs in document['files'].items()})
+
+    def save(self):
+        document = {
+            'version': VERSION,
+            'seed': self.seed,
+            'settings': self.settings,
+            'schedule': [list(entry) for entry in self.schedule],
+            'hosts': {
+                side: {'ips': encode_array(self.hosts[side + '_ips'].astype('>u4')),
+                       'macs': encode_array(self.hosts[side + '_macs'])}
+                for side in ('internal', 'external')},
+            'files': {str(number): outputs
+                      for number, outputs in sorted(self.files.items())},
+        }
+        temp_file = self.file_name + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(document, f, indent=1)
+        os.replace(temp_file, self.file_name)
+
+    def add_file(self, file_number, outputs):
+        """Records the (name, size, sha256) outputs of a finished file and saves"""
+        self.files[file_number] = [list(output) for output in outputs]
+        self.save()
+
+    def is_complete(self, file_number):
+        """True when every output recorded for the file is on disk unchanged"""
+        outputs = self.files.get(file_number)
+        if not outputs:
+            return False
+        for name, size, digest in outputs:
+            if not os.path.exists(name) or os.path.getsize(name) != size:
+                logging.info("{0} is missing or truncated".format(name))
+                return False
+            if file_digest(name)[1] != digest:
+                logging.info("{0} does not match its checksum".format(name))
+                return False
+        return True
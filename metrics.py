@@ -0,0 +1,144 @@
+#!/bin/env python
+
+import logging
+import os
+from collections import OrderedDict
+from time import perf_counter
+
+'''
+Optional instrumentation for the generator and anonymizer loops.
+
+A Stats object counts packets and bytes, accumulates the time spent in each
+stage of a loop and holds a few gauges (e.g. queue depths). Stage timing works
+by laps: every call to lap(stage) charges the time since the previous lap to
+that stage, so instrumenting a loop costs one clock read per stage. Every
+interval seconds the totals are logged as a stats line and/or written to a
+Prometheus text format file, which is replaced atomically so a scraper never
+sees half of it.
+
+Instrumented code takes stats=None and skips all of this when it is None.
+'''
+
+METRIC_PREFIX = 'syntheticpcap_'
+DEFAULT_INTERVAL = 10.0
+
+
+def create_stats(name, interval=DEFAULT_INTERVAL, log=False, prometheus_file=None,
+                 per_process=False):
+    """
+    Returns a Stats reporting as name, or None when neither the stats line
+    nor the Prometheus file was asked for. With per_process the process id is
+    added to the file name, so that every worker of a pool gets its own file.
+    """
+    if not log and prometheus_file is None:
+        return None
+    if prometheus_file is not None and per_process:
+        root, ext = os.path.splitext(prometheus_file)
+        prometheus_file = '{0}.{1}{2}'.format(root, os.getpid(), ext)
+    return Stats(name, interval=interval, log=log, prometheus_file=prometheus_file)
+
+
+class Stats(object):
+
+    def __init__(self, name, interval=DEFAULT_INTERVAL, log=True, prometheus_file=None):
+        self.name = name
+        self.interval = interval
+        self.log = log
+        self.prometheus_file = prometheus_file
+        self.packets = 0
+        self.bytes = 0
+        self.stages = OrderedDict()
+        self.gauges = OrderedDict()
+
+        self._started = perf_counter()
+        self._last = self._started
+        self._next_report = self._started + interval
+        self._reported_at = self._started
+        self._reported_packets = 0
+        self._reported_bytes = 0
+
+    def start_lap(self):
+        """Starts timing from now, e.g. after a pause between loops"""
+        self._last = perf_counter()
+
+    def lap(self, stage):
+        """Charges the time since the previous lap to stage"""
+        now = perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def count(self, packets, nbytes):
+        self.packets += packets
+        self.bytes += nbytes
+        # reuses the clock read of the last lap
+        if self._last >= self._next_report:
+            self.report()
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def tick(self):
+        """Reports if the interval has passed, for loops which don't lap"""
+        if perf_counter() >= self._next_report:
+            self.report()
+
+    def report(self):
+        now = perf_counter()
+        elapsed = now - self._reported_at
+        packet_rate = (self.packets - self._reported_packets) / elapsed if elapsed > 0 else 0.0
+        byte_rate = (self.bytes - self._reported_bytes) / elapsed if elapsed > 0 else 0.0
+        self._reported_at = now
+        self._reported_packets = self.packets
+        self._reported_bytes = self.bytes
+        self._next_report = now + self.interval
+
+        if self.log:
+            logging.info(self.format_line(packet_rate, byte_rate))
+        if self.prometheus_file is not None:
+            self.write_prometheus(packet_rate, byte_rate)
+
+    def close(self):
+        """Final report"""
+        self.report()
+
+    def format_line(self, packet_rate, byte_rate):
+        line = "{0}: {1} packets ({2:.0f}/s), {3:.1f} MB ({4:.1f} MB/s)".format(
+            self.name, self.packets, packet_rate, self.bytes / 1e6, byte_rate / 1e6)
+        total = sum(self.stages.values())
+        if total > 0:
+            line += "; " + ", ".join("{0} {1:.0%}".format(stage, seconds / total)
+                                     for stage, seconds in self.stages.items())
+        if self.gauges:
+            line += "; " + ", ".join("{0}={1}".format(name, value)
+                                     for name, value in self.gauges.items())
+        return line
+
+    def write_prometheus(self, packet_rate, byte_rate):
+        label = 'process="{0}"'.format(self.name)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP {0}{1} {2}".format(METRIC_PREFIX, name, help_text))
+            lines.append("# TYPE {0}{1} {2}".format(METRIC_PREFIX, name, kind))
+            for labels, value in samples:
+                lines.append("{0}{1}{{{2}}} {3}".format(METRIC_PREFIX, name, labels, value))
+
+        metric('packets_total', 'counter', 'Packets processed',
+               [(label, self.packets)])
+        metric('bytes_total', 'counter', 'Bytes of packet records processed',
+               [(label, self.bytes)])
+        metric('packets_per_second', 'gauge', 'Packet rate over the last interval',
+               [(label, '{0:.1f}'.format(packet_rate))])
+        metric('bytes_per_second', 'gauge', 'Byte rate over the last interval',
+               [(label, '{0:.1f}'.format(byte_rate))])
+        if self.stages:
+            metric('stage_seconds_total', 'counter', 'Time spent in each stage of the loop',
+                   [('{0},stage="{1}"'.format(label, stage), '{0:.6f}'.format(seconds))
+                    for stage, seconds in self.stages.items()])
+        for name, value in self.gauges.items():
+            metric(name, 'gauge', name.replace('_', ' ').capitalize(), [(label, value)])
+
+        temp_file = self.prometheus_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_file, self.prometheus_file)
@@ -0,0 +1,145 @@
+#!/bin/env python
+
+import numpy as np
+
+'''
+Batches of variable-length pcap records, shared by the packet engines, the
+file writer and the live output.
+
+A batch keeps every record (16 byte pcap packet header included) back to back
+in one flat uint8 buffer, along with the offset of each record in that buffer
+and the record timestamps, so a whole batch can be written with one call and
+still be split on record boundaries when needed.
+'''
+
+
+class PacketBatch(object):
+    """
+    data:    flat uint8 array holding the records back to back
+    offsets: int64 array of len(batch) + 1 record start offsets into data, the
+             last one being the total size
+    ts_sec, ts_usec: record timestamps; ts_usec holds the sub-second part in
+             microseconds, or in nanoseconds for nanosecond captures
+    """
+    __slots__ = ('data', 'offsets', 'ts_sec', 'ts_usec')
+
+    def __init__(self, data, offsets, ts_sec, ts_usec):
+        self.data = data
+        self.offsets = offsets
+        self.ts_sec = ts_sec
+        self.ts_usec = ts_usec
+
+    @classmethod
+    def from_records(cls, records):
+        """Wraps an array of fixed-size records (see test.PACKET_DTYPE)"""
+        offsets = np.arange(len(records) + 1, dtype=np.int64) * records.itemsize
+        return cls(records.view(np.uint8), offsets,
+                   records['ts_sec'], records['ts_usec'])
+
+    @classmethod
+    def from_rows(cls, rows, lengths, ts_sec, ts_usec):
+        """
+        Builds a batch from a 2-D array holding one zero-padded record per
+        row, where lengths gives the real size of each record
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        mask = np.arange(rows.shape[1]) < lengths[:, np.newaxis]
+        return cls(rows[mask], offsets, ts_sec, ts_usec)
+
+    @classmethod
+    def concatenate(cls, batches):
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls(np.empty(0, dtype=np.uint8), np.zeros(1, dtype=np.int64),
+                       np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32))
+
+        offsets = [batches[0].offsets]
+        total = batches[0].nbytes
+        for batch in batches[1:]:
+            offsets.append(batch.offsets[1:] + total)
+            total += batch.nbytes
+        return cls(np.concatenate([batch.data for batch in batches]),
+                   np.concatenate(offsets),
+                   np.concatenate([batch.ts_sec for batch in batches]),
+                   np.concatenate([batch.ts_usec for batch in batches]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return int(self.offsets[-1])
+
+    @property
+    def included_lengths(self):
+        return np.diff(self.offsets) - 16
+
+    def times(self, ticks=1000000):
+        """Record timestamps as float seconds, ts_usec counting ticks per second"""
+        return self.ts_sec + self.ts_usec / float(ticks)
+
+    def take(self, order):
+        """New batch holding the records at the given indices, in that order"""
+        order = np.asarray(order, dtype=np.int64)
+        starts = self.offsets[order]
+        lengths = self.offsets[order + 1] - starts
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # source index of every byte of the new buffer
+        ndx = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return PacketBatch(self.data[ndx], offsets, self.ts_sec[order], self.ts_usec[order])
+
+    def slice(self, first, last):
+        """New batch holding records [first, last), sharing this one's buffer"""
+        start = self.offsets[first]
+        return PacketBatch(self.data[start:self.offsets[last]],
+                           self.offsets[first:last + 1] - start,
+                           self.ts_sec[first:last], self.ts_usec[first:last])
+
+    def head(self, count):
+        """New batch holding the first count records, sharing this one's buffer"""
+        return self.slice(0, count)
+
+    def view(self, first=0, last=None):
+        """memoryview of the bytes of records [first, last)"""
+        if last is None:
+            last = len(self)
+        return memoryview(self.data[self.offsets[first]:self.offsets[last]])
+
+
+def fold_checksums(totals):
+    """
+    Folds arrays of 32+ bit ones' complement sums down to 16 bits and returns
+    the complemented checksums
+    """
+    totals = np.asarray(totals, dtype=np.uint64)
+    for i in range(3):
+        totals = (totals & 0xffff) + (totals >> 16)
+    return (~totals & 0xffff).astype(np.uint16)
+
+
+def sum_words(rows):
+    """
+    Sums each row of a 2-D uint8 array as big-endian 16-bit words (rows of
+    odd width are padded with a zero byte)
+    """
+    if rows.shape[1] % 2:
+        rows = np.concatenate([rows, np.zeros((rows.shape[0], 1), dtype=np.uint8)], axis=1)
+    words = rows.astype(np.uint64)
+    return (words[:, 0::2] * 256 + words[:, 1::2]).sum(axis=1)
+
+
+def ipv4_checksums(headers):
+    """Header checksums for an (n, 20) array of ipv4 headers with a zeroed checksum"""
+    return fold_checksums(sum_words(headers))
+
+
+def pseudo_header_sums(source_ips, destination_ips, protocol, lengths):
+    """Ones' complement sums of the ipv4 pseudo headers used by TCP and UDP"""
+    source_ips = np.asarray(source_ips, dtype=np.uint64)
+    destination_ips = np.asarray(destination_ips, dtype=np.uint64)
+    return ((source_ips >> 16) + (source_ips & 0xffff) +
+            (destination_ips >> 16) + (destination_ips & 0xffff) +
+            np.uint64(protocol) + np.asarray(lengths, dtype=np.uint64))
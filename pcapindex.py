@@ -0,0 +1,289 @@
+#!/bin/env python
+
+import logging
+import argparse
+import struct
+import time
+from array import array
+
+import numpy as np
+
+import anon
+import compression
+
+'''
+Sidecar index of the records in a pcap file, used to seek straight to packet N
+or to a point in time without scanning every packet header from the start.
+
+The index is written next to the capture as <file>.idx. It holds a 16 byte
+header followed by one (timestamp, offset) pair of little-endian uint64 values
+per record, in file order. Timestamps are in nanoseconds since the epoch and
+offsets are the byte position of the record's packet header in the capture.
+Both columns are sorted whenever the capture's timestamps are monotonic, which
+is recorded in the header flags.
+'''
+
+INDEX_MAGIC = b'PIDX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sII4x')
+FLAG_MONOTONIC = 0x1
+INDEX_DTYPE = np.dtype([('timestamp', '<u8'), ('offset', '<u8')])
+# number of buffered entries before they are flushed to the index file
+INDEX_BUFFER_SIZE = 65536
+
+
+def index_path(pcap_file):
+    return pcap_file + '.idx'
+
+
+class IndexWriter(object):
+    """
+    Streams index entries to disk as records are written, so indexing costs
+    a couple of appends per packet and constant memory however big the
+    capture gets.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.count = 0
+        self.monotonic = True
+        self._last = 0
+        self._entries = array('Q')
+        self._file = open(file_name, 'wb')
+        self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0))
+
+    def add(self, timestamp, offset):
+        if timestamp < self._last:
+            self.monotonic = False
+        self._last = timestamp
+        self._entries.append(timestamp)
+        self._entries.append(offset)
+        if len(self._entries) >= 2 * INDEX_BUFFER_SIZE:
+            self.flush()
+
+    def add_batch(self, timestamps, offsets):
+        """Vectorized add for arrays of timestamps and offsets"""
+        if len(timestamps) == 0:
+            return
+        self.flush()
+        if timestamps[0] < self._last or np.any(np.diff(timestamps) < 0):
+            self.monotonic = False
+        self._last = int(timestamps[-1])
+
+        entries = np.empty(len(timestamps), dtype=INDEX_DTYPE)
+        entries['timestamp'] = timestamps
+        entries['offset'] = offsets
+        self._file.write(memoryview(entries.view(np.uint8)))
+        self.count += len(entries)
+
+    def flush(self):
+        if self._entries:
+            entries = np.frombuffer(self._entries, dtype=np.uint64)
+            self._file.write(entries.astype('<u8', copy=False).tobytes())
+            self.count += len(self._entries) // 2
+            self._entries = array('Q')
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            flags = FLAG_MONOTONIC if self.monotonic else 0
+            self._file.seek(0)
+            self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, flags))
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PcapIndex(object):
+    """
+    Read side of the index. Entries are memory-mapped rather than loaded, and
+    time lookups are binary searches over the timestamp column.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            magic, version, flags = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("{0} is not a pcap index".format(file_name))
+
+        self.monotonic = bool(flags & FLAG_MONOTONIC)
+        self.entries = np.memmap(file_name, dtype=INDEX_DTYPE, mode='r',
+                                 offset=INDEX_HEADER.size)
+        self._order = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def offset(self, packet_number):
+        return int(self.entries['offset'][packet_number])
+
+    def timestamp(self, packet_number):
+        return int(self.entries['timestamp'][packet_number])
+
+    def _sorted(self):
+        """
+        Returns the timestamps in ascending order along with the record
+        numbers they belong to (None when the file order already is sorted)
+        """
+        timestamps = self.entries['timestamp']
+        if self.monotonic:
+            return timestamps, None
+        if self._order is None:
+            self._order = np.argsort(timestamps, kind='stable')
+        return timestamps[self._order], self._order
+
+    def find_time(self, timestamp):
+        """
+        Returns the number of the first packet captured at or after the given
+        time (nanoseconds since the epoch)
+        """
+        timestamps, order = self._sorted()
+        ndx = int(np.searchsorted(timestamps, timestamp, side='left'))
+        if order is not None and ndx < len(order):
+            return int(order[ndx])
+        return ndx
+
+    def time_range(self, start, end):
+        """
+        Returns the record numbers of every packet captured in [start, end),
+        in file order
+        """
+        timestamps, order = self._sorted()
+        first = int(np.searchsorted(timestamps, start, side='left'))
+        last = int(np.searchsorted(timestamps, end, side='left'))
+        if order is None:
+            return np.arange(first, last)
+        return np.sort(order[first:last])
+
+
+def build_index(pcap_file, file_name=None):
+    """
+    Indexes an existing capture (e.g. one written by anon.py) by hopping
+    through its record headers. Compressed captures are refused: their
+    records can't be seeked to, so the offsets would be of no use.
+    """
+    codec = compression.detect_codec(pcap_file)
+    if codec is not None:
+        raise ValueError("{0} is {1} compressed, decompress it before indexing".format(
+            pcap_file, codec))
+    if file_name is None:
+        file_name = index_path(pcap_file)
+
+    with anon.PcapReader(pcap_file) as reader:
+        with IndexWriter(file_name) as writer:
+            scale = 1000000000 // reader.ticks
+            for offset, packet_header, packet_data in reader:
+                writer.add(packet_header.start_time * 1000000000 +
+                           packet_header.offset_ms * scale, offset)
+    return file_name
+
+
+def slice_pcap(pcap_file, output_file, first, last, index=None):
+    """
+    Copies records [first, last) of a capture into a new file of the same
+    format (pcap or pcapng). Records are contiguous on disk, so this is a
+    single range copy.
+    """
+    if index is None:
+        index = PcapIndex(index_path(pcap_file))
+
+    with anon.PcapReader(pcap_file) as reader:
+        start = index.offset(first) if first < len(index) else reader.size
+        end = index.offset(last) if last < len(index) else reader.size
+        with open(output_file, 'wb') as out:
+            out.write(reader.header_bytes)
+            out.write(reader.read(start, end))
+
+
+def slice_pcap_by_time(pcap_file, output_file, start_time, end_time, index=None):
+    """
+    Copies every record captured in [start_time, end_time) (nanoseconds since
+    the epoch) into a new pcap file, preserving file order
+    """
+    if index is None:
+        index = PcapIndex(index_path(pcap_file))
+
+    records = index.time_range(start_time, end_time)
+    if index.monotonic:
+        first = int(records[0]) if len(records) else 0
+        last = int(records[-1]) + 1 if len(records) else 0
+        slice_pcap(pcap_file, output_file, first, last, index=index)
+        return len(records)
+
+    with anon.PcapReader(pcap_file) as reader:
+        with open(output_file, 'wb') as out:
+            out.write(reader.header_bytes)
+            for record in records:
+                start = index.offset(record)
+                end = index.offset(record + 1) if record + 1 < len(index) else reader.size
+                out.write(reader.read(start, end))
+    return len(records)
+
+
+def parse_time(value):
+    """
+    Accepts either seconds since the epoch or a time.strptime style string
+    and returns nanoseconds since the epoch
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = time.mktime(time.strptime(value))
+    return int(round(seconds * 1000000000))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python pcapindex.py',
+                                     description = 'Build and use pcap record indexes')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build', help='Index an existing pcap file')
+    build.add_argument('pcap_file')
+
+    slice_ = subparsers.add_parser('slice', help='Copy part of an indexed pcap file')
+    slice_.add_argument('pcap_file')
+    slice_.add_argument('output_file')
+    slice_.add_argument("--first",
+        help="Number of the first packet to copy", type=int)
+    slice_.add_argument("--last",
+        help="Number of the packet to stop before", type=int)
+    slice_.add_argument("--start-time",
+        help="Copy packets captured at or after this time (epoch seconds or "
+             "e.g. 'Sun Oct 2 00:00:00 2016')")
+    slice_.add_argument("--end-time",
+        help="Copy packets captured before this time")
+
+    args = parser.parse_args()
+    logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+
+    if args.command == 'build':
+        try:
+            file_name = build_index(args.pcap_file)
+        except ValueError as e:
+            parser.error(str(e))
+        logging.info("Wrote {0} entries to {1}".format(len(PcapIndex(file_name)), file_name))
+    elif args.command == 'slice':
+        index = PcapIndex(index_path(args.pcap_file))
+        if args.start_time is not None or args.end_time is not None:
+            start = parse_time(args.start_time) if args.start_time else 0
+            end = parse_time(args.end_time) if args.end_time else 2**64 - 1
+            count = slice_pcap_by_time(args.pcap_file, args.output_file,
+                                       start, end, index=index)
+        else:
+            first = args.first if args.first is not None else 0
+            last = args.last if args.last is not None else len(index)
+            slice_pcap(args.pcap_file, args.output_file, first, last, index=index)
+            count = max(0, min(last, len(index)) - first)
+        logging.info("Copied {0} packets to {1}".format(count, args.output_file))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/bin/env python
+
+import struct
+
+import numpy as np
+
+from packetbatch import PacketBatch
+
+'''
+pcapng output. A file is one section header block (of unspecified length, so
+the section can grow as large as needed) and one Ethernet interface with
+nanosecond timestamps, followed by an Enhanced Packet Block per packet.
+
+Batches of pcap records are converted to batches of EPBs in one go: the block
+headers and trailers are written as uint32 words (every block starts on a 4
+byte boundary) and the packet bytes are scattered into place with a single
+fancy-indexed copy. The result is again a PacketBatch, whose offsets are those
+of the blocks, so it can be written, indexed and rotated like pcap records.
+
+Reading pcapng is handled by anon.PcapReader.
+'''
+
+SECTION_HEADER_BLOCK = 0x0a0d0d0a
+INTERFACE_DESCRIPTION_BLOCK = 0x00000001
+ENHANCED_PACKET_BLOCK = 0x00000006
+BYTE_ORDER_MAGIC = 0x1a2b3c4d
+OPTION_END = 0
+OPTION_IF_TSRESOL = 9
+# timestamps are written in nanoseconds (if_tsresol 9)
+TICKS = 1000000000
+EPB_HEADER_SIZE = 28
+
+
+def section_header_block():
+    """Section header of unspecified length (-1), version 1.0, no options"""
+    return struct.pack('=IIIHHqI', SECTION_HEADER_BLOCK, 28, BYTE_ORDER_MAGIC,
+                       1, 0, -1, 28)
+
+
+def interface_description_block(link_type=1, snaplen=65535, ticks=TICKS):
+    """Interface with the timestamp resolution of ticks (1e6 or 1e9) per second"""
+    options = b''
+    if ticks != 1000000:
+        options = (struct.pack('=HHB3x', OPTION_IF_TSRESOL, 1, len(str(ticks)) - 1) +
+                   struct.pack('=HH', OPTION_END, 0))
+    length = 20 + len(options)
+    return (struct.pack('=IIHHI', INTERFACE_DESCRIPTION_BLOCK, length, link_type, 0, snaplen) +
+            options + struct.pack('=I', length))
+
+
+def create_file_header(link_type=1, snaplen=65535):
+    return section_header_block() + interface_description_block(link_type, snaplen)
+
+
+def enhanced_packet_block(record, ticks=TICKS):
+    """Converts one pcap record (16 byte header included) to an EPB"""
+    ts_sec, ts_frac, included_length, original_length = struct.unpack_from('=IIII', record)
+    timestamp = ts_sec * TICKS + ts_frac * (TICKS // ticks)
+    padding = -included_length % 4
+    length = 32 + included_length + padding
+    return b"".join([
+        struct.pack('=IIIIIII', ENHANCED_PACKET_BLOCK, length, 0, timestamp >> 32,
+                    timestamp & 0xffffffff, included_length, original_length),
+        bytes(record[16:16 + included_length]),
+        b'\x00' * padding,
+        struct.pack('=I', length)])
+
+
+def enhanced_packet_blocks(batch, ticks=TICKS):
+    """
+    Converts a PacketBatch of pcap records, whose sub-second timestamps are
+    in ticks per second (or an array of fixed-size packet records), to a
+    PacketBatch of EPBs
+    """
+    if not isinstance(batch, PacketBatch):
+        batch = PacketBatch.from_records(batch)
+    count = len(batch)
+    starts = batch.offsets[:-1]
+    included = batch.included_lengths
+    lengths = 32 + ((included + 3) & ~3)
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # original lengths come straight from the record headers
+    columns = starts[:, np.newaxis] + 12 + np.arange(4)
+    original = batch.data[columns].copy().view('=u4').ravel()
+    timestamps = (batch.ts_sec.astype(np.uint64) * np.uint64(TICKS) +
+                  batch.ts_usec.astype(np.uint64) * np.uint64(TICKS // ticks))
+
+    data = np.zeros(int(offsets[-1]), dtype=np.uint8)
+    words = data.view('=u4')
+    first = offsets[:-1] // 4
+    words[first] = ENHANCED_PACKET_BLOCK
+    words[first + 1] = lengths
+    words[first + 3] = timestamps >> np.uint64(32)
+    words[first + 4] = timestamps & np.uint64(0xffffffff)
+    words[first + 5] = included
+    words[first + 6] = original
+    words[offsets[1:] // 4 - 1] = lengths
+
+    # move every packet byte from behind its record header to behind its
+    # block header
+    shift = np.repeat(offsets[:-1] + EPB_HEADER_SIZE - starts - 16, included)
+    source = np.repeat(starts + 16 - np.concatenate([[0], np.cumsum(included)[:-1]]),
+                       included) + np.arange(int(included.sum()))
+    data[source + shift] = batch.data[source]
+
+    return PacketBatch(data, offsets, batch.ts_sec, batch.ts_usec)
@@ -0,0 +1,496 @@
+#!/bin/env python
+
+import logging
+import argparse
+import ipaddress
+import json
+import os
+import sys
+import time
+from collections import Counter
+from itertools import islice
+
+import numpy as np
+
+import anon
+import pcapindex
+
+'''
+Statistics and sanity checks for whole capture files, fast enough to run over
+every generated or anonymized file.
+
+Files are opened with anon.PcapReader (so pcap, nanosecond pcap, pcapng and
+compressed files all work) and handled a chunk of records at a time: the
+record offsets are collected first, then the fields anon.py reads one packet
+at a time (the PacketHeader and EthernetFrame fields, the IPv4 protocol and
+addresses) are gathered for the whole chunk with numpy fancy indexing. The
+only per-packet Python work is hopping from one record header to the next,
+and even that is skipped for pcap files with an up to date .idx sidecar (see
+pcapindex.py), whose offsets are checked against the file and used as is.
+
+The result is a JSON-friendly dict: sizes and lengths, the time span and
+per-second packet rates, the ether type and IP protocol mix, host counts and
+top talkers, and the count and first offset of every problem found.
+'''
+
+# records handled at a time
+CHUNK_PACKETS = 1 << 20
+# hosts listed as top talkers
+TOP_HOSTS = 10
+# distinct values kept per host counter before they are merged
+MERGE_SIZE = 1 << 22
+
+ETHER_TYPE_NAMES = {0x0800: 'ipv4', 0x0806: 'arp', 0x86dd: 'ipv6', 0x8100: 'vlan',
+                    0x88a8: 'qinq', 0x8847: 'mpls', 0x88cc: 'lldp'}
+IP_PROTOCOL_NAMES = {1: 'icmp', 2: 'igmp', 6: 'tcp', 17: 'udp', 47: 'gre',
+                     50: 'esp', 58: 'icmpv6', 132: 'sctp'}
+VLAN_ETHER_TYPES = (0x8100, 0x88a8)
+LINK_TYPE_ETHERNET = 1
+
+# the problems looked for, and what they mean
+CHECKS = (
+    ('truncated_record', 'record runs past the end of the file'),
+    ('trailing_bytes', 'bytes after the last record that are not a whole record'),
+    ('over_snaplen', 'included length is larger than the snaplen'),
+    ('over_original_length', 'included length is larger than the original length'),
+    ('bad_fraction', 'sub-second timestamp is a second or more'),
+    ('time_went_backwards', 'timestamp is earlier than the one before'),
+    ('bad_block_length', 'pcapng block length is invalid or does not match its trailer'),
+    ('unknown_interface', 'pcapng packet refers to an undescribed interface'),
+)
+
+
+def words(data, dtype):
+    """
+    Unaligned view of a uint8 array holding the word (e.g. '>u2') starting
+    at every byte, so fields at arbitrary offsets are one fancy index away
+    """
+    dtype = np.dtype(dtype)
+    return np.ndarray((max(0, len(data) - dtype.itemsize + 1),), dtype=dtype,
+                      buffer=data, strides=(1,))
+
+
+def gather_words(data, starts, dtype, count=None):
+    """
+    The word at every start offset, or with count an int64 array of count
+    consecutive words per offset
+    """
+    if count is None:
+        return words(data, dtype)[starts]
+    view = words(data, dtype)
+    size = np.dtype(dtype).itemsize
+    return np.stack([view[starts + i * size] for i in range(count)], axis=1).astype(np.int64)
+
+
+def count_values(values):
+    """{value: occurrences} of an integer array"""
+    if not len(values):
+        return {}
+    low = int(values.min())
+    span = int(values.max()) - low + 1
+    if span <= max(len(values), 65536):
+        counts = np.bincount((values - low).astype(np.int64), minlength=span)
+        present = np.flatnonzero(counts)
+        return dict(zip((present + low).tolist(), counts[present].tolist()))
+    values, counts = np.unique(values, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+
+def merge_counts(values, counts):
+    """Sums the counts of equal values; returns the distinct values and sums"""
+    values, inverse = np.unique(values, return_inverse=True)
+    return values, np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+
+
+class ValueCounter(object):
+    """Occurrences of every distinct value of a stream of integer arrays"""
+
+    def __init__(self):
+        self._values = []
+        self._counts = []
+        self._pending = 0
+
+    def add(self, values):
+        if len(values):
+            values, counts = np.unique(values, return_counts=True)
+            self._values.append(values)
+            self._counts.append(counts)
+            self._pending += len(values)
+            if self._pending > MERGE_SIZE:
+                self._merge()
+
+    def _merge(self):
+        if len(self._values) > 1:
+            values, counts = merge_counts(np.concatenate(self._values),
+                                          np.concatenate(self._counts))
+            self._values, self._counts = [values], [counts]
+        self._pending = len(self._values[0]) if self._values else 0
+
+    def result(self):
+        """Distinct values and their counts"""
+        self._merge()
+        if not self._values:
+            return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+        return self._values[0], self._counts[0]
+
+
+class Scan(object):
+    """Running totals of one file's scan, fed a chunk of packets at a time"""
+
+    def __init__(self, reader, data, top=TOP_HOSTS, per_second=False):
+        self.reader = reader
+        self.data = data
+        self.top = top
+        self.per_second = per_second
+        self.packets = 0
+        self.bytes = 0
+        self.original_bytes = 0
+        self.other_blocks = 0
+        self.min_length = None
+        self.max_length = None
+        self.first_time = None
+        self.last_time = None
+        self._previous_time = None
+        self.seconds = Counter()
+        self.ether_types = Counter()
+        self.ip_protocols = Counter()
+        self.vlan_tagged = 0
+        self.sources = ValueCounter()
+        self.destinations = ValueCounter()
+        self.macs = ValueCounter()
+        self.problems = {name: [0, None] for name, description in CHECKS}
+
+    def flag(self, name, mask, offsets):
+        """Counts the records of a chunk that fail a check"""
+        count = int(np.count_nonzero(mask))
+        if count:
+            problem = self.problems[name]
+            if problem[1] is None:
+                problem[1] = int(offsets[np.argmax(mask)])
+            problem[0] += count
+
+    def add_records(self, offsets):
+        """Adds a chunk of pcap records; returns where the last one ends"""
+        reader = self.reader
+        seconds, fraction, included, original = gather_words(
+            self.data, offsets, reader.byte_order + 'u4', 4).T
+        data_starts = offsets + 16
+        ends = data_starts + included
+
+        self.flag('truncated_record', ends > reader.size, offsets)
+        self.flag('over_original_length', included > original, offsets)
+        if reader.header.max_length:
+            self.flag('over_snaplen', included > reader.header.max_length, offsets)
+        self.flag('bad_fraction', fraction >= reader.ticks, offsets)
+
+        timestamps = seconds * 1000000000 + fraction * (1000000000 // reader.ticks)
+        self.add_packets(offsets, data_starts, included,
+                         np.minimum(included, reader.size - data_starts), original, timestamps)
+        return int(ends[-1])
+
+    def add_blocks(self, offsets):
+        """Adds a chunk of pcapng blocks; returns where the last one ends"""
+        reader = self.reader
+        data = self.data
+        order = reader.byte_order + 'u4'
+        block_types, lengths = gather_words(data, offsets, order, 2).T
+        ends = offsets + lengths
+        truncated = ends > reader.size
+        self.flag('truncated_record', truncated, offsets)
+
+        bad = (lengths < 12) | (lengths % 4 != 0)
+        whole = ~bad & ~truncated
+        bad[whole] = gather_words(data, ends[whole] - 4, order) != lengths[whole]
+
+        packets = (block_types == anon.PCAPNG_ENHANCED_PACKET) & ~bad & ~truncated
+        packets &= lengths >= 32
+        self.other_blocks += int(np.count_nonzero(block_types != anon.PCAPNG_ENHANCED_PACKET))
+        fields = gather_words(data, offsets[packets] + 8, order, 5)
+        interfaces = fields[:, 0]
+        # the packet data has to fit in the block
+        overflow = offsets[packets] + 28 + fields[:, 3] > ends[packets] - 4
+        bad[np.flatnonzero(packets)[overflow]] = True
+        self.flag('bad_block_length', bad, offsets)
+
+        units = np.full(len(interfaces), 1000000, dtype=np.int64)
+        snaplen = np.zeros(len(interfaces), dtype=np.int64)
+        unknown = np.zeros(len(interfaces), dtype=bool)
+        for interface in np.unique(interfaces).tolist():
+            selected = interfaces == interface
+            try:
+                snaplen[selected], units[selected] = reader.interface(interface)[1:]
+            except (IndexError, ValueError):
+                # not described, or only behind a block we can't get past
+                unknown |= selected
+        self.flag('unknown_interface', unknown, offsets[packets])
+
+        # without an interface the timestamps mean nothing, so those
+        # packets are left out of the statistics
+        known = ~unknown
+        packets[packets] = known
+        high, low, included, original = fields[known, 1:].T
+        units, snaplen = units[known], snaplen[known]
+        packet_offsets = offsets[packets]
+        data_starts = packet_offsets + 28
+        self.flag('over_original_length', included > original, packet_offsets)
+        self.flag('over_snaplen', (snaplen > 0) & (included > snaplen), packet_offsets)
+
+        raw = (high.astype(np.uint64) << np.uint64(32)) | low.astype(np.uint64)
+        units = units.astype(np.uint64)
+        timestamps = ((raw // units) * np.uint64(1000000000) +
+                      (raw % units) * np.uint64(1000000000) // units).astype(np.int64)
+        self.add_packets(packet_offsets, data_starts, included,
+                         np.clip(ends[packets] - 4 - data_starts, 0, included),
+                         original, timestamps)
+        return int(ends[-1])
+
+    def add_packets(self, offsets, data_starts, included, available, original, timestamps):
+        """
+        Adds a chunk of packets: record offsets, where their data starts, the
+        included length, how much of it is really there, the original length
+        and timestamps in nanoseconds
+        """
+        if not len(offsets):
+            return
+        self.packets += len(offsets)
+        self.bytes += int(included.sum())
+        self.original_bytes += int(original.sum())
+
+        low, high = int(included.min()), int(included.max())
+        self.min_length = low if self.min_length is None else min(self.min_length, low)
+        self.max_length = high if self.max_length is None else max(self.max_length, high)
+
+        earliest, latest = int(timestamps.min()), int(timestamps.max())
+        self.first_time = earliest if self.first_time is None else min(self.first_time, earliest)
+        self.last_time = latest if self.last_time is None else max(self.last_time, latest)
+        previous = timestamps[0] if self._previous_time is None else self._previous_time
+        backwards = np.empty(len(timestamps), dtype=bool)
+        backwards[0] = timestamps[0] < previous
+        backwards[1:] = timestamps[1:] < timestamps[:-1]
+        self.flag('time_went_backwards', backwards, offsets)
+        self._previous_time = timestamps[-1]
+
+        self.seconds.update(count_values(timestamps // 1000000000))
+
+        if self.reader.header.data_link == LINK_TYPE_ETHERNET:
+            self.add_ethernet(data_starts, available)
+
+    def add_ethernet(self, starts, included):
+        data = self.data
+        ethernet = included >= 14
+        starts, included = starts[ethernet], included[ethernet]
+        self.macs.add(self._macs(starts))
+
+        ether_types = gather_words(data, starts + 12, '>u2')
+        network = starts + 14
+        tagged = np.isin(ether_types, VLAN_ETHER_TYPES) & (included >= 18)
+        self.vlan_tagged += int(np.count_nonzero(tagged))
+        ether_types[tagged] = gather_words(data, starts[tagged] + 16, '>u2')
+        network[tagged] += 4
+        available = starts + included - network
+        self.ether_types.update(count_values(ether_types))
+
+        ipv4 = (ether_types == 0x0800) & (available >= 20)
+        self.ip_protocols.update(count_values(data[network[ipv4] + 9]))
+        self.sources.add(gather_words(data, network[ipv4] + 12, '>u4'))
+        self.destinations.add(gather_words(data, network[ipv4] + 16, '>u4'))
+
+        ipv6 = (ether_types == 0x86dd) & (available >= 40)
+        self.ip_protocols.update(count_values(data[network[ipv6] + 6]))
+
+    def _macs(self, starts):
+        """Destination and source MACs of Ethernet frames as integers"""
+        macs = words(self.data, '>u8')
+        return np.concatenate([macs[starts], macs[starts + 6]]) >> np.uint64(16)
+
+    def report(self):
+        reader = self.reader
+        sources, source_counts = self.sources.result()
+        destinations, destination_counts = self.destinations.result()
+        hosts, host_counts = merge_counts(np.concatenate([sources, destinations]),
+                                          np.concatenate([source_counts, destination_counts]))
+        busiest = np.argsort(-host_counts, kind='stable')[:self.top]
+
+        if self.seconds:
+            spanned = self.last_time // 1000000000 - self.first_time // 1000000000 + 1
+            rates = {'seconds': spanned,
+                     'mean': self.packets / float(spanned),
+                     'min': min(self.seconds.values()) if len(self.seconds) == spanned else 0,
+                     'max': max(self.seconds.values())}
+            if self.per_second:
+                rates['per_second'] = {str(second): count
+                                       for second, count in sorted(self.seconds.items())}
+        else:
+            rates = {'seconds': 0, 'mean': 0.0, 'min': 0, 'max': 0}
+
+        checks = {name: {'count': count, 'first_offset': offset}
+                  for name, (count, offset) in self.problems.items()}
+        report = {
+            'file': reader.file_name,
+            'format': 'pcapng' if reader.pcapng else
+                      'pcap-ns' if reader.ticks > 1000000 else 'pcap',
+            'byte_order': 'little' if reader.byte_order == '<' else 'big',
+            'link_type': reader.header.data_link,
+            'snaplen': reader.header.max_length,
+            'size': reader.size,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'original_bytes': self.original_bytes,
+            'lengths': {'min': self.min_length or 0,
+                        'max': self.max_length or 0,
+                        'mean': self.bytes / float(self.packets) if self.packets else 0.0},
+            'start_time': self.first_time / 1e9 if self.packets else None,
+            'end_time': self.last_time / 1e9 if self.packets else None,
+            'duration': (self.last_time - self.first_time) / 1e9 if self.packets else 0.0,
+            'rates': rates,
+            'protocols': {
+                'ether_types': self.named(self.ether_types, ETHER_TYPE_NAMES, '0x{0:04x}'),
+                'ip_protocols': self.named(self.ip_protocols, IP_PROTOCOL_NAMES, '{0}'),
+                'vlan_tagged': self.vlan_tagged},
+            'hosts': {
+                'ipv4': len(hosts),
+                'sources': len(sources),
+                'destinations': len(destinations),
+                'macs': len(self.macs.result()[0]),
+                'top': [{'ip': str(ipaddress.IPv4Address(int(hosts[i]))),
+                         'packets': int(host_counts[i])} for i in busiest]},
+            'checks': checks,
+            'valid': not any(check['count'] for check in checks.values()),
+        }
+        if reader.pcapng:
+            report['other_blocks'] = self.other_blocks
+        return report
+
+    @staticmethod
+    def named(counter, names, fallback):
+        return {names.get(value, fallback.format(value)): count
+                for value, count in counter.most_common()}
+
+
+def walk_offsets(reader):
+    """reader.offsets(), stopping at a pcapng block whose length is unusable"""
+    try:
+        for offset in reader.offsets():
+            yield offset
+    except ValueError:
+        # the block was yielded and is flagged by Scan.add_blocks
+        return
+
+
+def indexed_offsets(reader):
+    """
+    Record offsets of a pcap file from its .idx sidecar, or None when there
+    is none or it does not describe the file as it is now
+    """
+    file_name = pcapindex.index_path(reader.file_name)
+    if not os.path.exists(file_name):
+        return None
+    try:
+        offsets = np.asarray(pcapindex.PcapIndex(file_name).entries['offset'], dtype=np.int64)
+    except ValueError:
+        return None
+    if not len(offsets):
+        return offsets if reader.data_start == reader.size else None
+    if offsets[0] != reader.data_start or np.any(offsets + 16 > reader.size):
+        return None
+
+    # every record has to end where the next one starts, and the last one
+    # where the file does
+    data = np.frombuffer(reader.read(0, reader.size), dtype=np.uint8)
+    order = reader.byte_order + 'u4'
+    for first in range(0, len(offsets), CHUNK_PACKETS):
+        chunk = offsets[first:first + CHUNK_PACKETS + 1]
+        ends = chunk + 16 + gather_words(data, chunk + 8, order)
+        if np.any(ends[:-1] != chunk[1:]):
+            return None
+    if ends[-1] != reader.size:
+        return None
+    return offsets
+
+
+def offset_chunks(reader, chunk_packets=CHUNK_PACKETS, offsets=None):
+    """Arrays of the offsets of chunk_packets records at a time"""
+    if offsets is not None:
+        for first in range(0, len(offsets), chunk_packets):
+            yield offsets[first:first + chunk_packets]
+        return
+
+    walk = walk_offsets(reader)
+    while True:
+        chunk = np.fromiter(islice(walk, chunk_packets), dtype=np.int64)
+        if not len(chunk):
+            return
+        yield chunk
+
+
+def scan_file(file_name, chunk_packets=CHUNK_PACKETS, top=TOP_HOSTS, per_second=False,
+              use_index=True):
+    """
+    Scans a capture and returns its statistics and problems as a dict (see
+    Scan.report). With use_index, a pcap file's .idx sidecar stands in for
+    walking the records when it matches the file.
+    """
+    started = time.time()
+    with anon.PcapReader(file_name) as reader:
+        data = np.frombuffer(reader.read(0, reader.size), dtype=np.uint8)
+        scan = Scan(reader, data, top=top, per_second=per_second)
+        offsets = None
+        if use_index and not reader.pcapng:
+            offsets = indexed_offsets(reader)
+            if offsets is not None:
+                logging.info("Using the offsets of {0}".format(pcapindex.index_path(file_name)))
+
+        add_chunk = scan.add_blocks if reader.pcapng else scan.add_records
+        end = reader.data_start
+        for chunk in offset_chunks(reader, chunk_packets, offsets):
+            end = add_chunk(chunk)
+        scan.flag('trailing_bytes', np.array([end < reader.size]), [end])
+
+        report = scan.report()
+        del data, scan
+    report['scan_seconds'] = round(time.time() - started, 3)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python pcapstats.py',
+                                     description = 'Print statistics of pcap files as JSON '
+                                                   'and check them for problems')
+    parser.add_argument('pcap_files', nargs='+')
+    parser.add_argument("-o", "--output",
+        help="Write the JSON to this file rather than stdout")
+    parser.add_argument("--top",
+        help="Number of top talkers listed (default: %(default)s)",
+        type=int, default=TOP_HOSTS)
+    parser.add_argument("--per-second",
+        help="List the packet count of every second", action='store_true')
+    parser.add_argument("--chunk-packets",
+        help="Records handled at a time (default: %(default)s)",
+        type=int, default=CHUNK_PACKETS)
+    parser.add_argument("--no-index",
+        help="Walk the records even when a matching .idx file exists", action='store_true')
+
+    args = parser.parse_args()
+    logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+
+    reports = []
+    for file_name in args.pcap_files:
+        report = scan_file(file_name, chunk_packets=args.chunk_packets, top=args.top,
+                           per_second=args.per_second, use_index=not args.no_index)
+        problems = sum(check['count'] for check in report['checks'].values())
+        logging.info("Scanned {0} packets of {1} in {2:.2f}s, {3} problems".format(
+            report['packets'], file_name, report['scan_seconds'], problems))
+        reports.append(report)
+
+    document = json.dumps(reports[0] if len(reports) == 1 else reports, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document + '\n')
+    else:
+        print(document)
+    # a non-zero exit status tells scripts that something failed a check
+    return 0 if all(report['valid'] for report in reports) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
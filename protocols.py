@@ -0,0 +1,506 @@
+#!/bin/env python
+
+import numpy as np
+
+import flows
+import hostmodel
+from packetbatch import PacketBatch, fold_checksums, sum_words, ipv4_checksums, pseudo_header_sums
+from randomness import random_integers
+
+'''
+Mixed-protocol packet synthesis. Each protocol has a builder which turns an
+array of timestamps into a PacketBatch of that protocol's packets, and a
+ProtocolMix draws the protocol of every packet from a set of weights, builds
+each protocol's share in one batch and merges the results back into time
+order.
+
+New protocols plug in by subclassing PacketBuilder and adding the class to
+BUILDERS.
+'''
+
+# pcap packet header, ethernet frame and ipv4 header, followed by the L4 data
+IPV4_HEADER_DTYPE = np.dtype([
+    ('ts_sec', '=u4'),
+    ('ts_usec', '=u4'),
+    ('included_length', '=u4'),
+    ('original_length', '=u4'),
+    ('destination_mac', 'u1', (6,)),
+    ('source_mac', 'u1', (6,)),
+    ('ether_type', '>u2'),
+    ('version_ihl', 'u1'),
+    ('dscp_ecn', 'u1'),
+    ('total_length', '>u2'),
+    ('identification', '>u2'),
+    ('flags_fragment', '>u2'),
+    ('time_to_live', 'u1'),
+    ('protocol', 'u1'),
+    ('header_checksum', '>u2'),
+    ('source_ip', '>u4'),
+    ('destination_ip', '>u4'),
+])
+
+# pcap packet header, ethernet frame and ipv6 header
+IPV6_HEADER_DTYPE = np.dtype([
+    ('ts_sec', '=u4'),
+    ('ts_usec', '=u4'),
+    ('included_length', '=u4'),
+    ('original_length', '=u4'),
+    ('destination_mac', 'u1', (6,)),
+    ('source_mac', 'u1', (6,)),
+    ('ether_type', '>u2'),
+    ('version_class_flow', '>u4'),
+    ('payload_length', '>u2'),
+    ('next_header', 'u1'),
+    ('hop_limit', 'u1'),
+    ('source_ip', 'u1', (16,)),
+    ('destination_ip', 'u1', (16,)),
+])
+
+IPV4_IP_OFFSET = 30
+IPV6_IP_OFFSET = 30
+PROTOCOL_ICMP = 1
+PROTOCOL_UDP = 17
+
+UDP_SERVER_PORTS = np.array([123, 514, 161, 5060, 443], dtype=np.int64)
+ICMP_PAYLOAD_SIZE = 56
+PAYLOAD_POOL_SIZE = 1 << 20
+
+# names used for DNS queries, every combination of these parts
+DNS_HOSTS = ['www', 'mail', 'api', 'cdn', 'login', 'static', 'images', 'updates']
+DNS_DOMAINS = ['example', 'contoso', 'acme', 'initech', 'globex', 'umbrella']
+DNS_TLDS = ['com', 'net', 'org', 'io']
+
+# default share of each protocol in the mix
+DEFAULT_MIX = {'tcp': 0.6, 'udp': 0.1, 'dns': 0.15, 'icmp': 0.05, 'ipv6': 0.1}
+
+
+def put_u16(rows, column, values):
+    """Stores big-endian 16-bit values in two columns of a 2-D uint8 array"""
+    values = np.asarray(values, dtype=np.int64)
+    rows[:, column] = values >> 8
+    rows[:, column + 1] = values & 0xff
+
+
+def put_u32(rows, column, values):
+    values = np.asarray(values, dtype=np.int64)
+    put_u16(rows, column, values >> 16)
+    put_u16(rows, column + 2, values & 0xffff)
+
+
+class Endpoints(object):
+    """Source and destination MAC and IP address of a set of packets"""
+    __slots__ = ('source_mac', 'destination_mac', 'source_ip', 'destination_ip',
+                 'outbound')
+
+    def __init__(self, source_mac, destination_mac, source_ip, destination_ip, outbound):
+        self.source_mac = source_mac
+        self.destination_mac = destination_mac
+        self.source_ip = source_ip
+        self.destination_ip = destination_ip
+        self.outbound = outbound
+
+    def reversed(self):
+        """Endpoints of the replies to these packets"""
+        return Endpoints(self.destination_mac, self.source_mac,
+                         self.destination_ip, self.source_ip, ~self.outbound)
+
+    def interleave(self, replies):
+        """
+        Endpoints of requests and their replies alternated, request first,
+        trimmed to count packets
+        """
+        def merge(a, b):
+            merged = np.empty((2 * len(a),) + a.shape[1:], dtype=a.dtype)
+            merged[0::2] = a
+            merged[1::2] = b
+            return merged
+        return Endpoints(*[merge(getattr(self, name), getattr(replies, name))
+                           for name in self.__slots__])
+
+    def head(self, count):
+        return Endpoints(*[getattr(self, name)[:count] for name in self.__slots__])
+
+
+class PacketBuilder(object):
+    """
+    Base class of the per-protocol builders. Subclasses implement build(),
+    which returns a PacketBatch with one packet per timestamp, and
+    mean_record_size(), the expected size of a record in bytes. Hosts are
+    picked from host_pairs (see hostmodel.HostPairs), or uniformly when that
+    is None.
+    """
+
+    def __init__(self, internal_hosts, external_hosts, rng=np.random, host_pairs=None):
+        self.internal_hosts = internal_hosts
+        self.external_hosts = external_hosts
+        self.host_pairs = host_pairs
+        self.rng = rng
+        self.payload_pool = np.frombuffer(rng.bytes(PAYLOAD_POOL_SIZE + 2048), dtype=np.uint8)
+
+    def pick_endpoints(self, count, outbound=None):
+        """
+        Picks an internal and external host for count packets. Unless given,
+        the direction of every packet is random too.
+        """
+        internal = self.internal_hosts
+        external = self.external_hosts
+        if outbound is None:
+            outbound = self.rng.random(count) < 0.5
+        internal_ndx, external_ndx = self.pick_hosts(count)
+
+        internal_mac = internal.macs[internal_ndx]
+        external_mac = external.macs[external_ndx]
+        internal_ip = internal.ips[internal_ndx]
+        external_ip = external.ips[external_ndx]
+        column = outbound[:, np.newaxis]
+        return Endpoints(np.where(column, internal_mac, external_mac),
+                         np.where(column, external_mac, internal_mac),
+                         np.where(outbound, internal_ip, external_ip),
+                         np.where(outbound, external_ip, internal_ip),
+                         outbound)
+
+    def pick_hosts(self, count):
+        """Internal and external host indices for count packets"""
+        return hostmodel.sample_pairs(self.host_pairs, len(self.internal_hosts),
+                                      len(self.external_hosts), count, self.rng)
+
+    def pick_pairs(self, count):
+        """
+        Endpoints for count packets made of requests from internal hosts,
+        each followed by the reply to it
+        """
+        requests = self.pick_endpoints((count + 1) // 2,
+                                       outbound=np.ones((count + 1) // 2, dtype=bool))
+        return requests.interleave(requests.reversed()).head(count)
+
+    def cut_payloads(self, lengths, width):
+        """Random payloads of the given lengths, zero padded to width"""
+        columns = np.arange(width)
+        starts = random_integers(self.rng, 0, PAYLOAD_POOL_SIZE, len(lengths))
+        payloads = self.payload_pool[starts[:, np.newaxis] + columns]
+        payloads[columns >= lengths[:, np.newaxis]] = 0
+        return payloads
+
+    def build_udp_segments(self, source_ports, destination_ports, payloads, lengths):
+        """UDP headers (checksum left zero) followed by the payloads"""
+        segments = np.zeros((len(lengths), 8 + payloads.shape[1]), dtype=np.uint8)
+        put_u16(segments, 0, source_ports)
+        put_u16(segments, 2, destination_ports)
+        put_u16(segments, 4, 8 + lengths)
+        segments[:, 8:] = payloads
+        return segments, 8 + lengths
+
+    def build_ipv4(self, endpoints, protocol, segments, lengths, checksum_offset,
+                   ts_sec, ts_usec):
+        """
+        Wraps L4 segments (checksum fields zeroed) in ethernet and ipv4
+        headers, filling in the ipv4 and L4 checksums
+        """
+        count = len(lengths)
+        headers = np.zeros(count, dtype=IPV4_HEADER_DTYPE)
+        headers['ts_sec'] = ts_sec
+        headers['ts_usec'] = ts_usec
+        headers['included_length'] = 34 + lengths
+        headers['original_length'] = 34 + lengths
+        headers['source_mac'] = endpoints.source_mac
+        headers['destination_mac'] = endpoints.destination_mac
+        headers['ether_type'] = 0x0800
+        headers['version_ihl'] = 0x45
+        headers['total_length'] = 20 + lengths
+        headers['identification'] = random_integers(self.rng, 0, 1 << 16, count)
+        headers['time_to_live'] = np.where(endpoints.outbound, 128, 64)
+        headers['protocol'] = protocol
+        headers['source_ip'] = endpoints.source_ip
+        headers['destination_ip'] = endpoints.destination_ip
+
+        rows = headers.view(np.uint8).reshape(count, IPV4_HEADER_DTYPE.itemsize)
+        headers['header_checksum'] = ipv4_checksums(rows[:, IPV4_IP_OFFSET:])
+
+        totals = sum_words(segments)
+        if protocol != PROTOCOL_ICMP:
+            totals = totals + pseudo_header_sums(endpoints.source_ip,
+                                                 endpoints.destination_ip,
+                                                 protocol, lengths)
+        checksums = fold_checksums(totals)
+        if protocol == PROTOCOL_UDP:
+            # a computed checksum of zero is sent as all ones
+            checksums[checksums == 0] = 0xffff
+        put_u16(segments, checksum_offset, checksums)
+
+        return PacketBatch.from_rows(np.concatenate([rows, segments], axis=1),
+                                     IPV4_HEADER_DTYPE.itemsize + lengths,
+                                     ts_sec, ts_usec)
+
+
+class TcpBuilder(PacketBuilder):
+    """Stateful TCP connections from the flow engine"""
+
+    def __init__(self, internal_hosts, external_hosts, rng=np.random, host_pairs=None):
+        self.flow_table = flows.FlowTable(internal_hosts, external_hosts, rng=rng,
+                                          host_pairs=host_pairs)
+
+    def build(self, ts_sec, ts_usec):
+        return self.flow_table.create_batch(ts_sec, ts_usec)
+
+    def mean_record_size(self):
+        return self.flow_table.mean_record_size()
+
+
+class UdpBuilder(PacketBuilder):
+    """Single UDP datagrams to or from a handful of well-known services"""
+    min_payload = 20
+    max_payload = 1200
+
+    def build(self, ts_sec, ts_usec):
+        count = len(ts_sec)
+        endpoints = self.pick_endpoints(count)
+        client_ports = random_integers(self.rng, 32768, 61000, count)
+        server_ports = UDP_SERVER_PORTS[random_integers(self.rng, 0, len(UDP_SERVER_PORTS), count)]
+        outbound = endpoints.outbound
+
+        lengths = random_integers(self.rng, self.min_payload, self.max_payload + 1, count)
+        payloads = self.cut_payloads(lengths, self.max_payload)
+        segments, lengths = self.build_udp_segments(
+            np.where(outbound, client_ports, server_ports),
+            np.where(outbound, server_ports, client_ports),
+            payloads, lengths)
+        return self.build_ipv4(endpoints, PROTOCOL_UDP, segments, lengths, 6,
+                               ts_sec, ts_usec)
+
+    def mean_record_size(self):
+        return 16 + 42 + (self.min_payload + self.max_payload) / 2.0
+
+
+def encode_dns_name(name):
+    labels = [label.encode('ascii') for label in name.split('.')]
+    return b"".join([bytes([len(label)]) + label for label in labels]) + b'\x00'
+
+
+class DnsBuilder(PacketBuilder):
+    """
+    DNS A queries from internal hosts to external resolvers, each followed by
+    a response carrying one answer
+    """
+
+    def __init__(self, internal_hosts, external_hosts, rng=np.random, host_pairs=None):
+        PacketBuilder.__init__(self, internal_hosts, external_hosts, rng=rng,
+                               host_pairs=host_pairs)
+
+        names = [encode_dns_name('.'.join([host, domain, tld]))
+                 for host in DNS_HOSTS for domain in DNS_DOMAINS for tld in DNS_TLDS]
+        self.name_lengths = np.array([len(name) for name in names], dtype=np.int64)
+        self.names = np.zeros((len(names), self.name_lengths.max()), dtype=np.uint8)
+        for i, name in enumerate(names):
+            self.names[i, :len(name)] = np.frombuffer(name, dtype=np.uint8)
+
+    def build(self, ts_sec, ts_usec):
+        count = len(ts_sec)
+        queries = (count + 1) // 2
+        endpoints = self.pick_pairs(count)
+        is_response = np.arange(count) % 2 == 1
+
+        # every response repeats the id, port and name of its query
+        def pair(values):
+            return np.repeat(values, 2, axis=0)[:count]
+        ids = pair(random_integers(self.rng, 0, 1 << 16, queries))
+        client_ports = pair(random_integers(self.rng, 32768, 61000, queries))
+        names = pair(random_integers(self.rng, 0, len(self.names), queries))
+        name_lengths = self.name_lengths[names]
+
+        # header, question and (for responses) one answer
+        width = 12 + self.names.shape[1] + 4 + 16
+        payloads = np.zeros((count, width), dtype=np.uint8)
+        put_u16(payloads, 0, ids)
+        put_u16(payloads, 2, np.where(is_response, 0x8180, 0x0100))
+        put_u16(payloads, 4, 1)
+        put_u16(payloads, 6, is_response.astype(np.int64))
+        payloads[:, 12:12 + self.names.shape[1]] = self.names[names]
+
+        trailer = np.zeros((count, 20), dtype=np.uint8)
+        put_u16(trailer, 0, 1)                  # QTYPE A
+        put_u16(trailer, 2, 1)                  # QCLASS IN
+        put_u16(trailer, 4, 0xc00c)             # answer name, pointer to the question
+        put_u16(trailer, 6, 1)
+        put_u16(trailer, 8, 1)
+        put_u32(trailer, 10, random_integers(self.rng, 60, 3600, count))
+        put_u16(trailer, 14, 4)
+        put_u32(trailer, 16, random_integers(self.rng, 1 << 24, 0xe0000000, count))
+        trailer_lengths = np.where(is_response, 20, 4)
+        trailer[np.arange(20) >= trailer_lengths[:, np.newaxis]] = 0
+        rows = np.arange(count)[:, np.newaxis]
+        payloads[rows, 12 + name_lengths[:, np.newaxis] + np.arange(20)] = trailer
+
+        lengths = 12 + name_lengths + trailer_lengths
+        segments, lengths = self.build_udp_segments(
+            np.where(is_response, 53, client_ports),
+            np.where(is_response, client_ports, 53),
+            payloads, lengths)
+        return self.build_ipv4(endpoints, PROTOCOL_UDP, segments, lengths, 6,
+                               ts_sec, ts_usec)
+
+    def mean_record_size(self):
+        return 16 + 42 + 12 + self.name_lengths.mean() + 12
+
+
+class IcmpBuilder(PacketBuilder):
+    """ICMP echo requests from internal hosts, each followed by its reply"""
+
+    def build(self, ts_sec, ts_usec):
+        count = len(ts_sec)
+        requests = (count + 1) // 2
+        endpoints = self.pick_pairs(count)
+        is_reply = np.arange(count) % 2 == 1
+
+        segments = np.zeros((count, 8 + ICMP_PAYLOAD_SIZE), dtype=np.uint8)
+        segments[:, 0] = np.where(is_reply, 0, 8)       # echo reply / request
+        put_u16(segments, 4, np.repeat(random_integers(self.rng, 0, 1 << 16, requests), 2)[:count])
+        put_u16(segments, 6, np.repeat(random_integers(self.rng, 0, 1 << 16, requests), 2)[:count])
+        payloads = self.cut_payloads(np.full(requests, ICMP_PAYLOAD_SIZE), ICMP_PAYLOAD_SIZE)
+        segments[:, 8:] = np.repeat(payloads, 2, axis=0)[:count]
+
+        lengths = np.full(count, 8 + ICMP_PAYLOAD_SIZE, dtype=np.int64)
+        return self.build_ipv4(endpoints, PROTOCOL_ICMP, segments, lengths, 2,
+                               ts_sec, ts_usec)
+
+    def mean_record_size(self):
+        return 16 + 42 + ICMP_PAYLOAD_SIZE
+
+
+class Ipv6Builder(PacketBuilder):
+    """
+    UDP over IPv6. Internal hosts live in fd00::/64 and external ones in
+    2001:db8::/32 (with their ipv4 address embedded), each with an EUI-64
+    interface id derived from its MAC address.
+    """
+    min_payload = 64
+    max_payload = 1200
+
+    def get_addresses(self, macs, ips, internal):
+        count = len(ips)
+        addresses = np.zeros((count, 16), dtype=np.uint8)
+        if internal:
+            addresses[:, 0] = 0xfd
+        else:
+            put_u32(addresses, 0, np.full(count, 0x20010db8))
+            put_u32(addresses, 4, ips)
+        addresses[:, 8:11] = macs[:, 0:3]
+        addresses[:, 8] ^= 0x02
+        addresses[:, 11] = 0xff
+        addresses[:, 12] = 0xfe
+        addresses[:, 13:16] = macs[:, 3:6]
+        return addresses
+
+    def build(self, ts_sec, ts_usec):
+        count = len(ts_sec)
+        rng = self.rng
+        outbound = rng.random(count) < 0.5
+        internal_ndx, external_ndx = self.pick_hosts(count)
+        internal_mac = self.internal_hosts.macs[internal_ndx]
+        external_mac = self.external_hosts.macs[external_ndx]
+        internal_ip = self.get_addresses(internal_mac, self.internal_hosts.ips[internal_ndx], True)
+        external_ip = self.get_addresses(external_mac, self.external_hosts.ips[external_ndx], False)
+        column = outbound[:, np.newaxis]
+
+        headers = np.zeros(count, dtype=IPV6_HEADER_DTYPE)
+        headers['ts_sec'] = ts_sec
+        headers['ts_usec'] = ts_usec
+        headers['source_mac'] = np.where(column, internal_mac, external_mac)
+        headers['destination_mac'] = np.where(column, external_mac, internal_mac)
+        headers['ether_type'] = 0x86dd
+        headers['version_class_flow'] = (6 << 28) | random_integers(rng, 0, 1 << 20, count)
+        headers['next_header'] = PROTOCOL_UDP
+        headers['hop_limit'] = np.where(outbound, 64, 57)
+        source_ip = np.where(column, internal_ip, external_ip)
+        destination_ip = np.where(column, external_ip, internal_ip)
+        headers['source_ip'] = source_ip
+        headers['destination_ip'] = destination_ip
+
+        client_ports = random_integers(rng, 32768, 61000, count)
+        lengths = random_integers(rng, self.min_payload, self.max_payload + 1, count)
+        segments, lengths = self.build_udp_segments(
+            np.where(outbound, client_ports, 443),
+            np.where(outbound, 443, client_ports),
+            self.cut_payloads(lengths, self.max_payload), lengths)
+        headers['payload_length'] = lengths
+        headers['included_length'] = 54 + lengths
+        headers['original_length'] = 54 + lengths
+
+        # the ipv6 pseudo header is both addresses, the upper layer length
+        # and the next header value
+        totals = (sum_words(segments) + sum_words(source_ip) + sum_words(destination_ip) +
+                  lengths.astype(np.uint64) + np.uint64(PROTOCOL_UDP))
+        checksums = fold_checksums(totals)
+        checksums[checksums == 0] = 0xffff
+        put_u16(segments, 6, checksums)
+
+        rows = headers.view(np.uint8).reshape(count, IPV6_HEADER_DTYPE.itemsize)
+        return PacketBatch.from_rows(np.concatenate([rows, segments], axis=1),
+                                     IPV6_HEADER_DTYPE.itemsize + lengths,
+                                     ts_sec, ts_usec)
+
+    def mean_record_size(self):
+        return 16 + 62 + (self.min_payload + self.max_payload) / 2.0
+
+
+BUILDERS = {
+    'tcp': TcpBuilder,
+    'udp': UdpBuilder,
+    'dns': DnsBuilder,
+    'icmp': IcmpBuilder,
+    'ipv6': Ipv6Builder,
+}
+
+
+def parse_mix(value):
+    """Parses a 'tcp=0.6,dns=0.2,...' style protocol mix into a dict"""
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in BUILDERS:
+            raise ValueError("unknown protocol {0}, expected one of {1}".format(
+                name, ', '.join(sorted(BUILDERS))))
+        weights[name] = float(weight) if weight else 1.0
+    return weights
+
+
+class ProtocolMix(object):
+    """
+    Draws the protocol of every packet according to weights, builds each
+    protocol's packets in one batch and merges them back into time order
+    """
+
+    def __init__(self, internal_hosts, external_hosts, weights=None, rng=np.random,
+                 host_pairs=None):
+        if weights is None:
+            weights = DEFAULT_MIX
+        self.names = sorted(name for name, weight in weights.items() if weight > 0)
+        if not self.names:
+            raise ValueError("the protocol mix needs at least one positive weight")
+        total = float(sum(weights[name] for name in self.names))
+        self.weights = np.array([weights[name] / total for name in self.names])
+        self.builders = [BUILDERS[name](internal_hosts, external_hosts, rng=rng,
+                                        host_pairs=host_pairs)
+                         for name in self.names]
+        self.rng = rng
+
+    def mean_record_size(self):
+        return sum(weight * builder.mean_record_size()
+                   for weight, builder in zip(self.weights, self.builders))
+
+    def create_batch(self, ts_sec, ts_usec):
+        count = len(ts_sec)
+        labels = np.searchsorted(np.cumsum(self.weights), self.rng.random(count) * self.weights.sum())
+        labels = np.minimum(labels, len(self.builders) - 1)
+
+        batches = []
+        positions = []
+        for label, builder in enumerate(self.builders):
+            ndx = np.flatnonzero(labels == label)
+            if len(ndx):
+                batches.append(builder.build(ts_sec[ndx], ts_usec[ndx]))
+                positions.append(ndx)
+
+        # put the packets back in the order of their timestamps
+        merged = PacketBatch.concatenate(batches)
+        return merged.take(np.argsort(np.concatenate(positions), kind='stable'))
@@ -0,0 +1,28 @@
+#!/bin/env python
+
+import numpy as np
+
+'''
+Random streams shared by the generator's modules. Nothing in here knows about
+packets, so host tables, host models and packet engines can all draw from the
+same helpers without depending on each other.
+'''
+
+
+def get_rng(seed, *counters):
+    """
+    Random stream identified by seed and a path of counters, e.g. (FILE_STREAM,
+    file_number, batch_number). The streams are counter-based (Philox keyed by
+    a SeedSequence) and independent of each other, so any of them can be
+    recreated on its own, in any process and in any order.
+    """
+    sequence = np.random.SeedSequence(seed, spawn_key=counters)
+    return np.random.Generator(np.random.Philox(sequence))
+
+
+def random_integers(rng, low, high, size):
+    """
+    Uniform integers in [low, high), drawn in a way that works with both
+    np.random.RandomState and np.random.Generator
+    """
+    return low + (rng.random(size) * (high - low)).astype(np.int64)
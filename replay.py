@@ -0,0 +1,160 @@
+#!/bin/env python
+
+import asyncio
+import logging
+import os
+import stat
+import sys
+
+import numpy as np
+
+from packetbatch import PacketBatch
+
+'''
+Live output for the generator: streams pcap data to stdout, a named FIFO or a
+unix socket, paced against the packet timestamps.
+
+Pacing is done against absolute deadlines (the wall-clock time each packet is
+due, worked out from the first packet) rather than by sleeping between
+packets, so the stream never drifts. Whenever the scheduler wakes up it writes
+every packet that has become due in one go, which keeps the number of writes
+per second bounded by the timer resolution rather than by the packet rate.
+'''
+
+# never sleep for less than this (seconds), below it timer overhead dominates
+MIN_SLEEP = 0.0005
+
+
+class PacedProtocol(asyncio.Protocol):
+    """
+    Write-side protocol which tracks the transport's flow control so that
+    writers can wait for the consumer to catch up
+    """
+
+    def __init__(self):
+        self._paused = False
+        self._waiter = None
+        self.lost = None
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake()
+
+    def connection_lost(self, exc):
+        self.lost = exc if exc is not None else BrokenPipeError("consumer went away")
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def drain(self):
+        if self.lost is not None:
+            raise self.lost
+        while self._paused:
+            self._waiter = asyncio.get_running_loop().create_future()
+            await self._waiter
+            if self.lost is not None:
+                raise self.lost
+
+
+class FileTransport(object):
+    """
+    Stand-in for a transport when stdout is redirected to a regular file,
+    which asyncio can't drive as a pipe. Writes simply block.
+    """
+
+    def __init__(self, f):
+        self._file = f
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.flush()
+
+
+async def open_target(target):
+    """
+    Opens '-' (stdout), unix:PATH (a listening unix socket) or the path of a
+    named FIFO and returns a (transport, protocol) pair
+    """
+    loop = asyncio.get_running_loop()
+    if target.startswith('unix:'):
+        return await loop.create_unix_connection(PacedProtocol, target[5:])
+
+    if target == '-':
+        pipe = sys.stdout.buffer
+    else:
+        if not os.path.exists(target):
+            os.mkfifo(target)
+        # opening a FIFO for writing blocks until a reader shows up
+        logging.info("Waiting for a reader on {0}".format(target))
+        pipe = open(target, 'wb', buffering=0)
+
+    if stat.S_ISREG(os.fstat(pipe.fileno()).st_mode):
+        return FileTransport(pipe), PacedProtocol()
+    return await loop.connect_write_pipe(PacedProtocol, pipe)
+
+
+async def replay(header, batches, target, speed=1.0, ticks=1000000):
+    """
+    Writes header and then every PacketBatch (or array of fixed-size packet
+    records) from batches to target. With a speed of 0 packets are written
+    as fast as the consumer takes them, otherwise speed scales how fast
+    packet time passes relative to wall-clock time, starting when the first
+    packet is sent. ticks is the resolution of the batch timestamps.
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await open_target(target)
+    transport.write(header)
+
+    packets = 0
+    first = None
+    opened = loop.time()
+    # the clock starts with the first packet: started any earlier, the time
+    # taken to generate the first batch would be made up with a burst
+    started = None
+    try:
+        for batch in batches:
+            if not isinstance(batch, PacketBatch):
+                batch = PacketBatch.from_records(batch)
+            if speed <= 0:
+                transport.write(batch.view())
+                await protocol.drain()
+                packets += len(batch)
+                continue
+
+            # wall-clock deadline of every packet in the batch
+            times = batch.times(ticks)
+            if first is None:
+                first = times[0]
+                started = loop.time()
+            deadlines = started + (times - first) / speed
+
+            sent = 0
+            while sent < len(batch):
+                now = loop.time()
+                due = int(np.searchsorted(deadlines, now, side='right'))
+                if due > sent:
+                    transport.write(batch.view(sent, due))
+                    await protocol.drain()
+                    sent = due
+                else:
+                    await asyncio.sleep(max(deadlines[sent] - now, MIN_SLEEP))
+            packets += len(batch)
+    except (BrokenPipeError, ConnectionResetError):
+        logging.info("Consumer closed the stream")
+    finally:
+        transport.close()
+
+    elapsed = loop.time() - opened
+    logging.info("Streamed {0} packets in {1:.2f} seconds ({2:.0f} packets/s)".format(
+        packets, elapsed, packets / elapsed if elapsed > 0 else 0))
+
+
+def replay_batches(header, batches, target, speed=1.0, ticks=1000000):
+    asyncio.run(replay(header, batches, target, speed=speed, ticks=ticks))
@@ -0,0 +1,152 @@
+#!/bin/env python
+
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from packetbatch import PacketBatch
+
+'''
+Rotating capture output, in the style of tcpdump's -C, -c and -G options.
+
+A RotatingWriter takes a continuous stream of packet batches and spreads them
+over a series of files, starting a new one whenever the current file would
+grow past a size, hold more than a number of packets, or cross a time
+boundary (a multiple of the rotation period, going by packet time). Batches
+are split on record boundaries without copying them.
+
+All file work happens on a background thread fed through a bounded queue, so
+opening, writing and closing files overlaps with generating the next batches.
+'''
+
+# batches queued for the writer thread before the producer has to wait
+QUEUE_SIZE = 8
+
+
+class RotatingWriter(object):
+    """
+    pattern names the files: it is first formatted with the file number as
+    {index}, then passed to time.strftime with the time of the file's first
+    packet, e.g. 'capture_{index:04d}_%Y%m%d_%H%M%S.pcap'.
+
+    open_writer(file_name) must return an open writer with a position
+    attribute and write_batch and close methods (e.g. test.PcapWriter with
+    the global header already written). max_bytes counts that header too.
+    """
+
+    def __init__(self, pattern, open_writer, max_bytes=None, max_packets=None,
+                 seconds=None, queue_size=QUEUE_SIZE):
+        self.pattern = pattern
+        self.open_writer = open_writer
+        self.max_bytes = max_bytes
+        self.max_packets = max_packets
+        self.seconds = seconds
+        self.files = []
+
+        self._writer = None
+        self._packets = 0
+        self._boundary = None
+        self._error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='pcap-rotation')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, batch):
+        """Queues a PacketBatch (or array of fixed-size packet records)"""
+        if not isinstance(batch, PacketBatch):
+            batch = PacketBatch.from_records(batch)
+        while True:
+            self._check()
+            try:
+                self._queue.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        """Waits for every queued batch to be written and closes the last file"""
+        if self._thread is not None:
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self._thread.join()
+            self._thread = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._check()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            try:
+                self._write(batch)
+            except Exception as e:
+                self._error = e
+                return
+
+    def _write(self, batch):
+        first = 0
+        while first < len(batch):
+            if self._writer is None:
+                self._open(int(batch.ts_sec[first]))
+
+            count = self._fits(batch, first)
+            if count == 0:
+                if self._packets > 0:
+                    self._rotate()
+                    continue
+                # a single record bigger than the size limit gets a file of its own
+                count = 1
+
+            self._writer.write_batch(batch.slice(first, first + count))
+            self._packets += count
+            first += count
+
+    def _fits(self, batch, first):
+        """Number of records from first on which still belong in the current file"""
+        count = len(batch) - first
+        if self.max_packets is not None:
+            count = min(count, self.max_packets - self._packets)
+        if self.max_bytes is not None:
+            room = self.max_bytes - self._writer.position
+            ends = batch.offsets[first + 1:first + count + 1] - batch.offsets[first]
+            count = int(np.searchsorted(ends, room, side='right'))
+        if self._boundary is not None:
+            count = int(np.searchsorted(batch.ts_sec[first:first + count],
+                                        self._boundary, side='left'))
+        return max(count, 0)
+
+    def _open(self, ts_sec):
+        if self.seconds is not None:
+            self._boundary = (ts_sec // self.seconds + 1) * self.seconds
+        file_name = time.strftime(self.pattern.format(index=len(self.files)),
+                                  time.localtime(ts_sec))
+        logging.info("Rotating to {0}".format(file_name))
+        self._writer = self.open_writer(file_name)
+        self._packets = 0
+        self.files.append(file_name)
+
+    def _rotate(self):
+        self._writer.close()
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,17 +1,65 @@
 import logging
+import os
 import struct
 import time
 import calendar
+import random
 from random import randint
 import argparse
+import multiprocessing
+from collections import OrderedDict
 from logging.handlers import TimedRotatingFileHandler
 
+import numpy as np
+
+import amplify
+import compression
+import flows
+import hostmodel
+import manifest
+import pcapindex
+import metrics
+import pcapng
+import protocols
+import replay
+import rotation
+from packetbatch import PacketBatch
+from randomness import get_rng, random_integers
 import trafficmodel
 
 OUTPUT_FILE = 'sample_data/test.pcap'
+# capture re-emitted by the amplify engine
+SEED_CAPTURE = 'sample_data/http.pcap'
+# packet synthesis engines, see --engine
+ENGINES = ('packet', 'batch', 'flows', 'mixed', 'amplify')
 START_TIME = 'Sun Oct 2 00:00:00 2016'
-INTERNAL_HOSTS = []
-EXTERNAL_HOSTS = []
+# flush buffered packets to disk once this many bytes have accumulated
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# number of packets synthesized per call when using the batch engine
+BATCH_SIZE = 65536
+# upper bound on the memory used by pre-packed per host pair headers
+TEMPLATE_CACHE_SIZE = 64 * 1024 * 1024
+INTERNAL_HOSTS = None
+EXTERNAL_HOSTS = None
+# popularity of the hosts and sticky conversations, None for uniform picks
+HOST_PAIRS = None
+HEADER_TEMPLATES = None
+# instrumentation of this process, see metrics.create_stats
+STATS = None
+# independent random streams derived from the --seed, see get_rng
+HOSTS_STREAM = 0
+SCHEDULE_STREAM = 1
+FILE_STREAM = 2
+# command line options recorded in a --manifest, which a resumed run reuses
+MANIFEST_SETTINGS = ('internal_hosts', 'external_hosts', 'min_duration',
+                     'max_duration', 'file_count', 'engine', 'format', 'index',
+                     'compress', 'arrivals', 'protocol_mix', 'host_skew',
+                     'sticky_share', 'conversations', 'seed_capture')
+# capture formats that can be written, see create_file_header
+OUTPUT_FORMATS = ('pcap', 'pcap-ns', 'pcapng')
+# a pcapng block carries 16 bytes more header than a pcap record, plus
+# padding up to a multiple of 4 bytes
+PCAPNG_OVERHEAD = 18
 
 '''
 we could have it seeded with X number of "internal" machines and Y number of
@@ -51,31 +99,127 @@ def get_random_ip(first=0,second=0,third=0,fourth=0):
     return (first << 24) | (second << 16) | (third << 8) | fourth
 
 
-def initialize_hosts(internal_count=50, external_count=500):
+class HostTable(object):
+    """
+    Compact table of hosts stored as one contiguous (n, 6) array of MAC
+    address bytes and one array of uint32 IP addresses, which keeps the cost
+    per host at 10 bytes no matter how many hosts are simulated.
+    """
+    __slots__ = ('macs', 'ips')
+
+    def __init__(self, macs=None, ips=None):
+        if macs is None:
+            macs = np.empty((0, 6), dtype=np.uint8)
+        if ips is None:
+            ips = np.empty(0, dtype=np.uint32)
+        self.macs = macs
+        self.ips = ips
+
+    def __len__(self):
+        return len(self.ips)
+
+    def mac(self, ndx):
+        return self.macs[ndx].tobytes()
+
+    def ip(self, ndx):
+        return int(self.ips[ndx])
+
+    def sample(self, count, rng=np.random):
+        """Picks count host indices uniformly at random"""
+        return random_integers(rng, 0, len(self.ips), count)
+
+
+def get_batch_rngs(seed, file_number):
+    """Yields the random stream of every batch of a file, in order"""
+    batch_number = 0
+    while True:
+        yield get_rng(seed, FILE_STREAM, file_number, batch_number)
+        batch_number += 1
+
+
+def create_host_table(count, first=0, second=0, rng=np.random):
+    """
+    Vectorized equivalent of calling get_random_mac and get_random_ip count
+    times. Octets left as 0 are picked at random, the first from [1,255] and
+    the rest from [0,255].
+    """
+    macs = random_integers(rng, 0, 256, (count, 6)).astype(np.uint8)
+
+    octets = random_integers(rng, 0, 256, (count, 4)).astype(np.uint32)
+    if first > 0:
+        octets[:, 0] = first
+    else:
+        octets[:, 0] = random_integers(rng, 1, 256, count)
+    if second > 0:
+        octets[:, 1] = second
+    ips = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+
+    return HostTable(macs=macs, ips=ips)
+
+
+def initialize_hosts(internal_count=50, external_count=500, rng=np.random,
+                     host_skew=0.0, sticky_share=0.0,
+                     conversations=hostmodel.CONVERSATIONS):
+    """
+    Creates the host tables and, when host_skew or sticky_share is set, the
+    model picking hosts from them (see hostmodel.HostPairs)
+    """
     logging.info("Creating {} internal hosts".format(internal_count))
     logging.info("Creating {} external hosts".format(external_count))
     global INTERNAL_HOSTS
     global EXTERNAL_HOSTS
+    global HOST_PAIRS
+
+    INTERNAL_HOSTS = create_host_table(internal_count, first=192, second=168, rng=rng)
+    EXTERNAL_HOSTS = create_host_table(external_count, rng=rng)
+    HOST_PAIRS = None
+    if host_skew > 0 or sticky_share > 0:
+        HOST_PAIRS = hostmodel.HostPairs(internal_count, external_count,
+                                         exponent=host_skew,
+                                         sticky_share=sticky_share,
+                                         conversations=conversations, rng=rng)
 
-    for i in range(0, internal_count-1):
-        mac = get_random_mac()
-        ip = get_random_ip(first=192, second=168)
+    build_header_templates()
 
-        host = {
-            "mac" : mac,
-            "ip" : ip    
-        }
-        INTERNAL_HOSTS.append(host)
 
-    for i in range(0, external_count-1):
-        mac = get_random_mac()
-        ip = get_random_ip()
+def restore_hosts(hosts):
+    """
+    Puts back the host tables recorded in a manifest (see manifest.Manifest)
+    when they differ from the ones just created from the seed
+    """
+    global INTERNAL_HOSTS
+    global EXTERNAL_HOSTS
+    if (np.array_equal(INTERNAL_HOSTS.ips, hosts['internal_ips']) and
+            np.array_equal(INTERNAL_HOSTS.macs, hosts['internal_macs']) and
+            np.array_equal(EXTERNAL_HOSTS.ips, hosts['external_ips']) and
+            np.array_equal(EXTERNAL_HOSTS.macs, hosts['external_macs'])):
+        return
+    logging.warning("Host tables differ from the ones recorded, using the recorded ones")
+    INTERNAL_HOSTS = HostTable(macs=hosts['internal_macs'], ips=hosts['internal_ips'])
+    EXTERNAL_HOSTS = HostTable(macs=hosts['external_macs'], ips=hosts['external_ips'])
+    build_header_templates()
+
+
+def build_header_templates(max_bytes=TEMPLATE_CACHE_SIZE):
+    """
+    (Re)builds the header template cache for the current host tables. When
+    every host pair fits under max_bytes the cache is filled up front,
+    otherwise templates are packed on first use and evicted least recently
+    used first.
+    """
+    global HEADER_TEMPLATES
+    HEADER_TEMPLATES = HeaderTemplateCache(max_bytes=max_bytes)
 
-        host = {
-            "mac" : mac,
-            "ip" : ip    
-        }
-        EXTERNAL_HOSTS.append(host)
+    pair_count = 2 * len(INTERNAL_HOSTS) * len(EXTERNAL_HOSTS)
+    if pair_count > HEADER_TEMPLATES.max_entries:
+        logging.info("{0} host pairs exceed the template cache, "
+                     "packing templates on demand".format(pair_count))
+        return
+
+    for internal_ndx in range(0, len(INTERNAL_HOSTS)):
+        for external_ndx in range(0, len(EXTERNAL_HOSTS)):
+            HEADER_TEMPLATES.get(1, internal_ndx, external_ndx)
+            HEADER_TEMPLATES.get(0, external_ndx, internal_ndx)
 
 
 # Notes:
@@ -85,9 +229,9 @@ def initialize_hosts(internal_count=50, external_count=500):
 # H == uint16 (short)
 # B == uint8 (char)
 
-def create_global_header():
+def create_global_header(nanosecond=False):
     return struct.pack('IHHiIII',
-        0xa1b2c3d4,         # pcap magic number
+        0xa1b23c4d if nanosecond else 0xa1b2c3d4,   # pcap magic number
         2,                  # major version number
         4,                  # minor version number
         0,                  # GMT to local correction
@@ -96,18 +240,49 @@ def create_global_header():
         1                   # data link type
     )
 
+def create_file_header(output_format='pcap'):
+    """
+    Everything written in front of the packets of a file: the pcap global
+    header ('pcap' or, with nanosecond timestamps, 'pcap-ns'), or a pcapng
+    section header and interface description
+    """
+    if output_format == 'pcapng':
+        return pcapng.create_file_header(link_type=1, snaplen=65535)
+    return create_global_header(nanosecond=output_format == 'pcap-ns')
+
+
+def get_ticks(output_format='pcap'):
+    """Timestamp resolution of an output format, in ticks per second"""
+    if output_format == 'pcap':
+        return 1000000
+    return 1000000000
+
+
+def get_file_name(file_name, output_format='pcap'):
+    """file_name with the extension of the output format"""
+    if output_format != 'pcapng':
+        return file_name
+    if file_name.endswith('.pcap'):
+        return file_name + 'ng'
+    return file_name + '.pcapng'
+
 def get_start_time():
     start = time.strptime(START_TIME)
     return time.mktime(start)
 
-def create_packet_header(start_time=get_start_time(), offset_ms=0, included_length=62, original_length=62):
+PACKET_HEADER = struct.Struct('IIII')
+RECORD_TIMESTAMP = struct.Struct('II')
+
+def create_packet_header(start_time=None, offset_ms=0, included_length=62, original_length=62):
     """
     ts_sec: the date and time when this packet was captured. This value is in seconds since January 1, 1970 00:00:00 GMT; this is also known as a UN*X time_t. You can use the ANSI C time() function from time.h to get this value, but you might use a more optimized way to get this timestamp value. If this timestamp isn't based on GMT (UTC), use thiszone from the global header for adjustments.
     ts_usec: in regular pcap files, the microseconds when this packet was captured, as an offset to ts_sec. In nanosecond-resolution files, this is, instead, the nanoseconds when the packet was captured, as an offset to ts_sec /!\ Beware: this value shouldn't reach 1 second (in regular pcap files 1 000 000; in nanosecond-resolution files, 1 000 000 000); in this case ts_sec must be increased instead!
     incl_len: the number of bytes of packet data actually captured and saved in the file. This value should never become larger than orig_len or the snaplen value of the global header.
     orig_len: the length of the packet as it appeared on the network when it was captured. If incl_len and orig_len differ, the actually saved packet size was limited by snaplen.
     """
-    return struct.pack('IIII',
+    if start_time is None:
+        start_time = get_start_time()
+    return PACKET_HEADER.pack(
                        start_time,      # timestamp seconds
                        offset_ms,       # timestamp microseconds
                        included_length, # number of octets of packet saved in file (Included Bytes)
@@ -117,11 +292,11 @@ def create_packet_header(start_time=get_start_time(), offset_ms=0, included_leng
 
 def build_ethernet_frame(internal_as_source, source_ndx, destination_ndx, link_type=0x0008):
     if internal_as_source:
-        destination_mac =  EXTERNAL_HOSTS[destination_ndx]['mac']
-        source_mac =  INTERNAL_HOSTS[source_ndx]['mac']
+        destination_mac =  EXTERNAL_HOSTS.mac(destination_ndx)
+        source_mac =  INTERNAL_HOSTS.mac(source_ndx)
     else:
-        destination_mac =  INTERNAL_HOSTS[destination_ndx]['mac']
-        source_mac =  EXTERNAL_HOSTS[source_ndx]['mac']
+        destination_mac =  INTERNAL_HOSTS.mac(destination_ndx)
+        source_mac =  EXTERNAL_HOSTS.mac(source_ndx)
 
     link_type_struct = struct.pack('H', link_type)
 
@@ -129,11 +304,11 @@ def build_ethernet_frame(internal_as_source, source_ndx, destination_ndx, link_t
 
 def build_ipv4_datagram(internal_as_source, source_ndx, destination_ndx):
     if internal_as_source:
-        dest_ip =  EXTERNAL_HOSTS[destination_ndx]['ip']
-        source_ip =  INTERNAL_HOSTS[source_ndx]['ip']
+        dest_ip =  EXTERNAL_HOSTS.ip(destination_ndx)
+        source_ip =  INTERNAL_HOSTS.ip(source_ndx)
     else:
-        dest_ip =  INTERNAL_HOSTS[destination_ndx]['ip']
-        source_ip =  EXTERNAL_HOSTS[source_ndx]['ip']
+        dest_ip =  INTERNAL_HOSTS.ip(destination_ndx)
+        source_ip =  EXTERNAL_HOSTS.ip(source_ndx)
 
     # set up sub-byte values
     version = 4         # IP v4 (version) 0100....
@@ -196,31 +371,155 @@ def build_tcp_segment():
                        )
 
 
-def create_packet(start_time=get_start_time(), offset_ms=0):
+# the tcp segment never changes, so it only needs to be packed once
+TCP_SEGMENT = build_tcp_segment()
 
-    # build the PCAP file packet header
-    packet_header = create_packet_header(start_time=start_time, offset_ms = offset_ms)
+# rough cost of one cached template: the 34 bytes of headers plus the bytes
+# object, key tuple and dictionary entry that hold it
+TEMPLATE_ENTRY_SIZE = 256
 
-    # randomly pick source and destination
+
+class HeaderTemplateCache(object):
+    """
+    Bounded cache of pre-packed ethernet frame + ipv4 datagram prefixes keyed
+    by (internal_as_source, source_ndx, destination_ndx). Once max_bytes worth
+    of templates are held, the least recently used one is evicted.
+    """
+
+    def __init__(self, max_bytes=TEMPLATE_CACHE_SIZE):
+        self.max_entries = max(1, max_bytes // TEMPLATE_ENTRY_SIZE)
+        self.misses = 0
+        self._templates = OrderedDict()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def get(self, internal_as_source, source_ndx, destination_ndx):
+        key = (internal_as_source, source_ndx, destination_ndx)
+        templates = self._templates
+        template = templates.get(key)
+        if template is not None:
+            templates.move_to_end(key)
+            return template
+
+        self.misses += 1
+        template = b"".join([
+            build_ethernet_frame(internal_as_source, source_ndx, destination_ndx),
+            build_ipv4_datagram(internal_as_source, source_ndx, destination_ndx)])
+        if len(templates) >= self.max_entries:
+            templates.popitem(last=False)
+        templates[key] = template
+        return template
+
+
+def pick_hosts():
+    """
+    Randomly picks the direction of a packet and its source and destination
+    host, from HOST_PAIRS when set
+    """
     internal_as_source = randint(0,1)
+    if HOST_PAIRS is not None:
+        internal_ndx, external_ndx = HOST_PAIRS.pick(random.random)
+        if internal_as_source:
+            return internal_as_source, internal_ndx, external_ndx
+        return internal_as_source, external_ndx, internal_ndx
+
     if internal_as_source:
         source_ndx = randint(0,len(INTERNAL_HOSTS) - 1)      
         destination_ndx = randint(0,len(EXTERNAL_HOSTS) - 1)
     else:
         source_ndx = randint(0,len(EXTERNAL_HOSTS) - 1)      
         destination_ndx = randint(0,len(INTERNAL_HOSTS) - 1)
-    
-    # build the ethernet frame (L2)
-    ethernet_frame = build_ethernet_frame(internal_as_source, source_ndx, destination_ndx)
-    
-    # build the ipv4 datagram (L3)
-    ipv4_datagram = build_ipv4_datagram(internal_as_source, source_ndx, destination_ndx)
+    return internal_as_source, source_ndx, destination_ndx
+
 
-    # build the tcp_segment (L4)
-    tcp_segment = build_tcp_segment()
+def create_packet(start_time=None, offset_ms=0):
+    if start_time is None:
+        start_time = get_start_time()
+
+    # build the PCAP file packet header
+    packet_header = PACKET_HEADER.pack(start_time, offset_ms, 62, 62)
+
+    # randomly pick source and destination
+    internal_as_source, source_ndx, destination_ndx = pick_hosts()
+    
+    # splice the pre-packed ethernet frame (L2) and ipv4 datagram (L3) with
+    # the constant tcp segment (L4)
+    template = HEADER_TEMPLATES.get(internal_as_source, source_ndx, destination_ndx)
 
     # join and return the file
-    return b"".join([packet_header, ethernet_frame, ipv4_datagram, tcp_segment])
+    return b"".join([packet_header, template, TCP_SEGMENT])
+
+
+def create_timed_packet(start_time, offset_ms, stats):
+    """create_packet, charging the time of each step to a stage of stats"""
+    packet_header = PACKET_HEADER.pack(start_time, offset_ms, 62, 62)
+    stats.lap('header')
+
+    internal_as_source, source_ndx, destination_ndx = pick_hosts()
+    template = HEADER_TEMPLATES.get(internal_as_source, source_ndx, destination_ndx)
+    stats.lap('hosts')
+
+    packet = b"".join([packet_header, template, TCP_SEGMENT])
+    stats.lap('join')
+    return packet
+
+
+# Fixed 78-byte layout of a record produced by create_packet. The pcap header
+# and ether type are packed in native order (as struct does above), while the
+# IP fields are in network order. The TCP segment never changes so it is kept
+# as an opaque block of bytes.
+PACKET_DTYPE = np.dtype([
+    ('ts_sec', '=u4'),
+    ('ts_usec', '=u4'),
+    ('included_length', '=u4'),
+    ('original_length', '=u4'),
+    ('destination_mac', 'u1', (6,)),
+    ('source_mac', 'u1', (6,)),
+    ('link_type', '=u2'),
+    ('ip_header', 'u1', (12,)),
+    ('source_ip', '>u4'),
+    ('destination_ip', '>u4'),
+    ('tcp_segment', 'u1', (28,)),
+])
+
+
+def create_packet_batch(ts_sec, ts_usec, rng=np.random):
+    """
+    Vectorized version of create_packet. Builds one record per timestamp in a
+    single structured array (see PACKET_DTYPE) whose bytes are laid out exactly
+    like the output of create_packet.
+    """
+    count = len(ts_sec)
+
+    # start every record from the constant parts of a packet, then fill in
+    # the fields that vary from packet to packet
+    template = np.frombuffer(create_packet(0, 0), dtype=PACKET_DTYPE)
+    records = np.empty(count, dtype=PACKET_DTYPE)
+    records[:] = template[0]
+    records['ts_sec'] = ts_sec
+    records['ts_usec'] = ts_usec
+
+    # randomly pick source and destination
+    internal_as_source = rng.random(count) < 0.5
+    if HOST_PAIRS is not None:
+        internal_ndx, external_ndx = HOST_PAIRS.sample(count, rng)
+    else:
+        internal_ndx = INTERNAL_HOSTS.sample(count, rng)
+        external_ndx = EXTERNAL_HOSTS.sample(count, rng)
+
+    internal_mac = INTERNAL_HOSTS.macs[internal_ndx]
+    external_mac = EXTERNAL_HOSTS.macs[external_ndx]
+    outbound = internal_as_source[:, np.newaxis]
+    records['source_mac'] = np.where(outbound, internal_mac, external_mac)
+    records['destination_mac'] = np.where(outbound, external_mac, internal_mac)
+
+    internal_ip = INTERNAL_HOSTS.ips[internal_ndx]
+    external_ip = EXTERNAL_HOSTS.ips[external_ndx]
+    records['source_ip'] = np.where(internal_as_source, internal_ip, external_ip)
+    records['destination_ip'] = np.where(internal_as_source, external_ip, internal_ip)
+
+    return records
 
 
 def write_pcap(bytes_data, file_name=OUTPUT_FILE):
@@ -228,33 +527,181 @@ def write_pcap(bytes_data, file_name=OUTPUT_FILE):
         pcap_file.write(bytes_data)
 
 
+class PcapWriter(object):
+    """
+    Streams packet data to disk in bounded chunks. Packets are collected in a
+    small buffer which is joined and written out whenever it grows past
+    buffer_size, so memory use stays flat no matter how large the file gets.
+
+    output_format tells the writer how to read the timestamps of what it is
+    given for the index: pcap records at microsecond or nanosecond resolution,
+    or pcapng blocks.
+    """
+
+    def __init__(self, file_name=OUTPUT_FILE, buffer_size=WRITE_BUFFER_SIZE,
+                 header=None, index_file=None, compress=None, compress_threads=None,
+                 output_format='pcap'):
+        self.file_name = file_name
+        self.output_format = output_format
+        self.ticks = get_ticks(output_format)
+        self.buffer_size = buffer_size
+        self.bytes_written = 0
+        self._buffer = []
+        self._buffered = 0
+        # with compression, positions and bytes_written count uncompressed bytes
+        self._file = compression.open_compressed(file_name, compress,
+                                                 threads=compress_threads)
+        if header is not None:
+            self._file.write(header)
+            self.bytes_written += len(header)
+
+        # every record written from here on is indexed at the offset it lands
+        self._index = None
+        if index_file is not None:
+            self._index = pcapindex.IndexWriter(index_file)
+
+    @property
+    def position(self):
+        """Offset in the file at which the next write will land"""
+        return self.bytes_written + self._buffered
+
+    def write(self, data):
+        """Writes one packet record (packet header included) or pcapng block"""
+        if self._index is not None:
+            if self.output_format == 'pcapng':
+                high, low = RECORD_TIMESTAMP.unpack_from(data, 12)
+                timestamp = (high << 32) | low
+            else:
+                ts_sec, ts_usec = RECORD_TIMESTAMP.unpack_from(data)
+                timestamp = ts_sec * 1000000000 + ts_usec * (1000000000 // self.ticks)
+            self._index.add(timestamp, self.position)
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def write_batch(self, batch):
+        """
+        Writes a whole PacketBatch (or array of PACKET_DTYPE records) straight
+        to disk without copying it into the buffer
+        """
+        if not isinstance(batch, PacketBatch):
+            batch = PacketBatch.from_records(batch)
+
+        self.flush()
+        if self._index is not None:
+            offsets = batch.offsets[:-1].astype(np.uint64) + self.position
+            timestamps = (batch.ts_sec.astype(np.uint64) * 1000000000 +
+                          batch.ts_usec.astype(np.uint64) * (1000000000 // self.ticks))
+            self._index.add_batch(timestamps, offsets)
+
+        self._file.write(batch.view())
+        self.bytes_written += batch.nbytes
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self.bytes_written += self._buffered
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 # set max size to 300M (or 300,000,00)
-def create_pcap_file(start_time=get_start_time(), duration=90, 
-                     max_size=300000000, file_name=OUTPUT_FILE):
+def create_pcap_file(start_time=None, duration=90, 
+                     max_size=300000000, file_name=OUTPUT_FILE,
+                     buffer_size=WRITE_BUFFER_SIZE, engine='packet',
+                     batch_size=BATCH_SIZE, index=False, arrivals='jitter',
+                     protocol_mix=None, stats=None, rng=np.random,
+                     batch_rngs=None, compress=None, compress_threads=None,
+                     output_format='pcap', packet_pool=None):
+    """
+    rng drives everything that carries state from one batch to the next
+    (timestamps, connections), while the packets of the batch engine are
+    drawn from batch_rngs, an iterator of one random stream per batch, when
+    given. The per-packet engine uses the random module.
+
+    With compress the file is compressed with that codec (see compression.py)
+    and gets its extension; max_size still counts uncompressed bytes.
+    output_format is one of OUTPUT_FORMATS, pcapng files get a .pcapng
+    extension. The amplify engine re-emits packet_pool (an
+    amplify.PacketPool). Returns the name of the file written.
+    """
+    if start_time is None:
+        start_time = get_start_time()
+    file_name = get_file_name(file_name, output_format)
+    if compress is not None:
+        file_name += compression.EXTENSIONS[compress]
     logging.info("Creating a {0} second file named {1}".format(duration, file_name))
-    file_data = []
 
     # calculate total # of packets
-    size_file_header = 24
-    size_packet_plus_header = 78
-    num_packets = (max_size - size_file_header)/size_packet_plus_header
+    source = get_packet_source(engine, protocol_mix, rng, packet_pool)
+    num_packets = get_packet_count(max_size, get_record_size(source, output_format))
 
     # initialize the offsets
     start = int(start_time)
     # subtracting one from the end is important to ensure the random slide of
     # the offset doesn't put us over the time boundary
     end = int(start + duration) -1
-    offset = 0
 
-    global_header = create_global_header()
-    file_data.append(global_header)
+    index_file = pcapindex.index_path(file_name) if index else None
+    with PcapWriter(file_name=file_name, buffer_size=buffer_size,
+                    header=create_file_header(output_format),
+                    index_file=index_file, compress=compress,
+                    compress_threads=compress_threads,
+                    output_format=output_format) as writer:
+
+        if engine != 'packet' or arrivals != 'jitter' or output_format != 'pcap':
+            timestamps = get_timestamps(start_time, duration, num_packets,
+                                        arrivals, batch_size, rng,
+                                        ticks=get_ticks(output_format))
+            write_packet_batches(writer, timestamps, source, max_size, engine,
+                                 stats=stats, batch_rngs=batch_rngs, rng=rng,
+                                 output_format=output_format)
+        else:
+            write_packets(writer, start, end, num_packets, stats=stats)
+
+    if stats is not None:
+        stats.report()
+    return file_name
+
+
+def write_packets(writer, start, end, num_packets, stats=None):
+    """
+    The original generation loop: writes num_packets-1 packets one
+    create_packet call at a time, spaced out with random jitter
+    """
+    offset = 0
+    if stats is not None:
+        stats.start_lap()
 
     for i in range(0, num_packets-1):
         if i % 100000 == 0:
             logging.info("Creating Packet: {0}".format(i))
 
-        packet_data = create_packet(start, offset)
-        file_data.append(packet_data)
+        if stats is None:
+            packet_data = create_packet(start, offset)
+            writer.write(packet_data)
+        else:
+            packet_data = create_timed_packet(start, offset, stats)
+            writer.write(packet_data)
+            stats.lap('write')
+            stats.count(1, len(packet_data))
 
         # set up the counters for the next loop
         # start by calculating the straight-line average inter-packet time given
@@ -270,7 +717,383 @@ def create_pcap_file(start_time=get_start_time(), duration=90,
             start += 1
             offset -= 1000000
 
-    write_pcap(b"".join(file_data), file_name = file_name)
+        if stats is not None:
+            stats.lap('timing')
+
+
+def get_packet_count(max_size, size_packet_plus_header=78):
+    """
+    Number of packets that fit in a file of max_size bytes, given the
+    (expected) size of a record
+    """
+    size_file_header = 24
+    return int((max_size - size_file_header) // size_packet_plus_header)
+
+
+def get_packet_source(engine='batch', protocol_mix=None, rng=np.random,
+                      packet_pool=None):
+    """
+    Returns the object building the packets of the flows, mixed and amplify
+    engines (anything with create_batch(ts_sec, ts_usec) and
+    mean_record_size()), or None for the engines writing fixed-size SYN
+    packets
+    """
+    if engine == 'flows':
+        return flows.FlowTable(INTERNAL_HOSTS, EXTERNAL_HOSTS, rng=rng,
+                               host_pairs=HOST_PAIRS)
+    if engine == 'mixed':
+        return protocols.ProtocolMix(INTERNAL_HOSTS, EXTERNAL_HOSTS,
+                                     weights=protocol_mix, rng=rng,
+                                     host_pairs=HOST_PAIRS)
+    if engine == 'amplify':
+        return amplify.Amplifier(packet_pool, INTERNAL_HOSTS, EXTERNAL_HOSTS, rng=rng,
+                                 host_pairs=HOST_PAIRS)
+    return None
+
+
+def get_record_size(source, output_format='pcap'):
+    """Expected size of a record written with the given packet source"""
+    size = 78 if source is None else source.mean_record_size()
+    if output_format == 'pcapng':
+        size += PCAPNG_OVERHEAD
+    return size
+
+
+def get_timestamps(start_time, duration, num_packets, arrivals='jitter',
+                   batch_size=BATCH_SIZE, rng=np.random, ticks=1000000):
+    """
+    Returns an iterator of (ts_sec, ts_usec) arrays for the packets of one
+    file, following the requested arrival model, with the sub-second part
+    counting ticks (1e6 or 1e9) per second
+    """
+    if arrivals == 'jitter':
+        start = int(start_time)
+        return get_timestamp_batches(start, int(start + duration) -1,
+                                     num_packets, batch_size, rng, ticks=ticks)
+
+    process = trafficmodel.ArrivalProcess(
+        start_time, duration, num_packets-1,
+        process='even' if arrivals == 'diurnal' else 'poisson',
+        bursty=arrivals == 'bursty',
+        rng=rng)
+    return process.batches(batch_size, ticks=ticks)
+
+
+def get_timestamp_batches(start, end, num_packets, batch_size=BATCH_SIZE,
+                          rng=np.random, ticks=1000000):
+    """
+    Vectorized version of the timestamps made by the per-packet loop in
+    create_pcap_file, except that the straight-line inter-packet time is
+    re-evaluated once per batch rather than once per packet. Yields
+    (ts_sec, ts_usec) arrays, ts_usec counting ticks per second.
+    """
+    first = start
+    elapsed = 0     # ticks since the first packet
+    i = 0
+    while i < num_packets-1:
+        count = min(batch_size, num_packets-1-i)
+
+        start = first + elapsed // ticks
+        inter_packet_timing = int(((end-start) / float(num_packets-i))*ticks)
+        gaps = random_integers(rng, 0, max(inter_packet_timing, 0) + 1, count)
+
+        # each packet is offset by the sum of the gaps before it
+        offsets = np.empty(count, dtype=np.int64)
+        offsets[0] = elapsed
+        np.cumsum(gaps[:-1], out=offsets[1:])
+        offsets[1:] += elapsed
+        elapsed = int(offsets[-1] + gaps[-1])
+
+        yield first + offsets // ticks, offsets % ticks
+        i += count
+
+
+def write_packet_batches(writer, timestamps, source=None, max_size=None,
+                         engine='batch', stats=None, batch_rngs=None,
+                         rng=np.random, output_format='pcap'):
+    """
+    Writes one packet per timestamp from an iterable of (ts_sec, ts_usec)
+    arrays, built by source (see get_packet_source), the batch engine or one
+    create_packet call at a time. When packet sizes vary the packet count is
+    only an estimate, so writing stops at the last record that fits in
+    max_size bytes.
+    """
+    written = 0
+    if stats is not None:
+        stats.start_lap()
+
+    if engine == 'packet' and source is None:
+        for ts_sec, ts_usec in timestamps:
+            logging.info("Creating Packet: {0}".format(written))
+            if stats is not None:
+                stats.lap('timing')
+            for sec, usec in zip(ts_sec.tolist(), ts_usec.tolist()):
+                if stats is None:
+                    packet_data = create_packet(sec, usec)
+                else:
+                    packet_data = create_timed_packet(sec, usec, stats)
+                if output_format == 'pcapng':
+                    packet_data = pcapng.enhanced_packet_block(packet_data)
+                writer.write(packet_data)
+                if stats is not None:
+                    stats.lap('write')
+                    stats.count(1, len(packet_data))
+            written += len(ts_sec)
+        return
+
+    for batch in generate_packet_batches(timestamps, source, stats=stats,
+                                         batch_rngs=batch_rngs, rng=rng,
+                                         output_format=output_format):
+        logging.info("Creating Packet: {0}".format(written))
+        full = max_size is not None and writer.position + batch.nbytes > max_size
+        if full:
+            fits = int(np.searchsorted(batch.offsets, max_size - writer.position,
+                                       side='right')) - 1
+            batch = batch.head(fits)
+        writer.write_batch(batch)
+        written += len(batch)
+        if stats is not None:
+            stats.lap('write')
+            stats.count(len(batch), batch.nbytes)
+        if full:
+            return
+
+
+def generate_packet_batches(timestamps, source=None, stats=None,
+                            batch_rngs=None, rng=np.random, output_format='pcap'):
+    """
+    Yields one batch of packets per (ts_sec, ts_usec) pair of arrays in
+    timestamps, built by source (see get_packet_source) or by the batch
+    engine, drawing each batch from the next of batch_rngs if given. For
+    pcapng the batches hold Enhanced Packet Blocks rather than pcap records.
+    """
+    for ts_sec, ts_usec in timestamps:
+        if stats is not None:
+            stats.lap('timing')
+        if source is not None:
+            batch = source.create_batch(ts_sec, ts_usec)
+        else:
+            batch_rng = next(batch_rngs) if batch_rngs is not None else rng
+            batch = create_packet_batch(ts_sec, ts_usec, batch_rng)
+        if stats is not None:
+            stats.lap('build')
+        if output_format == 'pcapng':
+            batch = pcapng.enhanced_packet_blocks(batch)
+            if stats is not None:
+                stats.lap('encode')
+        yield batch
+
+
+def generate_scheduled_batches(schedule, max_size=300000000, engine='batch',
+                               arrivals='jitter', batch_size=BATCH_SIZE,
+                               protocol_mix=None, seed=None, output_format='pcap',
+                               packet_pool=None):
+    """
+    Yields the packets of every file in the schedule, back to back, as
+    batches of packet records. With the same seed the packets are the same
+    as in the files create_scheduled_files would write.
+    """
+    for file_number, (start_time, duration, file_name) in enumerate(schedule):
+        logging.info("Streaming {0} seconds of packets starting at {1}".format(
+            duration, time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime(start_time))))
+        rng = get_rng(seed, FILE_STREAM, file_number)
+        source = get_packet_source(engine, protocol_mix, rng, packet_pool)
+        num_packets = get_packet_count(max_size, get_record_size(source, output_format))
+        timestamps = get_timestamps(start_time, duration, num_packets,
+                                    arrivals, batch_size, rng,
+                                    ticks=get_ticks(output_format))
+        for batch in generate_packet_batches(timestamps, source, rng=rng,
+                                             batch_rngs=get_batch_rngs(seed, file_number),
+                                             output_format=output_format):
+            yield batch
+
+
+def create_rotating_capture(schedule, pattern, max_bytes=None, max_packets=None,
+                            seconds=None, index=False, compress=None,
+                            compress_threads=None, output_format='pcap', **options):
+    """
+    Generates the packets of every file in the schedule as one continuous
+    capture, rotated into files by size, packet count and/or time (see
+    rotation.RotatingWriter). Any other keyword arguments are passed through
+    to generate_scheduled_batches.
+    """
+    def open_writer(file_name):
+        index_file = pcapindex.index_path(file_name) if index else None
+        return PcapWriter(file_name=file_name, header=create_file_header(output_format),
+                          index_file=index_file, compress=compress,
+                          compress_threads=compress_threads,
+                          output_format=output_format)
+
+    pattern = get_file_name(pattern, output_format)
+    if compress is not None:
+        pattern += compression.EXTENSIONS[compress]
+
+    with rotation.RotatingWriter(pattern, open_writer, max_bytes=max_bytes,
+                                 max_packets=max_packets, seconds=seconds) as writer:
+        for batch in generate_scheduled_batches(schedule, output_format=output_format,
+                                                **options):
+            writer.write(batch)
+    logging.info("Wrote {0} files".format(len(writer.files)))
+    return writer.files
+
+
+def parse_protocol_mix(value):
+    try:
+        return protocols.parse_mix(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def plan_schedule(start_time, file_count=1, min_duration=60, max_duration=120,
+                  rng=np.random):
+    """
+    Works out the (start_time, duration, file_name) of every file up front.
+    Each file starts where the previous one ended, so the whole schedule only
+    depends on the durations returned by the traffic model.
+    """
+    if file_count == 1:
+        duration = int(random_integers(rng, min_duration, max_duration + 1, 1)[0])
+        return [(start_time, duration, 'generated_0000.pcap')]
+
+    schedule = []
+    for i in range(0, file_count):
+        file_name = 'generated_{0:06d}.pcap'.format(i)
+
+        # use the model to generate
+        next_time = time.localtime(start_time)
+
+        # get is weekend (Mon = 0, Sun = 6)
+        is_weekend = next_time.tm_wday > 4
+
+        # get float of hour (military time)
+        decimal_hour = next_time.tm_hour
+        mins = next_time.tm_min + (next_time.tm_sec / float(60))
+        decimal_hour += mins/60
+
+        # get result, round, and convert to int
+        duration = trafficmodel.get_duration_scalar(decimal_hour, is_weekend)
+        duration = int(round(duration*480))
+        logging.info("{0} - {1} - {2} - {3}".format(
+            time.strftime("%a, %d %b %Y %H:%M:%S", next_time), 
+            duration, decimal_hour, is_weekend))
+
+        schedule.append((start_time, duration, file_name))
+
+        # set the start time for the next iteration
+        start_time = start_time + duration
+
+    return schedule
+
+
+def init_worker(internal_hosts, external_hosts, metrics_options=None, host_pairs=None):
+    """
+    Pool initializer which hands the parent's host tables (and host model) to
+    each worker so that every file is generated against the same set of hosts
+    """
+    global INTERNAL_HOSTS
+    global EXTERNAL_HOSTS
+    global HOST_PAIRS
+    global STATS
+    INTERNAL_HOSTS = internal_hosts
+    EXTERNAL_HOSTS = external_hosts
+    HOST_PAIRS = host_pairs
+    build_header_templates()
+    if metrics_options is not None:
+        STATS = metrics.create_stats('generator', per_process=True, **metrics_options)
+
+
+def create_scheduled_file(task):
+    """
+    Generates one file of the schedule. Returns the file number and, with
+    checksum set, the (name, size, sha256) of every file written for it.
+    """
+    start_time, duration, file_name, seed, file_number, checksum, options = task
+
+    # every file gets its own RNG streams so the output does not depend on
+    # which worker picked it up or in what order
+    rng = get_rng(seed, FILE_STREAM, file_number)
+    random.seed(rng.bytes(16))
+
+    file_name = create_pcap_file(start_time=start_time,
+                                 duration=duration,
+                                 file_name=file_name,
+                                 stats=STATS,
+                                 rng=rng,
+                                 batch_rngs=get_batch_rngs(seed, file_number),
+                                 **options)
+    logging.info("Finished {0}".format(file_name))
+
+    outputs = []
+    if checksum:
+        names = [file_name]
+        if options.get('index'):
+            names.append(pcapindex.index_path(file_name))
+        # hashed here, while the file is still in the page cache
+        outputs = [(name,) + manifest.file_digest(name) for name in names]
+    return file_number, outputs
+
+
+def create_scheduled_files(schedule, workers=1, seed=None, metrics_options=None,
+                           checkpoint=None, **options):
+    """
+    Generates every file in the schedule, either one after another or spread
+    across a pool of worker processes. File N is drawn from the random
+    streams of seed and N only, so the output is the same either way.
+    metrics_options are the keyword arguments of metrics.create_stats, or
+    None to skip instrumentation. With a checkpoint (a manifest.Manifest),
+    files it records as complete and which are still intact are skipped,
+    and every file finished is recorded in it. Any other keyword arguments
+    are passed through to create_pcap_file.
+    """
+    global STATS
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    tasks = [(start_time, duration, file_name, seed, file_number,
+              checkpoint is not None, options)
+             for file_number, (start_time, duration, file_name) in enumerate(schedule)]
+
+    if checkpoint is not None:
+        pending = [task for task in tasks if not checkpoint.is_complete(task[4])]
+        if len(pending) < len(tasks):
+            logging.info("Skipping {0} complete files, {1} left to generate".format(
+                len(tasks) - len(pending), len(pending)))
+        tasks = pending
+
+    def finished(result):
+        file_number, outputs = result
+        if checkpoint is not None:
+            checkpoint.add_file(file_number, outputs)
+
+    if workers <= 1:
+        if metrics_options is not None:
+            STATS = metrics.create_stats('generator', **metrics_options)
+        for task in tasks:
+            finished(create_scheduled_file(task))
+        return
+
+    # the parent only tracks the queue of files, the workers report the
+    # packet rates, each to its own file
+    stats = None
+    if metrics_options is not None:
+        stats = metrics.create_stats('scheduler', **metrics_options)
+
+    logging.info("Generating {0} files with {1} workers".format(len(tasks), workers))
+    pool = multiprocessing.Pool(processes=workers,
+                                initializer=init_worker,
+                                initargs=(INTERNAL_HOSTS, EXTERNAL_HOSTS,
+                                          metrics_options, HOST_PAIRS))
+    try:
+        done = 0
+        for result in pool.imap(create_scheduled_file, tasks):
+            finished(result)
+            done += 1
+            if stats is not None:
+                stats.gauge('files_pending', len(tasks) - done)
+                stats.gauge('files_done', done)
+                stats.report()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def main():
@@ -298,6 +1121,144 @@ def main():
         help="Number of files to generate. (default: %(default)s)",
         default=1)
 
+    parser.add_argument("--engine",
+        help="Packet synthesis engine: 'packet' builds one SYN at a time, "
+             "'batch' builds them vectorized in batches, 'flows' simulates "
+             "whole TCP connections with valid checksums, 'mixed' adds UDP, "
+             "DNS, ICMP and IPv6 traffic to those (see --protocol-mix) and "
+             "'amplify' re-emits the packets of --seed-capture between the "
+             "generated hosts. (default: %(default)s)",
+        choices=ENGINES,
+        default='packet')
+
+    parser.add_argument("--host-skew",
+        help="Zipf exponent of host popularity: the host of rank k is picked "
+             "in proportion to 1/k**skew, 0 picks hosts uniformly. "
+             "(default: %(default)s)",
+        type=float,
+        default=0.0)
+
+    parser.add_argument("--sticky-share",
+        help="Share of packets (or connections) belonging to a fixed set of "
+             "recurring conversations between host pairs. (default: %(default)s)",
+        type=float,
+        default=0.0)
+
+    parser.add_argument("--conversations",
+        help="Number of recurring conversations used by --sticky-share. "
+             "(default: %(default)s)",
+        type=int,
+        default=hostmodel.CONVERSATIONS)
+
+    parser.add_argument("--seed-capture",
+        help="Capture whose IPv4 packets the amplify engine re-emits with "
+             "rewritten hosts, timestamps and checksums. (default: %(default)s)",
+        default=SEED_CAPTURE)
+
+    parser.add_argument("--protocol-mix",
+        help="Share of each protocol with the mixed engine, as comma separated "
+             "name=weight pairs out of {0}. (default: {1})".format(
+                 ', '.join(sorted(protocols.BUILDERS)),
+                 ','.join('{0}={1}'.format(name, weight) for name, weight
+                          in sorted(protocols.DEFAULT_MIX.items()))),
+        type=parse_protocol_mix,
+        default=None)
+
+    parser.add_argument("--arrivals",
+        help="How packets are spread over each file: 'jitter' spaces them "
+             "evenly with random jitter, 'diurnal' makes the packet rate follow "
+             "the daily traffic curve, 'poisson' adds Poisson arrivals on top "
+             "of that and 'bursty' adds on/off bursts as well. "
+             "(default: %(default)s)",
+        choices=['jitter', 'diurnal', 'poisson', 'bursty'],
+        default='jitter')
+
+    parser.add_argument("--format",
+        help="Capture format: 'pcap' with microsecond timestamps, 'pcap-ns' "
+             "with nanosecond timestamps or 'pcapng' (nanosecond Enhanced "
+             "Packet Blocks, written as .pcapng files). (default: %(default)s)",
+        choices=OUTPUT_FORMATS,
+        default='pcap')
+
+    parser.add_argument("--index",
+        help="Write a <file>.idx record index next to every generated file",
+        action="store_true")
+
+    parser.add_argument("--compress",
+        help="Compress every file with this codec, using a pool of threads "
+             "(zstd and lz4 need the zstandard and lz4 packages)",
+        choices=sorted(compression.EXTENSIONS))
+
+    parser.add_argument("--compress-threads",
+        help="Number of compression threads per file (default: one per CPU)",
+        type=int)
+
+    parser.add_argument("--live",
+        help="Stream packets to this target instead of writing files: '-' for "
+             "stdout, unix:PATH for a unix socket, or the path of a named FIFO",
+        metavar="TARGET")
+
+    parser.add_argument("--speed",
+        help="Pacing of --live output relative to the packet timestamps, e.g. "
+             "1 for real time, 10 for ten times faster or 0 for as fast as "
+             "possible. (default: %(default)s)",
+        type=float,
+        default=1.0)
+
+    parser.add_argument("--seed",
+        help="Seed of every random choice. The same seed and options always "
+             "give the same files, however many workers make them "
+             "(default: random, logged at startup)",
+        type=int)
+
+    parser.add_argument("--manifest",
+        help="Record the run (seed, settings, host tables, schedule and a "
+             "checksum of every finished file) in this file. If it already "
+             "exists the recorded run is resumed instead: its settings replace "
+             "the ones given, and only files that are missing or damaged are "
+             "generated")
+
+    parser.add_argument("--rotate-size",
+        help="Generate one continuous capture and start a new file whenever "
+             "the current one would grow past this many bytes",
+        type=int)
+
+    parser.add_argument("--rotate-packets",
+        help="Generate one continuous capture and start a new file every "
+             "this many packets",
+        type=int)
+
+    parser.add_argument("--rotate-seconds",
+        help="Generate one continuous capture and start a new file whenever "
+             "the packet time crosses a multiple of this many seconds",
+        type=int)
+
+    parser.add_argument("--rotate-pattern",
+        help="Names of the rotated files: formatted with the file number as "
+             "{index}, then with time.strftime for the time of the first "
+             "packet. (default: %(default)s)",
+        default='capture_{index:06d}_%Y%m%d_%H%M%S.pcap')
+
+    parser.add_argument("--workers",
+        help="Number of processes used to generate files in parallel. "
+             "(default: %(default)s)",
+        default=1)
+
+
+    parser.add_argument("--stats",
+        help="Log a line of packet rates and per-stage timings every "
+             "--stats-interval seconds",
+        action="store_true")
+
+    parser.add_argument("--stats-interval",
+        help="Seconds between stats lines and metrics file updates. "
+             "(default: %(default)s)",
+        type=float,
+        default=metrics.DEFAULT_INTERVAL)
+
+    parser.add_argument("--metrics-file",
+        help="Keep the same stats in this Prometheus text format file (with "
+             "--workers, each worker writes its own <name>.<pid>.prom next to it)")
 
     parser.add_argument("--log_file", 
         help="The path to the log file for the service. (default: %(default)s)",
@@ -319,6 +1280,33 @@ def main():
 
     args = parser.parse_args()
 
+    # resuming a run takes everything that shapes its output from the manifest
+    checkpoint = None
+    if args.manifest is not None:
+        if (args.live is not None or args.rotate_size is not None or
+                args.rotate_packets is not None or args.rotate_seconds is not None):
+            parser.error("--manifest can't be combined with --live or --rotate-*")
+        if os.path.exists(args.manifest):
+            checkpoint = manifest.Manifest.load(args.manifest)
+            for name in MANIFEST_SETTINGS:
+                setattr(args, name, checkpoint.settings[name])
+            args.seed = checkpoint.seed
+
+    if args.host_skew < 0:
+        parser.error("--host-skew can't be negative")
+    if not 0 <= args.sticky_share <= 1:
+        parser.error("--sticky-share must be between 0 and 1")
+    if args.conversations < 1:
+        parser.error("--conversations must be at least 1")
+
+    if args.compress is not None:
+        if args.compress not in compression.get_codecs():
+            parser.error("{0} compression needs a package that is not installed".format(
+                args.compress))
+        if args.index:
+            parser.error("--index can't be combined with --compress, index "
+                         "offsets need an uncompressed file")
+
     # setup the default... couldn't figure out how to do this better 
     # (must be a way...)
     if args.log_level is None:
@@ -337,51 +1325,96 @@ def main():
 
     logging.info("Starting the ORCA Synthetic PCAP Generator Utility")
 
+    seed = args.seed
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    logging.info("Using seed {0}".format(seed))
+
     # set up our random hosts
     initialize_hosts(internal_count=int(args.internal_hosts), 
-                     external_count=int(args.external_hosts))
-
-    start_time=get_start_time()
-
-    if int(args.file_count) == 1:
-        file_name = 'generated_0000.pcap'
-        duration = randint(int(args.min_duration), int(args.max_duration))
-
-        create_pcap_file(start_time=start_time, 
-                         duration=duration, 
-                         file_name=file_name)
+                     external_count=int(args.external_hosts),
+                     rng=get_rng(seed, HOSTS_STREAM),
+                     host_skew=args.host_skew,
+                     sticky_share=args.sticky_share,
+                     conversations=args.conversations)
+
+    if checkpoint is not None:
+        logging.info("Resuming the run recorded in {0}".format(args.manifest))
+        restore_hosts(checkpoint.hosts)
+        schedule = checkpoint.schedule
     else:
-        for i in range(0, int(args.file_count)):
-            file_name = 'generated_{0:06d}.pcap'.format(i)
-
-            # get a random number
-            duration = randint(int(args.min_duration), int(args.max_duration))
-
-
-            # use the model to generate
-            next_time = time.localtime(start_time)
-
-            # get is weekend (Mon = 0, Sun = 6)
-            is_weekend = next_time.tm_wday > 4
-
-            # get float of hour (military time)
-            decimal_hour = next_time.tm_hour
-            mins = next_time.tm_min + (next_time.tm_sec / float(60))
-            decimal_hour += mins/60
-
-            # get result, round, and convert to int
-            duration = trafficmodel.get_duration_scalar(decimal_hour, is_weekend)
-            duration = int(round(duration*480))
-            logging.info("{0} - {1} - {2} - {3}".format(
-                time.strftime("%a, %d %b %Y %H:%M:%S", next_time), 
-                duration, decimal_hour, is_weekend))
-
-            create_pcap_file(start_time=start_time, 
-                            duration=duration, 
-                            file_name=file_name)
-            
-            # set the start time for the next iteration
-            start_time = start_time + duration
+        schedule = plan_schedule(start_time=get_start_time(),
+                                 file_count=int(args.file_count),
+                                 min_duration=int(args.min_duration),
+                                 max_duration=int(args.max_duration),
+                                 rng=get_rng(seed, SCHEDULE_STREAM))
+
+    if args.manifest is not None and checkpoint is None:
+        checkpoint = manifest.Manifest(
+            args.manifest, seed=seed,
+            settings=dict((name, getattr(args, name)) for name in MANIFEST_SETTINGS),
+            schedule=schedule,
+            hosts={'internal_macs': INTERNAL_HOSTS.macs, 'internal_ips': INTERNAL_HOSTS.ips,
+                   'external_macs': EXTERNAL_HOSTS.macs, 'external_ips': EXTERNAL_HOSTS.ips})
+        checkpoint.save()
+
+    # the seed capture is parsed once, every file re-emits the same pool
+    packet_pool = None
+    if args.engine == 'amplify':
+        packet_pool = amplify.PacketPool.load(args.seed_capture)
+
+    # continuous output is built in batches, one SYN at a time is pointless
+    stream_engine = args.engine if args.engine != 'packet' else 'batch'
+
+    if args.live is not None:
+        replay.replay_batches(create_file_header(args.format),
+                              generate_scheduled_batches(
+                                  schedule,
+                                  engine=stream_engine,
+                                  arrivals=args.arrivals,
+                                  protocol_mix=args.protocol_mix,
+                                  seed=seed,
+                                  output_format=args.format,
+                                  packet_pool=packet_pool),
+                              args.live, speed=args.speed,
+                              ticks=get_ticks(args.format))
+        return
+
+    if (args.rotate_size is not None or args.rotate_packets is not None or
+            args.rotate_seconds is not None):
+        create_rotating_capture(schedule, args.rotate_pattern,
+                                max_bytes=args.rotate_size,
+                                max_packets=args.rotate_packets,
+                                seconds=args.rotate_seconds,
+                                index=args.index,
+                                compress=args.compress,
+                                compress_threads=args.compress_threads,
+                                engine=stream_engine,
+                                arrivals=args.arrivals,
+                                protocol_mix=args.protocol_mix,
+                                seed=seed,
+                                output_format=args.format,
+                                packet_pool=packet_pool)
+        return
+
+    metrics_options = None
+    if args.stats or args.metrics_file is not None:
+        metrics_options = {'interval': args.stats_interval,
+                           'log': args.stats,
+                           'prometheus_file': args.metrics_file}
+
+    create_scheduled_files(schedule, workers=int(args.workers),
+                           seed=seed,
+                           metrics_options=metrics_options,
+                           checkpoint=checkpoint,
+                           engine=args.engine,
+                           index=args.index,
+                           compress=args.compress,
+                           compress_threads=args.compress_threads,
+                           arrivals=args.arrivals,
+                           protocol_mix=args.protocol_mix,
+                           output_format=args.format,
+                           packet_pool=packet_pool)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,796 @@
+import argparse
+import glob
+import functools
+import os
+import random
+import struct
+import time
+
+import numpy as np
+import pytest
+
+import amplify
+import anon
+import benchmark
+import compression
+import flows
+import hostmodel
+import manifest
+from packetbatch import PacketBatch
+import protocols
+import pcapindex
+import pcapstats
+from randomness import get_rng
+import test as generator
+
+'''
+End to end checks of the invariants the generator and anonymizer promise, on
+files small enough (a few thousand packets) to run in a couple of seconds.
+'''
+
+START_TIME = 1475366400
+KEY = b'0123456789abcdef'
+
+
+def verify_ipv6_checksum(frame, offset):
+    end = offset + 40 + struct.unpack_from('!H', frame, offset + 4)[0]
+    assert end <= len(frame)
+    protocol, segment = frame[offset + 6], offset + 40
+    while protocol in anon.IPV6_OPTION_HEADERS:
+        protocol, segment = frame[segment], segment + (frame[segment + 1] + 1) * 8
+    assert protocol in (6, 17, 58)
+    pseudo_header = frame[offset+8:offset+40] + struct.pack('!IxxxB', end - segment, protocol)
+    assert anon.internet_checksum(frame[segment:end],
+                                  initial=int.from_bytes(pseudo_header, 'big')) == 0
+
+
+def icmpv6_frame():
+    """An ethernet/IPv6/hop-by-hop/ICMPv6 echo request with a valid checksum"""
+    source = bytes.fromhex('fd000000000000000000000000000001')
+    destination = bytes.fromhex('20010db8000000000000000000000002')
+    options = bytes([58, 0, 5, 2, 0, 0, 1, 0])
+    icmp = bytearray(struct.pack('!BBHHH', 128, 0, 0, 7, 1) + b'ping')
+    pseudo_header = source + destination + struct.pack('!IxxxB', len(icmp), 58)
+    struct.pack_into('!H', icmp, 2, anon.internet_checksum(
+        icmp, initial=int.from_bytes(pseudo_header, 'big')))
+    ip = struct.pack('!IHBB16s16s', 6 << 28, len(options) + len(icmp), 0, 64,
+                     source, destination)
+    return (b'\x33\x33\x00\x00\x00\x01' + b'\x02\x00\x00\x00\x00\x02' +
+            struct.pack('!H', anon.ETHER_TYPE_IPV6) + ip + options + bytes(icmp))
+
+@pytest.fixture
+def hosts(monkeypatch):
+    """Small, seeded host tables in the generator's globals"""
+    monkeypatch.setattr(generator, 'INTERNAL_HOSTS', generator.HostTable())
+    monkeypatch.setattr(generator, 'EXTERNAL_HOSTS', generator.HostTable())
+    np.random.seed(1)
+    generator.initialize_hosts(5, 20)
+
+
+def read_file(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def read_frames(file_name):
+    """(timestamp in ticks, included length, original length, data) per record"""
+    with anon.PcapReader(file_name) as reader:
+        return [(header.start_time * reader.ticks + header.offset_ms,
+                 header.included_length, header.original_length, bytes(data))
+                for offset, header, data in reader]
+
+
+def write_pcap(file_name, frames, start_time=START_TIME, snaplen=65535):
+    """
+    Writes frames out as a microsecond pcap, one record a millisecond, cut
+    short at snaplen bytes the way a capture would
+    """
+    with open(file_name, 'wb') as f:
+        f.write(struct.pack('=IHHiIII', anon.PCAP_MAGIC, 2, 4, 0, 0, snaplen, 1))
+        for ndx, frame in enumerate(frames):
+            f.write(struct.pack('=IIII', start_time, ndx * 1000,
+                                min(len(frame), snaplen), len(frame)))
+            f.write(frame[:snaplen])
+
+
+def udp_frame(payload=b'hello world', vlan=None, ether_type=0x0800):
+    """An ethernet/IPv4/UDP frame with valid checksums, optionally 802.1Q tagged"""
+    source, destination = bytes([10, 0, 0, 1]), bytes([192, 168, 1, 2])
+    udp = bytearray(struct.pack('!HHHH', 5353, 53, 8 + len(payload), 0) + payload)
+    pseudo_header = source + destination + struct.pack('!BBH', 0, 17, len(udp))
+    struct.pack_into('!H', udp, 6, anon.internet_checksum(
+        udp, initial=int.from_bytes(pseudo_header, 'big')))
+    ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 1, 0, 64, 17, 0,
+                               source, destination))
+    struct.pack_into('!H', ip, 10, anon.internet_checksum(ip))
+    tag = b'' if vlan is None else struct.pack('!HH', 0x8100, vlan)
+    return (b'\x02\x00\x00\x00\x00\x01' + b'\x02\x00\x00\x00\x00\x02' + tag +
+            struct.pack('!H', ether_type) + bytes(ip) + bytes(udp))
+
+
+def verify_checksums(frame):
+    """
+    Asserts the IP header and TCP/UDP/ICMP(v6) checksums of a frame are
+    valid, skipping any that a snaplen or fragmentation left nothing to check on
+    """
+    offset = 14
+    ether_type = struct.unpack_from('!H', frame, 12)[0]
+    while ether_type in anon.VLAN_ETHER_TYPES:
+        ether_type = struct.unpack_from('!H', frame, offset + 2)[0]
+        offset += 4
+    if ether_type == anon.ETHER_TYPE_IPV6:
+        verify_ipv6_checksum(frame, offset)
+    if ether_type != anon.ETHER_TYPE_IPV4:
+        return
+
+    ihl = (frame[offset] & 0x0f) * 4
+    assert anon.internet_checksum(frame[offset:offset+ihl]) == 0
+    total_length, flags = struct.unpack_from('!HxxH', frame, offset + 2)
+    if offset + total_length > len(frame) or flags & 0x3fff:
+        return
+
+    protocol = frame[offset + 9]
+    segment = frame[offset+ihl:offset+total_length]
+    if protocol == 1:
+        assert anon.internet_checksum(segment) == 0
+    elif protocol in (6, 17):
+        if protocol == 17 and segment[6:8] == b'\x00\x00':
+            return
+        pseudo_header = frame[offset+12:offset+20] + struct.pack('!BBH', 0, protocol,
+                                                                 len(segment))
+        assert anon.internet_checksum(
+            segment, initial=int.from_bytes(pseudo_header, 'big')) == 0
+
+
+def test_output_does_not_depend_on_the_write_buffer(hosts, tmp_path):
+    outputs = []
+    for buffer_size in (1, 1000, generator.WRITE_BUFFER_SIZE):
+        file_name = str(tmp_path / 'buffered_{0}.pcap'.format(buffer_size))
+        random.seed(2)
+        generator.create_pcap_file(START_TIME, duration=10, max_size=100000,
+                                   file_name=file_name, buffer_size=buffer_size)
+        outputs.append(read_file(file_name))
+
+    assert len(outputs[0]) == 24 + 78 * ((100000 - 24) // 78 - 1)
+    assert outputs[1] == outputs[0]
+    assert outputs[2] == outputs[0]
+
+
+def test_batch_records_match_create_packet(hosts, monkeypatch):
+    ts_sec = np.full(2000, START_TIME, dtype=np.uint32) + np.arange(2000) // 100
+    ts_usec = np.arange(2000, dtype=np.uint32) * 397 % 1000000
+    np.random.seed(2)
+    records = generator.create_packet_batch(ts_sec, ts_usec)
+
+    # replay the hosts the batch picked through the per-packet engine
+    internal = {ip: ndx for ndx, ip in enumerate(generator.INTERNAL_HOSTS.ips.tolist())}
+    external = {ip: ndx for ndx, ip in enumerate(generator.EXTERNAL_HOSTS.ips.tolist())}
+    picks = []
+    for source, destination in zip(records['source_ip'].tolist(),
+                                   records['destination_ip'].tolist()):
+        if source in internal:
+            picks.extend([1, internal[source], external[destination]])
+        else:
+            picks.extend([0, external[source], internal[destination]])
+    picks = iter(picks)
+    monkeypatch.setattr(generator, 'randint', lambda low, high: next(picks))
+
+    packets = b"".join(generator.create_packet(sec, usec)
+                       for sec, usec in zip(ts_sec.tolist(), ts_usec.tolist()))
+    assert records.tobytes() == packets
+
+
+def test_workers_write_the_same_files_as_one_process(hosts, monkeypatch, tmp_path):
+    create_pcap_file = generator.create_pcap_file
+    monkeypatch.setattr(generator, 'create_pcap_file',
+                        lambda **options: create_pcap_file(max_size=50000, **options))
+    schedule = [(START_TIME + 100 * ndx, 100, 'generated_{0:06d}.pcap'.format(ndx))
+                for ndx in range(3)]
+
+    outputs = []
+    for workers in (1, 2):
+        directory = tmp_path / str(workers)
+        directory.mkdir()
+        monkeypatch.chdir(directory)
+        generator.create_scheduled_files(schedule, workers=workers, seed=3, engine='batch')
+        outputs.append([read_file(file_name) for _, _, file_name in schedule])
+    assert all(len(output) > 40000 for output in outputs[0])
+    assert outputs[1] == outputs[0]
+
+
+@pytest.mark.parametrize('max_bytes', [generator.TEMPLATE_CACHE_SIZE,
+                                       3 * generator.TEMPLATE_ENTRY_SIZE])
+def test_template_splice_matches_packing_each_header(hosts, monkeypatch, max_bytes):
+    generator.build_header_templates(max_bytes=max_bytes)
+    internal = len(generator.INTERNAL_HOSTS) - 1
+    external = len(generator.EXTERNAL_HOSTS) - 1
+    rng = random.Random(4)
+    for offset in range(500):
+        picks = [rng.randint(0, 1)]
+        if picks[0]:
+            picks.extend([rng.randint(0, internal), rng.randint(0, external)])
+        else:
+            picks.extend([rng.randint(0, external), rng.randint(0, internal)])
+        expected = b"".join([
+            generator.create_packet_header(START_TIME, offset),
+            generator.build_ethernet_frame(*picks),
+            generator.build_ipv4_datagram(*picks),
+            generator.build_tcp_segment()])
+
+        replay = iter(picks)
+        monkeypatch.setattr(generator, 'randint', lambda low, high: next(replay))
+        assert generator.create_packet(START_TIME, offset) == expected
+    assert len(generator.HEADER_TEMPLATES) <= generator.HEADER_TEMPLATES.max_entries
+
+
+def test_host_tables_hold_the_requested_hosts(hosts):
+    internal = generator.INTERNAL_HOSTS
+    external = generator.EXTERNAL_HOSTS
+    assert (len(internal), len(external)) == (5, 20)
+    assert internal.macs.shape == (5, 6) and internal.macs.dtype == np.uint8
+    assert internal.ips.dtype == np.uint32
+    assert all(ip >> 16 == 0xc0a8 for ip in internal.ips.tolist())
+    assert all(ip >> 24 > 0 for ip in external.ips.tolist())
+
+    # every packet travels between an internal and an external host
+    ips = set(internal.ips.tolist()), set(external.ips.tolist())
+    for offset in range(200):
+        packet = generator.create_packet(START_TIME, offset)
+        source, destination = struct.unpack('!II', packet[42:50])
+        assert (source in ips[0] and destination in ips[1]) or \
+               (source in ips[1] and destination in ips[0])
+
+
+def test_reader_records_match_unpacking_the_file(hosts, tmp_path):
+    file_name = str(tmp_path / 'read.pcap')
+    generator.create_pcap_file(START_TIME, duration=10, max_size=20000,
+                               file_name=file_name, engine='batch')
+    contents = read_file(file_name)
+
+    expected = []
+    offset = 24
+    while offset < len(contents):
+        header = struct.unpack('IIII', contents[offset:offset + 16])
+        data = contents[offset + 16:offset + 16 + header[2]]
+        expected.append((offset, header, data))
+        offset += 16 + header[2]
+
+    with anon.PcapReader(file_name) as reader:
+        assert tuple(reader.header) == struct.unpack('IHHiIII', contents[:24])
+        records = [(offset, tuple(header), bytes(data))
+                   for offset, header, data in reader]
+    assert len(records) > 200
+    assert records == expected
+
+
+def test_anon_keeps_vlan_tags_and_drops_unknown_protocols(tmp_path):
+    write_pcap(str(tmp_path / 'in.pcap'),
+               [udp_frame(), udp_frame(vlan=42), udp_frame(ether_type=0x88cc)])
+    anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap'), key=KEY)
+
+    frames = read_frames(str(tmp_path / 'out.pcap'))
+    assert len(frames) == 2
+    plain, tagged = frames[0][3], frames[1][3]
+    assert tagged[12:16] == struct.pack('!HH', 0x8100, 42)
+    assert plain[26:34] == tagged[30:38] != udp_frame()[26:34]
+    for timestamp, included_length, original_length, frame in frames:
+        assert included_length == original_length == len(frame)
+        verify_checksums(frame)
+
+
+def test_anon_writes_truncated_last_record_with_its_real_length(tmp_path):
+    write_pcap(str(tmp_path / 'in.pcap'), [udp_frame(), udp_frame(b'x' * 100)])
+    with open(str(tmp_path / 'in.pcap'), 'r+b') as f:
+        f.truncate(24 + 2 * 16 + len(udp_frame()) + 60)
+    anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap'), key=KEY)
+
+    frames = read_frames(str(tmp_path / 'out.pcap'))
+    assert [frame[1:3] for frame in frames] == [(53, 53), (60, len(udp_frame(b'x' * 100)))]
+    assert [len(frame[3]) for frame in frames] == [53, 60]
+
+
+def test_anon_hashes_long_keys_down(tmp_path):
+    write_pcap(str(tmp_path / 'in.pcap'), [udp_frame()])
+    for name in ('a.pcap', 'b.pcap'):
+        anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / name), key=b'k' * 100)
+    assert read_frames(str(tmp_path / 'a.pcap'))[0][3][26:34] == \
+        read_frames(str(tmp_path / 'b.pcap'))[0][3][26:34]
+    assert anon.AddressMapper(KEY).map_ip(b'\x0a\x00\x00\x01') == \
+        anon.AddressMapper(KEY).map_ip(b'\x0a\x00\x00\x01')
+
+
+def test_anon_rejects_time_shifts_out_of_range(tmp_path):
+    write_pcap(str(tmp_path / 'in.pcap'), [udp_frame()])
+    with pytest.raises(ValueError):
+        anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap'),
+                             time_shift=-START_TIME - 1, key=KEY)
+
+
+@pytest.mark.parametrize('snaplen', [14, 18, 20, 30, 40])
+def test_anon_survives_frames_cut_short(tmp_path, snaplen):
+    frames = [udp_frame(), udp_frame(vlan=5), icmpv6_frame()]
+    for frame in frames:
+        assert anon.anonymize_packet(frame[:snaplen], anon.AddressMapper(KEY),
+                                     truncated=True) is not None
+
+    write_pcap(str(tmp_path / 'in.pcap'), frames, snaplen=snaplen)
+    anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap'), key=KEY)
+    assert [frame[1:3] for frame in read_frames(str(tmp_path / 'out.pcap'))] == \
+        [(min(len(frame), snaplen), len(frame)) for frame in frames]
+
+
+def test_anon_output_is_reproducible_and_shardable(tmp_path):
+    file_name = str(tmp_path / 'in.pcap')
+    write_pcap(file_name, [udp_frame(b'payload %d' % ndx) for ndx in range(200)])
+    outputs = []
+    for ndx, workers in enumerate((1, 1, 2, 3)):
+        output_file = str(tmp_path / 'anon_{0}.pcap'.format(ndx))
+        anon.clone_pcap_file(file_name, output_file, key=KEY, workers=workers)
+        outputs.append(read_file(output_file))
+    assert all(output == outputs[0] for output in outputs)
+
+    # payloads are still replaced, and differently under another key
+    anon.clone_pcap_file(file_name, str(tmp_path / 'other.pcap'), key=KEY[::-1])
+    original, other = read_frames(file_name), read_frames(str(tmp_path / 'other.pcap'))
+    anonymized = read_frames(str(tmp_path / 'anon_0.pcap'))
+    assert [frame[3][42:] for frame in original] != [frame[3][42:] for frame in anonymized]
+    assert [frame[3][42:] for frame in other] != [frame[3][42:] for frame in anonymized]
+    for timestamp, included_length, original_length, frame in anonymized:
+        verify_checksums(frame)
+
+
+@pytest.mark.parametrize('engine', ['packet', 'batch'])
+def test_index_seeks_and_slices_like_scanning(hosts, tmp_path, engine):
+    file_name = str(tmp_path / 'indexed.pcap')
+    generator.create_pcap_file(START_TIME, duration=10, max_size=50000,
+                               file_name=file_name, engine=engine, index=True)
+    frames = read_frames(file_name)
+    with anon.PcapReader(file_name) as reader:
+        offsets = [offset for offset, header, data in reader]
+
+    # the index written alongside the file is the one built from scanning it
+    index = pcapindex.PcapIndex(pcapindex.index_path(file_name))
+    built = pcapindex.build_index(file_name, str(tmp_path / 'built.idx'))
+    assert read_file(built) == read_file(pcapindex.index_path(file_name))
+    assert len(index) == len(frames) > 500
+    assert [index.offset(ndx) for ndx in range(len(index))] == offsets
+    assert [index.timestamp(ndx) for ndx in range(len(index))] == \
+        [frame[0] * 1000 for frame in frames]
+
+    pcapindex.slice_pcap(file_name, str(tmp_path / 'slice.pcap'), 100, 300, index=index)
+    assert read_frames(str(tmp_path / 'slice.pcap')) == frames[100:300]
+
+    start, end = frames[150][0] * 1000, frames[400][0] * 1000
+    assert index.find_time(start) <= 150
+    count = pcapindex.slice_pcap_by_time(file_name, str(tmp_path / 'range.pcap'),
+                                         start, end, index=index)
+    assert read_frames(str(tmp_path / 'range.pcap')) == \
+        [frame for frame in frames if start <= frame[0] * 1000 < end]
+    assert count > 0
+
+
+def test_index_slices_unsorted_captures_in_file_order(tmp_path):
+    file_name = str(tmp_path / 'unsorted.pcap')
+    write_pcap(file_name, [udp_frame(b'frame %d' % ndx) for ndx in range(20)])
+    frames = read_frames(file_name)
+    # swap the timestamps of two records so the capture is out of order
+    with open(file_name, 'r+b') as f:
+        for record, timestamp in ((3, frames[12][0]), (12, frames[3][0])):
+            f.seek(24 + sum(16 + frame[1] for frame in frames[:record]) + 4)
+            f.write(struct.pack('=I', timestamp % 1000000))
+    frames = read_frames(file_name)
+
+    index = pcapindex.PcapIndex(pcapindex.build_index(file_name))
+    assert not index.monotonic
+    start, end = frames[2][0] * 1000, frames[5][0] * 1000
+    pcapindex.slice_pcap_by_time(file_name, str(tmp_path / 'range.pcap'), start, end)
+    assert read_frames(str(tmp_path / 'range.pcap')) == \
+        [frame for frame in frames if start <= frame[0] * 1000 < end]
+
+
+@pytest.mark.parametrize('weekend', [False, True])
+def test_duration_spline_matches_scipy(weekend):
+    interpolate = pytest.importorskip('scipy.interpolate')
+    import trafficmodel
+
+    points = trafficmodel.WEEKEND_POINTS if weekend else trafficmodel.WEEKDAY_POINTS
+    hours = np.arange(0, 24, 0.05)
+    expected = np.clip(1 - interpolate.interp1d(range(25), points, kind='cubic')(
+        (hours + 1) % 24), 0, 1)
+    assert np.allclose(trafficmodel.get_duration_scalars(hours, weekend), expected)
+    assert np.allclose([trafficmodel.get_duration_scalar(hour, weekend) for hour in hours],
+                       expected)
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    """Local time in a zone with daylight saving, put back afterwards"""
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize('arrivals', ['diurnal', 'poisson', 'bursty'])
+def test_arrivals_follow_the_daily_curve(hosts, tmp_path, new_york, arrivals):
+    file_name = str(tmp_path / 'day.pcap')
+    generator.create_pcap_file(START_TIME, duration=86400, max_size=200000,
+                               file_name=file_name, engine='batch', arrivals=arrivals)
+    timestamps = np.array([frame[0] for frame in read_frames(file_name)]) / 1e6
+    assert len(timestamps) == (200000 - 24) // 78 - 1
+    assert np.all(np.diff(timestamps) >= 0)
+    assert START_TIME <= timestamps[0] and timestamps[-1] < START_TIME + 86400
+
+    # packets per two hours rise and fall with the model's activity
+    import trafficmodel
+    edges = np.arange(START_TIME, START_TIME + 86400 + 1, 7200)
+    counts = np.histogram(timestamps, edges)[0]
+    activity = [trafficmodel.get_activity(np.arange(low, high, 60)).mean()
+                for low, high in zip(edges[:-1], edges[1:])]
+    assert np.corrcoef(counts, activity)[0, 1] > 0.8
+
+
+def test_activity_follows_daylight_saving_changes(new_york):
+    import trafficmodel
+
+    # an hour either side of the end of daylight saving time in 2016
+    change = 1478412000
+    timestamps = np.arange(change - 3600, change + 3600, 0.5)
+    offsets = np.array([time.localtime(int(np.floor(timestamp))).tm_gmtoff
+                        for timestamp in timestamps])
+    assert set(offsets.tolist()) == {-14400, -18000}
+    assert np.array_equal(trafficmodel.get_utc_offsets(timestamps), offsets)
+
+    local = timestamps + offsets
+    days, seconds = np.divmod(local, 86400)
+    expected = trafficmodel.MIN_ACTIVITY + (1 - trafficmodel.MIN_ACTIVITY) * (
+        1 - trafficmodel.get_duration_scalars(seconds / 3600.0, (days + 3) % 7 > 4))
+    assert np.allclose(trafficmodel.get_activity(timestamps), expected)
+
+
+def test_replay_paces_from_the_first_packet(hosts, tmp_path, monkeypatch):
+    import replay
+
+    ts_usec = np.arange(5, dtype=np.uint32) * 50000
+    records = generator.create_packet_batch(np.full(5, START_TIME, dtype=np.uint32), ts_usec)
+
+    def batches():
+        # a slow first batch must not be made up for with a burst
+        time.sleep(0.3)
+        for ndx in range(len(records)):
+            yield records[ndx:ndx + 1]
+
+    writes = []
+    write = replay.FileTransport.write
+
+    def record_write(self, data):
+        writes.append((time.monotonic(), len(data)))
+        write(self, data)
+    monkeypatch.setattr(replay.FileTransport, 'write', record_write)
+
+    output_file = tmp_path / 'out.pcap'
+    output_file.write_bytes(b'')
+    replay.replay_batches(generator.create_global_header(), batches(), str(output_file))
+
+    assert len(writes) == 6
+    assert writes[-1][0] - writes[1][0] >= 0.15
+    assert output_file.read_bytes() == generator.create_global_header() + records.tobytes()
+
+
+def test_flows_checksums_and_sequence_numbers_are_valid(hosts, tmp_path, monkeypatch):
+    # few enough connections that a small file sees them through to the end
+    monkeypatch.setattr(flows, 'FlowTable', functools.partial(flows.FlowTable, count=16))
+    file_name = str(tmp_path / 'flows.pcap')
+    generator.create_pcap_file(START_TIME, duration=10, max_size=200000,
+                               file_name=file_name, engine='flows')
+    frames = read_frames(file_name)
+    assert len(frames) > 100
+
+    # every segment carries on from where the last one its side sent ended
+    next_sequence = {}
+    seen = set()
+    for timestamp, included_length, original_length, frame in frames:
+        verify_checksums(frame)
+        side = frame[26:38]
+        sequence, flags = struct.unpack_from('!I5xB', frame, 38)
+        length = len(frame) - 54
+        if not flags & flows.TCP_SYN:
+            assert next_sequence[side] == sequence
+        seen.add(flags)
+        next_sequence[side] = (sequence + length + bool(flags & flows.TCP_SYN) +
+                               bool(flags & flows.TCP_FIN)) & 0xffffffff
+    assert {flows.TCP_SYN, flows.TCP_ACK, flows.TCP_FIN | flows.TCP_ACK} <= seen
+
+
+def test_mixed_checksums_survive_anon(hosts, tmp_path):
+    file_name = str(tmp_path / 'mixed.pcap')
+    generator.create_pcap_file(START_TIME, duration=10, max_size=200000,
+                               file_name=file_name, engine='mixed')
+    anon.clone_pcap_file(file_name, str(tmp_path / 'anon.pcap'), key=KEY)
+    original, anonymized = read_frames(file_name), read_frames(str(tmp_path / 'anon.pcap'))
+
+    assert len(original) == len(anonymized)
+    ether_types = set()
+    for before, after in zip(original, anonymized):
+        assert before[0:3] == after[0:3]
+        verify_checksums(before[3])
+        verify_checksums(after[3])
+        ether_type = struct.unpack_from('!H', before[3], 12)[0]
+        ether_types.add(ether_type)
+        if ether_type == anon.ETHER_TYPE_IPV6:
+            assert before[3][22:54] != after[3][22:54]
+    assert ether_types == {anon.ETHER_TYPE_IPV4, anon.ETHER_TYPE_IPV6}
+
+
+def test_anon_ipv6_extension_headers_and_icmpv6(tmp_path):
+    write_pcap(str(tmp_path / 'in.pcap'), [icmpv6_frame()])
+    anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap'), key=KEY)
+
+    frame = read_frames(str(tmp_path / 'out.pcap'))[0][3]
+    verify_checksums(frame)
+    assert frame[22:54] != icmpv6_frame()[22:54]
+    assert frame[22] != 0xff and frame[38] != 0xff
+    assert frame[54:62] == bytes([58, 0]) + bytes(6)
+
+
+def test_protocol_mix_follows_its_weights(hosts):
+    mix = protocols.ProtocolMix(generator.INTERNAL_HOSTS, generator.EXTERNAL_HOSTS)
+    count = 20000
+    batch = mix.create_batch(np.full(count, START_TIME, dtype=np.uint32),
+                             np.arange(count, dtype=np.uint32) * 50)
+    assert len(batch) == count
+    assert np.all(np.diff(batch.ts_usec.astype(np.int64)) >= 0)
+
+    names = []
+    for first, last in zip(batch.offsets[:-1].tolist(), batch.offsets[1:].tolist()):
+        frame = bytes(batch.data[first + 16:last])
+        ether_type, protocol = struct.unpack_from('!H9xB', frame, 12)
+        if ether_type == anon.ETHER_TYPE_IPV6:
+            names.append('ipv6')
+        elif protocol == 17:
+            ports = struct.unpack_from('!HH', frame, 34)
+            names.append('dns' if 53 in ports else 'udp')
+        else:
+            names.append({6: 'tcp', 1: 'icmp'}[protocol])
+    for name, weight in protocols.DEFAULT_MIX.items():
+        assert abs(names.count(name) / float(count) - weight) < 0.02
+
+
+def test_benchmark_cases_report_their_own_work():
+    with pytest.raises(argparse.ArgumentTypeError):
+        benchmark.parse_engines('batch,nonsense')
+    cases = benchmark.plan_cases(['create_pcap_file', 'clone_pcap_file'], [(5, 20)],
+                                 [50000], benchmark.parse_engines('batch,mixed,amplify'))
+    assert len(cases) == 6
+
+    results = benchmark.run_benchmarks(cases)
+    assert [(result['benchmark'], result['params']) for result in results] == cases
+    for result in results:
+        assert 10000 < result['bytes'] <= 50000
+        assert result['packets'] > 50
+        assert result['packets_per_second'] > 0 and result['peak_rss_bytes'] > 0
+
+
+def read_metrics(file_name):
+    """{metric{labels}: value} of a Prometheus text format file"""
+    with open(file_name) as f:
+        return dict(line.rsplit(' ', 1) for line in f.read().splitlines()
+                    if not line.startswith('#'))
+
+
+def test_metrics_count_what_was_written(hosts, monkeypatch, tmp_path):
+    monkeypatch.setattr(generator, 'STATS', None)
+    create_pcap_file = generator.create_pcap_file
+    monkeypatch.setattr(generator, 'create_pcap_file',
+                        lambda **options: create_pcap_file(max_size=50000, **options))
+    monkeypatch.chdir(tmp_path)
+    schedule = [(START_TIME + 100 * ndx, 100, 'generated_{0:06d}.pcap'.format(ndx))
+                for ndx in range(2)]
+    options = {'interval': 1000, 'log': True, 'prometheus_file': str(tmp_path / 'gen.prom')}
+    generator.create_scheduled_files(schedule, metrics_options=options, engine='batch')
+
+    frames = sum((read_frames(file_name) for _, _, file_name in schedule), [])
+    generated = read_metrics(str(tmp_path / 'gen.prom'))
+    label = '{process="generator"}'
+    assert int(generated['syntheticpcap_packets_total' + label]) == len(frames)
+    assert int(generated['syntheticpcap_bytes_total' + label]) == \
+        sum(16 + len(frame[3]) for frame in frames)
+    for stage in ('timing', 'build', 'write'):
+        assert 'syntheticpcap_stage_seconds_total{{process="generator",stage="{0}"}}'.format(
+            stage) in generated
+
+    # with workers every shard reports to its own file, the parent the queue
+    options['prometheus_file'] = str(tmp_path / 'anon.prom')
+    anon.clone_pcap_file(schedule[0][2], str(tmp_path / 'anon.pcap'), key=KEY,
+                         workers=2, metrics_options=options)
+    counts = [int(read_metrics(file_name)['syntheticpcap_packets_total{process="anon"}'])
+              for file_name in glob.glob(str(tmp_path / 'anon.*.prom'))]
+    # a worker that happens to take both shards reports the last one only
+    assert counts and all(counts)
+    assert sum(counts) <= len(read_frames(schedule[0][2]))
+    scheduler = read_metrics(str(tmp_path / 'anon.prom'))
+    assert scheduler['syntheticpcap_shards_done{process="anon_scheduler"}'] == '2'
+
+
+def generate(directory, monkeypatch, **options):
+    """Runs the scheduler in directory and returns the bytes of each file it wrote"""
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    schedule = generator.plan_schedule(START_TIME, 3, 10, 20,
+                                       rng=get_rng(5, generator.SCHEDULE_STREAM))
+    generator.create_scheduled_files(schedule, seed=5, **options)
+    return dict((path.name, path.read_bytes()) for path in sorted(directory.iterdir()))
+
+
+@pytest.mark.parametrize('engine', ['packet', 'batch', 'mixed'])
+def test_seeded_output_does_not_depend_on_workers(hosts, tmp_path, monkeypatch, engine):
+    serial = generate(tmp_path / 'serial', monkeypatch, workers=1,
+                      engine=engine, max_size=100000)
+    parallel = generate(tmp_path / 'parallel', monkeypatch, workers=2,
+                        engine=engine, max_size=100000)
+    assert len(serial) == 3
+    assert all(len(data) > 10000 for data in serial.values())
+    assert serial == parallel
+
+
+@pytest.mark.parametrize('limit', [{'max_bytes': 30000}, {'max_packets': 200},
+                                   {'seconds': 60}])
+def test_rotated_files_concatenate_to_the_stream(hosts, tmp_path, limit):
+    schedule = generator.plan_schedule(START_TIME, 2, 10, 20,
+                                       rng=get_rng(6, generator.SCHEDULE_STREAM))
+    options = dict(engine='mixed', max_size=100000, seed=6)
+    stream = b"".join(
+        bytes((batch if isinstance(batch, PacketBatch)
+               else PacketBatch.from_records(batch)).view())
+        for batch in generator.generate_scheduled_batches(schedule, **options))
+
+    files = generator.create_rotating_capture(schedule, str(tmp_path / 'cap_{index:03d}.pcap'),
+                                              **dict(options, **limit))
+    assert len(files) > 1
+    rotated = b""
+    for file_name in files:
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        rotated += data[24:]
+        frames = read_frames(file_name)
+        if 'max_bytes' in limit:
+            assert len(data) <= limit['max_bytes']
+        if 'max_packets' in limit:
+            assert len(frames) <= limit['max_packets']
+        if 'seconds' in limit:
+            windows = set(frame[0] // (limit['seconds'] * 1000000) for frame in frames)
+            assert len(windows) == 1
+    assert rotated == stream
+
+
+def test_compressed_anon_output_is_named_after_its_codec(tmp_path):
+    write_pcap(str(tmp_path / 'in.pcap'), [udp_frame(b'payload %d' % ndx) for ndx in range(50)])
+    output_file = anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap'),
+                                       key=KEY, compress='gzip')
+    assert output_file == str(tmp_path / 'out.pcap.gz')
+    assert not (tmp_path / 'out.pcap').exists()
+    with pytest.raises(ValueError):
+        pcapindex.build_index(output_file)
+    anon.clone_pcap_file(str(tmp_path / 'in.pcap'), str(tmp_path / 'plain.pcap'), key=KEY)
+    assert read_frames(output_file) == read_frames(str(tmp_path / 'plain.pcap'))
+
+    # compressed input is decompressed once and anonymized like the plain file
+    with compression.open_compressed(str(tmp_path / 'in.pcap.gz'), 'gzip') as f:
+        f.write(read_file(str(tmp_path / 'in.pcap')))
+    for workers in (1, 2):
+        output_file = str(tmp_path / 'from_gzip_{0}.pcap'.format(workers))
+        anon.clone_pcap_file(str(tmp_path / 'in.pcap.gz'), output_file, key=KEY,
+                             workers=workers)
+        assert read_file(output_file) == read_file(str(tmp_path / 'plain.pcap'))
+    assert not list(tmp_path.glob('*.input'))
+
+
+@pytest.mark.parametrize('output_format', ['pcap-ns', 'pcapng'])
+def test_formats_round_trip_through_anon_and_pcapindex(hosts, tmp_path, output_format):
+    file_name = generator.create_pcap_file(START_TIME, duration=10, max_size=100000,
+                                           file_name=str(tmp_path / 'in.pcap'),
+                                           engine='batch', rng=get_rng(7),
+                                           output_format=output_format)
+    with anon.PcapReader(file_name) as reader:
+        scale = 1000000000 // reader.ticks
+    frames = read_frames(file_name)
+
+    # the batch engine writes bare SYNs, there is no payload for anon to scrub
+    serial = anon.clone_pcap_file(file_name, str(tmp_path / 'serial.pcap'), key=KEY)
+    sharded = anon.clone_pcap_file(file_name, str(tmp_path / 'sharded.pcap'), key=KEY,
+                                   workers=2)
+    with open(serial, 'rb') as f, open(sharded, 'rb') as g:
+        assert f.read() == g.read()
+    anonymized = read_frames(serial)
+    with anon.PcapReader(serial) as reader:
+        assert 1000000000 // reader.ticks == scale
+    assert [frame[0:3] for frame in anonymized] == [frame[0:3] for frame in frames]
+    for before, after in zip(frames, anonymized):
+        assert before[3][26:34] != after[3][26:34]
+        verify_checksums(after[3])
+
+    index = pcapindex.PcapIndex(pcapindex.build_index(file_name))
+    assert [index.timestamp(ndx) for ndx in range(len(index))] == \
+        [frame[0] * scale for frame in frames]
+    pcapindex.slice_pcap(file_name, str(tmp_path / 'part'), 10, 20, index=index)
+    with open(file_name, 'rb') as f, open(str(tmp_path / 'part'), 'rb') as g:
+        assert f.read(4) == g.read(4)
+    assert read_frames(str(tmp_path / 'part')) == frames[10:20]
+
+
+def test_amplify_checksums_are_valid(hosts, tmp_path):
+    pool = amplify.PacketPool.load(os.path.join(os.path.dirname(generator.__file__),
+                                                generator.SEED_CAPTURE))
+    file_name = generator.create_pcap_file(START_TIME, duration=10, max_size=200000,
+                                           file_name=str(tmp_path / 'amplified.pcap'),
+                                           engine='amplify', rng=get_rng(8),
+                                           packet_pool=pool)
+    frames = read_frames(file_name)
+    assert len(frames) > len(pool)
+    for timestamp, included_length, original_length, frame in frames:
+        verify_checksums(frame)
+
+
+def test_host_pairs_need_a_conversation():
+    with pytest.raises(ValueError):
+        hostmodel.HostPairs(5, 20, sticky_share=0.5, conversations=0)
+
+
+def test_manifest_resume_regenerates_only_damaged_files(hosts, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    schedule = generator.plan_schedule(START_TIME, 4, 10, 20,
+                                       rng=get_rng(9, generator.SCHEDULE_STREAM))
+    checkpoint = manifest.Manifest(
+        'run.json', seed=9, schedule=schedule,
+        hosts={'internal_macs': generator.INTERNAL_HOSTS.macs,
+               'internal_ips': generator.INTERNAL_HOSTS.ips,
+               'external_macs': generator.EXTERNAL_HOSTS.macs,
+               'external_ips': generator.EXTERNAL_HOSTS.ips})
+    checkpoint.save()
+    generator.create_scheduled_files(schedule, seed=9, checkpoint=checkpoint,
+                                     engine='batch', max_size=50000, index=True)
+    names = [file_name for start_time, duration, file_name in schedule]
+    originals = dict((name, (tmp_path / name).read_bytes()) for name in names)
+
+    # truncate one capture, delete another and flip a byte in a third's index
+    with open(names[0], 'r+b') as f:
+        f.truncate(1000)
+    os.remove(names[1])
+    index = tmp_path / pcapindex.index_path(names[2])
+    data = bytearray(index.read_bytes())
+    data[-1] ^= 0xff
+    index.write_bytes(bytes(data))
+
+    regenerated = []
+    create_pcap_file = generator.create_pcap_file
+
+    def record(**options):
+        regenerated.append(options['file_name'])
+        return create_pcap_file(**options)
+    monkeypatch.setattr(generator, 'create_pcap_file', record)
+    generator.create_scheduled_files(schedule, seed=9,
+                                     checkpoint=manifest.Manifest.load('run.json'),
+                                     engine='batch', max_size=50000, index=True)
+
+    assert regenerated == names[0:3]
+    assert dict((name, (tmp_path / name).read_bytes()) for name in names) == originals
+    assert manifest.Manifest.load('run.json').is_complete(2)
+
+
+@pytest.mark.parametrize('output_format', ['pcap', 'pcapng'])
+def test_pcapstats_agrees_with_the_records(hosts, tmp_path, output_format):
+    file_name = generator.create_pcap_file(START_TIME, duration=10, max_size=100000,
+                                           file_name=str(tmp_path / 'mixed.pcap'),
+                                           engine='mixed', rng=get_rng(10),
+                                           index=True, output_format=output_format)
+    frames = read_frames(file_name)
+    report = pcapstats.scan_file(file_name, chunk_packets=100)
+    assert report['valid']
+    assert report['packets'] == len(frames)
+    assert report['bytes'] == sum(frame[1] for frame in frames)
+
+    # a record running past the end of the file is reported
+    with open(file_name, 'r+b') as f:
+        f.truncate(len(f.read()) - 10)
+    assert not pcapstats.scan_file(file_name, use_index=False)['valid']
@@ -1,9 +1,112 @@
 #!/bin/env python
 
 import logging
-#import matplotlib.pyplot as plt
-from scipy import interpolate
-#import numpy as np
+import time
+import numpy as np
+
+# Crude hand-jammed points to characterize daily activity at hourly intervals
+WEEKEND_POINTS = [
+    0,  #11PM
+    .4, #12AM
+    0,  #01AM
+    0,  #02AM
+    0,  #03AM
+    0,  #04AM
+    0,  #05AM
+    0,  #06AM
+    .1, #07AM
+    .2, #08AM
+    .5, #09AM
+    .45,#10AM
+    .45,#11AM
+    .5, #12AM
+    .45,#01PM
+    .45,#02PM
+    .45,#03PM
+    .45, #04PM
+    .5, #05PM
+    .2, #06PM
+    0,  #07PM
+    0,  #08PM
+    0,  #09PM
+    0,  #10PM
+    0,  #11PM since this isn't a circular array
+    ]
+
+WEEKDAY_POINTS = [
+    0,  #11PM
+    .4, #12AM
+    0,  #01AM
+    0,  #02AM
+    0,  #03AM
+    0,  #04AM
+    0,  #05AM
+    .1, #06AM
+    .2, #07AM
+    .4, #08AM
+    .95,#09AM
+    .9, #10AM
+    .9, #11AM
+    .95,#12AM
+    .9, #01PM
+    .9, #02PM
+    .9, #03PM
+    .9,#04PM
+    .95, #05PM
+    .4, #06PM
+    .1, #07PM
+    0,  #08PM
+    0,  #09PM
+    0,  #10PM
+    0,  #11PM since this isn't a circular array
+    ]
+
+# fitted spline coefficients, keyed by weekend, filled in on first use. The
+# same coefficients are kept as plain tuples for the scalar code path.
+_SPLINES = {}
+_SPLINE_ROWS = {}
+
+
+def fit_cubic_spline(y):
+    """
+    Fits a cubic spline through the points (0, y[0]) ... (n-1, y[n-1]) using
+    the same not-a-knot end conditions as scipy's interp1d(kind='cubic'), and
+    returns an (n-1, 4) table holding the a, b, c, d coefficients of
+    a + b*t + c*t**2 + d*t**3 for each unit interval (t in [0,1]).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+
+    # solve for the second derivative m at every knot. Interior knots must
+    # have continuous first derivatives, while not-a-knot makes the third
+    # derivative continuous across the second and second to last knots.
+    system = np.zeros((n, n))
+    rhs = np.zeros(n)
+    system[0, 0:3] = [1, -2, 1]
+    system[n-1, n-3:n] = [1, -2, 1]
+    for i in range(1, n-1):
+        system[i, i-1:i+2] = [1, 4, 1]
+        rhs[i] = 6 * (y[i-1] - 2*y[i] + y[i+1])
+    m = np.linalg.solve(system, rhs)
+
+    coefficients = np.empty((n-1, 4))
+    coefficients[:, 0] = y[:-1]
+    coefficients[:, 1] = (y[1:] - y[:-1]) - (2*m[:-1] + m[1:]) / 6
+    coefficients[:, 2] = m[:-1] / 2
+    coefficients[:, 3] = (m[1:] - m[:-1]) / 6
+    return coefficients
+
+
+def get_spline(weekend=False):
+    """Returns the (cached) spline coefficients for weekdays or weekends"""
+    weekend = bool(weekend)
+    coefficients = _SPLINES.get(weekend)
+    if coefficients is None:
+        coefficients = fit_cubic_spline(WEEKEND_POINTS if weekend else WEEKDAY_POINTS)
+        _SPLINES[weekend] = coefficients
+        _SPLINE_ROWS[weekend] = [tuple(row) for row in coefficients.tolist()]
+    return coefficients
+
 
 '''
 Input:
@@ -18,90 +121,193 @@ def get_duration_scalar(hour,weekend=False):
         raise ValueError("hour must be [0,24), value given was "+str(hour))
     
     hour = (hour + 1) % 24
-    #if (hour > 23):
-    #    hour -= 23
-    
-        
-    x = range(0,25)
 
-# Crude hand-jammed points to characterize daily activity at hourly intervals
-    if (weekend):
-        y = [0,  #11PM
-             .4, #12AM
-             0,  #01AM
-             0,  #02AM
-             0,  #03AM
-             0,  #04AM
-             0,  #05AM
-             0,  #06AM
-             .1, #07AM
-             .2, #08AM
-             .5, #09AM
-             .45,#10AM
-             .45,#11AM
-             .5, #12AM
-             .45,#01PM
-             .45,#02PM
-             .45,#03PM
-             .45, #04PM
-             .5, #05PM
-             .2, #06PM
-             0,  #07PM
-             0,  #08PM
-             0,  #09PM
-             0,  #10PM
-             0,  #11PM since this isn't a circular array
-             ]
-    else:
-        y = [0,  #11PM
-             .4, #12AM
-             0,  #01AM
-             0,  #02AM
-             0,  #03AM
-             0,  #04AM
-             0,  #05AM
-             .1, #06AM
-             .2, #07AM
-             .4, #08AM
-             .95,#09AM
-             .9, #10AM
-             .9, #11AM
-             .95,#12AM
-             .9, #01PM
-             .9, #02PM
-             .9, #03PM
-             .9,#04PM
-             .95, #05PM
-             .4, #06PM
-             .1, #07PM
-             0,  #08PM
-             0,  #09PM
-             0,  #10PM
-             0,  #11PM since this isn't a circular array
-             ]
-    
-    
-    f = interpolate.interp1d(x, y, kind='cubic')
-    
+    # evaluate the piece of the spline that covers this hour
+    rows = _SPLINE_ROWS.get(bool(weekend))
+    if rows is None:
+        get_spline(weekend)
+        rows = _SPLINE_ROWS[bool(weekend)]
+    interval = min(int(hour), 23)
+    a, b, c, d = rows[interval]
+    t = hour - interval
+
     # We are using cubic splines to make the curve smooth, we need to prevent values out of range
-    result = 1 - f(hour)
+    result = 1 - (a + t*(b + t*(c + t*d)))
     if (result < 0):
         result = 0
     elif (result > 1):
         result = 1
-    
-    
-    '''
-    x1000  = np.arange(0, 24, 0.1)
-    plt.figure()
-    plt.plot(x, y, 'x', x1000, f(x1000),'b')
-    plt.legend(['Points', ' Spline'])
-    plt.show()
-    '''
-        
+
     return result
 
 
+def get_duration_scalars(hours, weekend=False):
+    """
+    Vectorized get_duration_scalar: evaluates a whole array of hours in one
+    call. weekend may be a single bool or an array matching hours.
+    """
+    hours = np.asarray(hours, dtype=np.float64)
+    if np.any((hours < 0) | (hours >= 24)):
+        raise ValueError("hours must be [0,24)")
+
+    hours = (hours + 1) % 24
+    intervals = np.minimum(hours.astype(np.int64), 23)
+    t = hours - intervals
+
+    if np.ndim(weekend) == 0:
+        coefficients = get_spline(weekend)[intervals]
+    else:
+        weekend = np.asarray(weekend, dtype=bool)
+        coefficients = np.where(weekend[..., np.newaxis],
+                                get_spline(True)[intervals],
+                                get_spline(False)[intervals])
+
+    a, b, c, d = np.moveaxis(coefficients, -1, 0)
+    return np.clip(1 - (a + t*(b + t*(c + t*d))), 0, 1)
+
+
+# packet rate at the quietest point of the day, relative to the busiest
+MIN_ACTIVITY = 0.05
+# bursty arrivals alternate between on and off periods whose lengths are
+# exponentially distributed with these means (seconds). While off, the rate
+# drops to BURST_OFF_RATE of what it would otherwise be.
+BURST_ON_TIME = 0.5
+BURST_OFF_TIME = 0.5
+BURST_OFF_RATE = 0.05
+# resolution (seconds) of the rate curve, and a cap on its number of points
+RATE_RESOLUTION = 0.01
+MAX_RATE_POINTS = 1000000
+
+
+def get_utc_offsets(timestamps):
+    """
+    Local time zone offset (seconds east of UTC) at every one of an array of
+    unix timestamps. Rather than asking for the local time of each one, the
+    daylight saving changes between the earliest and latest timestamp are
+    found by bisection, so this costs a few dozen calls per change.
+    """
+    def offset(second):
+        return time.localtime(second).tm_gmtoff
+
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    start = int(np.floor(timestamps.min()))
+    end = int(np.floor(timestamps.max()))
+    offsets = np.full(timestamps.shape, offset(start), dtype=np.float64)
+
+    # changes are months apart, so the spans checked here hold at most one
+    # and an unchanged offset at both ends means no change in between
+    while offset(start) != offset(end):
+        before, low, high = offset(start), start, end
+        while high - low > 1:
+            middle = (low + high) // 2
+            if offset(middle) == before:
+                low = middle
+            else:
+                high = middle
+        offsets[timestamps >= high] = offset(high)
+        start = high
+    return offsets
+
+
+def get_activity(timestamps):
+    """
+    Relative packet rate (MIN_ACTIVITY to 1) at an array of unix timestamps,
+    following the diurnal curve for the local hour and day of the week
+    (across daylight saving changes too)
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    local = timestamps + get_utc_offsets(timestamps)
+    days, seconds = np.divmod(local, 86400)
+
+    # the epoch fell on a thursday (Mon = 0, Sun = 6)
+    weekend = (days + 3) % 7 > 4
+    hours = np.minimum(seconds / 3600.0, np.nextafter(24, 0))
+
+    activity = 1 - get_duration_scalars(hours, weekend)
+    return MIN_ACTIVITY + (1 - MIN_ACTIVITY) * activity
+
+
+class ArrivalProcess(object):
+    """
+    Spreads count packet arrivals over [start_time, start_time + duration)
+    with an instantaneous rate that follows the diurnal curve, optionally
+    modulated by on/off bursts.
+
+    Arrivals are first laid out in "operational time", where the rate is a
+    constant one packet per unit, either evenly or as a Poisson process, and
+    then mapped back to wall-clock time through the inverse of the
+    cumulative rate curve. Timestamps are produced in batches as
+    cumulative sums, so memory use only depends on the batch size.
+    """
+
+    def __init__(self, start_time, duration, count, process='poisson',
+                 diurnal=True, bursty=False, rng=np.random,
+                 resolution=RATE_RESOLUTION):
+        self.start_time = start_time
+        self.duration = duration
+        self.count = count
+        self.process = process
+        self.rng = rng
+
+        # sample the rate curve and integrate it
+        steps = max(1, min(int(np.ceil(duration / resolution)), MAX_RATE_POINTS))
+        self.times = np.linspace(0, duration, steps + 1)
+        midpoints = (self.times[:-1] + self.times[1:]) / 2
+        if diurnal:
+            rates = get_activity(start_time + midpoints)
+        else:
+            rates = np.ones(steps)
+        if bursty:
+            rates = rates * self.get_bursts(midpoints)
+
+        cumulative = np.empty(steps + 1)
+        cumulative[0] = 0
+        np.cumsum(rates, out=cumulative[1:])
+        self.cumulative = cumulative * (count / cumulative[-1])
+
+    def get_bursts(self, midpoints):
+        """Rate multiplier (1 while on, BURST_OFF_RATE while off) per point"""
+        mean_cycle = BURST_ON_TIME + BURST_OFF_TIME
+        cycles = int(np.ceil(self.duration / mean_cycle * 2)) + 2
+        lengths = np.empty(2 * cycles)
+        lengths[0::2] = self.rng.exponential(BURST_ON_TIME, cycles)
+        lengths[1::2] = self.rng.exponential(BURST_OFF_TIME, cycles)
+        edges = np.cumsum(lengths) - self.rng.uniform(0, mean_cycle)
+
+        state = np.searchsorted(edges, midpoints, side='right')
+        return np.where(state % 2 == 0, 1.0, BURST_OFF_RATE)
+
+    def get_operational_times(self, first, count):
+        """
+        Arrival positions (in units of packets) of packets first to
+        first + count. Poisson arrivals inside the batch are uniform order
+        statistics, built as a normalized cumulative sum of exponential gaps.
+        """
+        if self.process == 'even':
+            return first + np.arange(count) + 0.5
+
+        gaps = self.rng.exponential(1.0, count + 1)
+        positions = np.cumsum(gaps[:-1])
+        positions *= count / (positions[-1] + gaps[-1])
+        return first + positions
+
+    def batches(self, batch_size, ticks=1000000):
+        """
+        Yields (ts_sec, ts_usec) arrays of at most batch_size arrivals, the
+        sub-second part counting ticks (1e6 or 1e9) per second
+        """
+        first = 0
+        while first < self.count:
+            count = min(batch_size, self.count - first)
+            offsets = np.interp(self.get_operational_times(first, count),
+                                self.cumulative, self.times)
+
+            timestamps = (np.int64(round(self.start_time * ticks)) +
+                          (offsets * ticks).astype(np.int64))
+            yield timestamps // ticks, timestamps % ticks
+            first += count
+
+
 def main():
     logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
 